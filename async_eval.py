@@ -0,0 +1,76 @@
+from __future__ import print_function
+import shutil, tempfile, multiprocessing, traceback
+from six.moves import queue
+from chainer import cuda
+
+def _worker(tasks, results, evaluate, load_model, gpu_device):
+	# cuda is initialized here, after the fork
+	if gpu_device >= 0:
+		cuda.get_device(gpu_device).use()
+	while True:
+		task = tasks.get()
+		# only the latest snapshot is worth evaluating, older ones are reported as skipped
+		while task is not None:
+			try:
+				newer = tasks.get_nowait()
+			except queue.Empty:
+				break
+			shutil.rmtree(task[1], ignore_errors=True)
+			results.put((task[0], None, None))
+			task = newer
+		if task is None:
+			return
+		epoch, snapshot_dir = task
+		try:
+			model = load_model(snapshot_dir)
+			if gpu_device >= 0:
+				model.to_gpu()
+			results.put((epoch, evaluate(model), None))
+		except Exception:
+			results.put((epoch, None, traceback.format_exc()))
+		finally:
+			shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+# evaluates weight snapshots in a separate process while training continues
+# evaluate(model) -> metrics; the worker is forked so evaluate may close over the loaded dataset
+# must be created before cuda is initialized in the training process
+class AsyncEvaluator(object):
+	def __init__(self, evaluate, load_model, save_model, gpu_device=-1):
+		self.save_model = save_model
+		self.num_pending = 0
+		self._tasks = multiprocessing.Queue()
+		self._results = multiprocessing.Queue()
+		self._process = multiprocessing.Process(target=_worker, args=(self._tasks, self._results, evaluate, load_model, gpu_device))
+		self._process.daemon = True
+		self._process.start()
+
+	# writes the current weights to a temporary directory and queues them
+	def submit(self, epoch, model):
+		snapshot_dir = tempfile.mkdtemp(prefix="snapshot")
+		self.save_model(snapshot_dir, model)
+		self._tasks.put((epoch, snapshot_dir))
+		self.num_pending += 1
+
+	# returns the finished evaluations as a list of (epoch, metrics)
+	# with block=True waits until every submitted snapshot has been evaluated or skipped
+	def poll(self, block=False):
+		finished = []
+		while self.num_pending > 0:
+			try:
+				epoch, metrics, error = self._results.get(block, 1)
+			except queue.Empty:
+				if block and self._process.is_alive():
+					continue
+				break
+			self.num_pending -= 1
+			if error is not None:
+				print(error)
+			elif metrics is not None:
+				finished.append((epoch, metrics))
+		return finished
+
+	def close(self):
+		results = self.poll(block=True)
+		self._tasks.put(None)
+		self._process.join()
+		return results
@@ -0,0 +1,31 @@
+import itertools
+import numpy as np
+
+# concatenates a list of word id lists into one int32 array
+# returns tokens, lengths, offsets (start of each sentence in tokens)
+def flatten(dataset):
+	lengths = np.fromiter((len(word_ids) for word_ids in dataset), dtype=np.int64, count=len(dataset))
+	tokens = np.fromiter(itertools.chain.from_iterable(dataset), dtype=np.int32, count=int(lengths.sum()))
+	offsets = np.zeros_like(lengths)
+	np.cumsum(lengths[:-1], out=offsets[1:])
+	return tokens, lengths, offsets
+
+# index of the first size that can hold each length
+# sizes do not have to be sorted, len(sizes) is returned for lengths that do not fit
+def assign_buckets(lengths, sizes):
+	return np.searchsorted(np.maximum.accumulate(np.asarray(sizes)), lengths, side="left")
+
+# writes the sentences selected by indices into a (len(indices), width) matrix with one scatter
+# sentences are right-aligned if left_pad is True
+# returns the matrix and the mask of non-PAD positions
+def pack(tokens, lengths, offsets, indices, width, pad_id, left_pad=False):
+	sub_lengths = lengths[indices]
+	num_tokens = int(sub_lengths.sum())
+	rows = np.repeat(np.arange(len(indices)), sub_lengths)
+	positions = np.arange(num_tokens) - np.repeat(np.cumsum(sub_lengths) - sub_lengths, sub_lengths)	# position in the sentence
+	columns = positions + np.repeat(width - sub_lengths, sub_lengths) if left_pad else positions
+	matrix = np.full((len(indices), width), pad_id, dtype=np.int32)
+	matrix[rows, columns] = tokens[np.repeat(offsets[indices], sub_lengths) + positions]
+	mask = np.zeros((len(indices), width), dtype=np.bool_)
+	mask[rows, columns] = True
+	return matrix, mask
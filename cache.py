@@ -0,0 +1,38 @@
+import os, json, hashlib, pickle, tempfile
+
+def hash_file(filename, chunk_size=1 << 20):
+	sha1 = hashlib.sha1()
+	with open(filename, "rb") as f:
+		while True:
+			chunk = f.read(chunk_size)
+			if len(chunk) == 0:
+				break
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+# parts must be json serializable
+def make_key(*parts):
+	return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_cache_filename(cache_dir, key):
+	return os.path.join(cache_dir, key + ".pickle")
+
+def load_cache(cache_dir, key):
+	filename = get_cache_filename(cache_dir, key)
+	if not os.path.isfile(filename):
+		return None
+	print("loading {} ...".format(filename))
+	with open(filename, "rb") as f:
+		return pickle.load(f)
+
+def save_cache(cache_dir, key, data):
+	try:
+		os.makedirs(cache_dir)
+	except:
+		pass
+
+	# write to a temporary file first so that concurrent readers never see a partial cache
+	fd, tmp_filename = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+	with os.fdopen(fd, "wb") as f:
+		pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.rename(tmp_filename, get_cache_filename(cache_dir, key))
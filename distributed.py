@@ -0,0 +1,281 @@
+from __future__ import division
+from __future__ import print_function
+from six.moves import xrange, queue
+import argparse, json, multiprocessing, socket, struct, threading, time
+import numpy as np
+from parallel import DataParallelBase
+
+# length-prefixed json, only used during the rendezvous
+def _send_message(sock, message):
+	data = json.dumps(message).encode("utf-8")
+	sock.sendall(struct.pack("!I", len(data)) + data)
+
+def _recv_exactly(sock, buf):
+	view = memoryview(buf)
+	while len(view) > 0:
+		n = sock.recv_into(view)
+		if n == 0:
+			raise RuntimeError("a peer closed the connection")
+		view = view[n:]
+
+def _recv_message(sock):
+	header = bytearray(4)
+	_recv_exactly(sock, header)
+	data = bytearray(struct.unpack("!I", bytes(header))[0])
+	_recv_exactly(sock, data)
+	return json.loads(bytes(data).decode("utf-8"))
+
+# peers may not be listening yet, retries until timeout
+def _connect(host, port, timeout):
+	deadline = time.time() + timeout
+	while True:
+		try:
+			return socket.create_connection((host, port), timeout)
+		except socket.error:
+			if time.time() > deadline:
+				raise
+			time.sleep(0.1)
+
+# the address of the interface that routes to the master, which is the one other nodes can reach
+def _local_address(master_addr):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		sock.connect((master_addr, 1))
+		return sock.getsockname()[0]
+	except socket.error:
+		return "127.0.0.1"
+	finally:
+		sock.close()
+
+def _listen(host, port):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(16)
+	return sock
+
+# every rank listens on an ephemeral port for its left neighbour in the ring
+# rank 0 listens on master_port, collects (host, port) of all ranks and sends the table back
+# returns the listening socket and the table
+def rendezvous(rank, world_size, master_addr, master_port, timeout=60):
+	listener = _listen("", 0)
+	listener.settimeout(timeout)
+	address = [_local_address(master_addr), listener.getsockname()[1]]
+	if rank == 0:
+		server = _listen("", master_port)
+		server.settimeout(timeout)
+		try:
+			table = {0: address}
+			connections = []
+			while len(table) < world_size:
+				sock, _ = server.accept()
+				sock.settimeout(timeout)
+				message = _recv_message(sock)
+				if message["rank"] in table or not 0 < message["rank"] < world_size:
+					raise RuntimeError("invalid or duplicate rank {}".format(message["rank"]))
+				table[message["rank"]] = message["address"]
+				connections.append(sock)
+			table = [table[r] for r in xrange(world_size)]
+			for sock in connections:
+				_send_message(sock, table)
+				sock.close()
+		finally:
+			server.close()
+	else:
+		sock = _connect(master_addr, master_port, timeout)
+		try:
+			_send_message(sock, {"rank": rank, "address": address})
+			table = _recv_message(sock)
+		finally:
+			sock.close()
+	return listener, table
+
+# sums arrays over all ranks with a ring all-reduce over tcp
+# every rank sends to rank+1 and receives from rank-1, each one sends and receives 2*(world_size-1)/world_size of the array
+# arrays are split into buckets of bucket_size elements, a communication thread reduces them one after another
+# while the caller keeps packing and submitting the next ones, and a sender thread lets sends and receives overlap
+# float32 arrays go over the wire as dtype (float32 or float16), partial sums are kept in float32
+class RingAllReduce(object):
+	def __init__(self, rank, world_size, master_addr="127.0.0.1", master_port=29500, dtype=np.float32, bucket_size=1 << 20, timeout=60):
+		assert 0 <= rank < world_size
+		self.rank = rank
+		self.world_size = world_size
+		self.dtype = np.dtype(dtype)
+		self.bucket_size = bucket_size
+		self._error = None
+		self._next = None
+		self._prev = None
+		if world_size > 1:
+			listener, table = rendezvous(rank, world_size, master_addr, master_port, timeout)
+			try:
+				# connect to the right neighbour, accept the left one
+				host, port = table[(rank + 1) % world_size]
+				self._next = _connect(host, port, timeout)
+				_send_message(self._next, {"rank": rank})
+				self._prev, _ = listener.accept()
+				self._prev.settimeout(timeout)
+				if _recv_message(self._prev)["rank"] != (rank - 1) % world_size:
+					raise RuntimeError("unexpected peer in the ring")
+			finally:
+				listener.close()
+			for sock in (self._next, self._prev):
+				sock.settimeout(None)	# a step may take arbitrarily long, e.g. while rank 0 evaluates
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self._sends = queue.Queue()
+		self._tasks = queue.Queue()
+		self._num_pending = 0
+		self._done = threading.Condition()
+		self._threads = [threading.Thread(target=self._send_loop), threading.Thread(target=self._reduce_loop)]
+		for thread in self._threads:
+			thread.daemon = True
+			thread.start()
+
+	def _send_loop(self):
+		while True:
+			data = self._sends.get()
+			if data is None:
+				return
+			try:
+				self._next.sendall(data)
+			except Exception as e:
+				self._error = e
+				return
+
+	def _reduce_loop(self):
+		while True:
+			task = self._tasks.get()
+			if task is None:
+				return
+			try:
+				if self._error is None:
+					self._ring(*task)
+			except Exception as e:
+				self._error = e
+			with self._done:
+				self._num_pending -= 1
+				self._done.notify_all()
+
+	def _recv(self, size, dtype):
+		buf = np.empty((size,), dtype=dtype)
+		_recv_exactly(self._prev, buf.view(np.uint8))
+		return buf
+
+	# array is replaced in place by the sum over all ranks
+	def _ring(self, array, compress):
+		W, r = self.world_size, self.rank
+		wire_dtype = self.dtype if compress and array.dtype == np.float32 else array.dtype
+		bounds = np.linspace(0, array.size, W + 1).astype(np.int64)
+		chunk = lambda c: array[bounds[c]:bounds[c + 1]]
+
+		# reduce-scatter, after W-1 steps this rank holds the sum of chunk r+1
+		for s in xrange(W - 1):
+			self._sends.put(chunk((r - s) % W).astype(wire_dtype).tobytes())
+			target = chunk((r - s - 1) % W)
+			target += self._recv(target.size, wire_dtype)
+		# every rank must end up with the same values
+		owned = chunk((r + 1) % W)
+		owned[...] = owned.astype(wire_dtype)
+
+		# all-gather
+		for s in xrange(W - 1):
+			self._sends.put(chunk((r + 1 - s) % W).astype(wire_dtype).tobytes())
+			target = chunk((r - s) % W)
+			target[...] = self._recv(target.size, wire_dtype)
+		if self._error is not None:
+			raise self._error
+
+	# queues a contiguous array to be summed in place, all ranks must submit the same sizes in the same order
+	# compress=False keeps the wire dtype of the array, e.g. for counts that must be exact
+	def submit(self, array, compress=True):
+		assert array.flags.c_contiguous
+		if self.world_size == 1:
+			return
+		with self._done:
+			self._num_pending += 1
+		self._tasks.put((array.reshape(-1), compress))
+
+	# blocks until every submitted array has been reduced
+	def wait(self):
+		with self._done:
+			while self._num_pending > 0:
+				self._done.wait(1)
+		if self._error is not None:
+			raise RuntimeError("all-reduce failed: {}".format(self._error))
+
+	# same interface as parallel.SharedAllReduce
+	def __call__(self, worker_index, array, is_alive=None, compress=True):
+		array = array.reshape(-1)
+		for start in xrange(0, array.size, self.bucket_size):
+			self.submit(array[start:start + self.bucket_size], compress)
+		self.wait()
+
+	# array of every rank is replaced by the one of rank 0
+	def broadcast(self, worker_index, array, is_alive=None):
+		if self.rank != 0:
+			array[...] = 0
+		self(worker_index, array, is_alive, compress=False)
+
+	def close(self):
+		self._tasks.put(None)
+		self._sends.put(None)
+		for thread in self._threads:
+			thread.join()
+		for sock in (self._next, self._prev):
+			if sock is not None:
+				sock.close()
+
+# synchronous data-parallel training with one process per rank, possibly on different machines
+# every rank must create the model with the same weights, rank 0 broadcasts them at the start
+class DistributedDataParallel(DataParallelBase):
+	def __init__(self, model, optimizer, all_reduce, sync_interval=100):
+		super(DistributedDataParallel, self).__init__(model, optimizer, all_reduce, all_reduce.rank, all_reduce.world_size, sync_interval)
+		all_reduce.broadcast(self.worker_index, self.params.data)
+
+	# the scalars are reduced first and exactly, the gradients are divided by the total number of tokens
+	# before they are sent, so that float16 on the wire carries averaged gradients that do not overflow
+	def _all_reduce(self, grad, scalars, is_alive=None):
+		self.all_reduce.submit(scalars, compress=False)
+		self.all_reduce.wait()
+		grad *= 1 / max(1, float(scalars[1]))
+		bucket_size = self.all_reduce.bucket_size
+		for start in xrange(0, grad.size, bucket_size):
+			self.all_reduce.submit(grad[start:start + bucket_size])
+		self.all_reduce.wait()
+
+def _run_benchmark(rank, world_size, master_addr, master_port, size, num_steps, fp16, bucket_size):
+	all_reduce = RingAllReduce(rank, world_size, master_addr, master_port, dtype=np.float16 if fp16 else np.float32, bucket_size=bucket_size)
+	array = np.full((size,), rank + 1, dtype=np.float32)
+	all_reduce(rank, array)
+	assert np.all(array == world_size * (world_size + 1) // 2)
+	start_time = time.time()
+	for step in xrange(num_steps):
+		array.fill(rank + 1)
+		all_reduce(rank, array)
+	elapsed_time = time.time() - start_time
+	all_reduce.close()
+	if rank == 0:
+		print("ranks	{}	{:.1f} MB/s per rank".format(world_size, 2 * (world_size - 1) / world_size * size * all_reduce.dtype.itemsize * num_steps / elapsed_time / 1e6))
+
+# python distributed.py --world-size 4 runs all ranks on localhost
+# python distributed.py --rank r --world-size n --master-addr host runs one rank
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rank", type=int, default=None)
+	parser.add_argument("--world-size", type=int, default=2)
+	parser.add_argument("--master-addr", type=str, default="127.0.0.1")
+	parser.add_argument("--master-port", type=int, default=29500)
+	parser.add_argument("--size", type=int, default=1 << 24)
+	parser.add_argument("--steps", type=int, default=10)
+	parser.add_argument("--bucket-size", type=int, default=1 << 20)
+	parser.add_argument("--fp16", default=False, action="store_true")
+	args = parser.parse_args()
+	benchmark_args = (args.world_size, args.master_addr, args.master_port, args.size, args.steps, args.fp16, args.bucket_size)
+	if args.rank is not None:
+		_run_benchmark(args.rank, *benchmark_args)
+	else:
+		processes = [multiprocessing.Process(target=_run_benchmark, args=(rank,) + benchmark_args) for rank in xrange(1, args.world_size)]
+		for process in processes:
+			process.start()
+		_run_benchmark(0, *benchmark_args)
+		for process in processes:
+			process.join()
@@ -1,6 +1,23 @@
 import math
+import numpy as np
 from chainer import optimizer, cuda
 
+# loss feedback of Eve, returns the new (d, f) after step t with the given loss
+def update_d_and_f(d, f, loss, t, beta3=0.999, lower_threshold=0.1, upper_threshold=10):
+	if t <= 1:
+		return d, loss
+	if loss > f:
+		delta = lower_threshold + 1.
+		Delta = upper_threshold + 1.
+	else:
+		delta = 1. / (upper_threshold + 1.)
+		Delta = 1. / (lower_threshold + 1.)
+	c = min(max(delta, loss / (f + 1e-12)), Delta)
+	new_f = c * f
+	r = abs(new_f - f) / (min(new_f, f) + 1e-12)
+	d += (1 - beta3) * (r - d)
+	return d, new_f
+
 class Eve(optimizer.GradientMethod):
 	def __init__(self, alpha=0.001, beta1=0.9, beta2=0.999, beta3=0.999, eps=1e-8, lower_threshold=0.1, upper_threshold=10):
 		self.alpha = alpha
@@ -10,44 +27,29 @@ class Eve(optimizer.GradientMethod):
 		self.eps = eps
 		self.lower_threshold = lower_threshold
 		self.upper_threshold = upper_threshold
+		# d and f depend only on the loss, they are shared by all parameters
+		self.d = 1.
+		self.f = 0.
 
 	def init_state(self, param, state):
 		xp = cuda.get_array_module(param.data)
 		with cuda.get_device(param.data):
 			state['m'] = xp.zeros_like(param.data)
 			state['v'] = xp.zeros_like(param.data)
-			state['d'] = xp.ones(1, dtype=param.data.dtype)
-			state['f'] = xp.zeros(1, dtype=param.data.dtype)
 
-	def _update_d_and_f(self, state):
-		d, f = state['d'], state['f']
-		if self.t > 1:
-			old_f = float(cuda.to_cpu(state['f']))
-			if self.loss > old_f:
-				delta = self.lower_threshold + 1.
-				Delta = self.upper_threshold + 1.
-			else:
-				delta = 1. / (self.upper_threshold + 1.)
-				Delta = 1. / (self.lower_threshold + 1.)
-			c = min(max(delta, self.loss / (old_f + 1e-12)), Delta)
-			new_f = c * old_f
-			r = abs(new_f - old_f) / (min(new_f, old_f) + 1e-12)
-			d += (1 - self.beta3) * (r - d)
-			f[:] = new_f
-		else:
-			f[:] = self.loss
+	# called once per update, t is the step being taken
+	def _update_d_and_f(self, t):
+		self.d, self.f = update_d_and_f(self.d, self.f, self.loss, t, self.beta3, self.lower_threshold, self.upper_threshold)
 
 	def update_one_cpu(self, param, state):
-		m, v, d = state['m'], state['v'], state['d']
+		m, v = state['m'], state['v']
 		grad = param.grad
 
-		self._update_d_and_f(state)
 		m += (1. - self.beta1) * (grad - m)
 		v += (1. - self.beta2) * (grad * grad - v)
-		param.data -= self.lr * m / (d * np.sqrt(v) + self.eps)
+		param.data -= self.lr * m / (self.d * np.sqrt(v) + self.eps)
 
 	def update_one_gpu(self, param, state):
-		self._update_d_and_f(state)
 		cuda.elementwise(
 			'T grad, T lr, T one_minus_beta1, T one_minus_beta2, T eps, T d',
 			'T param, T m, T v',
@@ -55,7 +57,7 @@ class Eve(optimizer.GradientMethod):
 			   v += one_minus_beta2 * (grad * grad - v);
 			   param -= lr * m / (d * sqrt(v) + eps);''',
 			'eve')(param.grad, self.lr, 1 - self.beta1, 1 - self.beta2,
-				   self.eps, float(state['d']), param.data, state['m'],
+				   self.eps, self.d, param.data, state['m'],
 				   state['v'])
 
 	@property
@@ -70,4 +72,24 @@ class Eve(optimizer.GradientMethod):
 			raise RuntimeError('Eve.update requires lossfun to be specified')
 		loss_var = lossfun(*args, **kwds)
 		self.loss = float(loss_var.data)
-		super(Eve, self).update(lossfun=lambda: loss_var)
\ No newline at end of file
+		self._update_d_and_f(self.t + 1)
+		super(Eve, self).update(lossfun=lambda: loss_var)
+
+	# applies gradients the caller has already accumulated with backward, e.g. over several micro-batches
+	# loss is the value of the objective these gradients belong to
+	def update_with_loss(self, loss):
+		self.loss = float(loss)
+		self._update_d_and_f(self.t + 1)
+		super(Eve, self).update()
+
+	def serialize(self, serializer):
+		super(Eve, self).serialize(serializer)
+		try:
+			self.d = float(serializer('d', self.d))
+			self.f = float(serializer('f', self.f))
+		except KeyError:
+			# older snapshots keep a copy of d and f in the state of every parameter
+			name = sorted(name for name, param in self.target.namedparams())[0]
+			state = serializer[name[1:]]
+			self.d = float(state('d', np.ones(1, dtype=np.float32))[0])
+			self.f = float(state('f', np.zeros(1, dtype=np.float32))[0])
\ No newline at end of file
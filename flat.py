@@ -0,0 +1,169 @@
+from __future__ import division
+import math
+import numpy as np
+from chainer import cuda
+from eve import Eve, update_d_and_f
+
+# all parameters of a link in one flat float32 array, ordered by name
+def _sorted_params(link):
+	return [param for name, param in sorted(link.namedparams(), key=lambda pair: pair[0])]
+
+def save_params(link, filename):
+	params = _sorted_params(link)
+	flat = np.concatenate([np.asarray(param.data, dtype=np.float32).ravel() for param in params])
+	np.save(filename, flat)
+
+# replaces every parameter of link with a read-only view of the memory-mapped file
+# processes that map the same file share one copy of the weights in the page cache
+def map_params(link, filename):
+	flat = np.load(filename, mmap_mode="r")
+	params = _sorted_params(link)
+	assert flat.size == sum(param.data.size for param in params)
+	offset = 0
+	for param in params:
+		size = param.data.size
+		param.data = flat[offset:offset + size].reshape(param.data.shape)
+		offset += size
+
+# all parameters and gradients of a link packed into two contiguous arrays
+# param.data and param.grad become views of the flat arrays, so this must be created after to_gpu
+class FlatParameters(object):
+	def __init__(self, link):
+		self.params = _sorted_params(link)
+		xp = cuda.get_array_module(self.params[0].data)
+		self.size = sum(param.data.size for param in self.params)
+		self.data = xp.empty((self.size,), dtype=np.float32)
+		self.grad = xp.zeros((self.size,), dtype=np.float32)
+		self.data_views = []
+		self.grad_views = []
+		offset = 0
+		for param in self.params:
+			size = param.data.size
+			data = self.data[offset:offset + size].reshape(param.data.shape)
+			data[...] = param.data
+			param.data = data
+			self.data_views.append(data)
+			self.grad_views.append(self.grad[offset:offset + size].reshape(param.data.shape))
+			offset += size
+		self.gather_grads()
+
+	# backward may replace param.grad with a new array, copies it back into the flat buffer
+	def gather_grads(self):
+		for param, view in zip(self.params, self.grad_views):
+			if param.grad is view:
+				continue
+			if param.grad is None:
+				view.fill(0)
+			else:
+				view[...] = param.grad
+			param.grad = view
+
+# Adam with gradient clipping and weight decay fused into one pass over FlatParameters
+# equivalent to optimizers.Adam with the GradientClipping and WeightDecay hooks used by train.py
+class FlatAdam(object):
+	def __init__(self, alpha=0.001, beta1=0.9, beta2=0.999, eps=1e-8, grad_clip=None, weight_decay=0):
+		self.alpha = alpha
+		self.beta1 = beta1
+		self.beta2 = beta2
+		self.eps = eps
+		self.grad_clip = grad_clip
+		self.weight_decay = weight_decay
+		self.t = 0
+		self.d = 1.
+
+	def setup(self, link):
+		self.target = link
+		self.params = FlatParameters(link)
+		xp = cuda.get_array_module(self.params.data)
+		self.m = xp.zeros_like(self.params.data)
+		self.v = xp.zeros_like(self.params.data)
+		self._buffer = xp.empty_like(self.params.data)	# scratch for the cpu update
+
+	@property
+	def lr(self):
+		fix1 = 1. - self.beta1 ** self.t
+		fix2 = 1. - self.beta2 ** self.t
+		return self.alpha * math.sqrt(fix2) / fix1
+
+	def _update_loss(self, loss):
+		pass
+
+	def update(self, lossfun):
+		loss = lossfun()
+		self.target.zerograds()
+		loss.backward()
+		self.update_with_loss(float(loss.data))
+
+	# applies gradients the caller has already accumulated with backward, loss is the value they belong to
+	def update_with_loss(self, loss):
+		self._update_loss(loss)
+		self.params.gather_grads()
+		self.t += 1
+
+		grad = self.params.grad
+		scale = 1.
+		if self.grad_clip is not None:
+			norm = math.sqrt(float(grad.dot(grad)))
+			if norm > 0:
+				scale = min(1., self.grad_clip / norm)
+
+		if cuda.get_array_module(grad) is np:
+			self._update_cpu(scale)
+		else:
+			self._update_gpu(scale)
+
+	def _update_cpu(self, scale):
+		data, grad, m, v, buf = self.params.data, self.params.grad, self.m, self.v, self._buffer
+		if scale < 1:
+			grad *= scale
+		if self.weight_decay > 0:
+			np.multiply(data, self.weight_decay, out=buf)
+			grad += buf
+		np.subtract(grad, m, out=buf)
+		buf *= 1 - self.beta1
+		m += buf
+		np.multiply(grad, grad, out=buf)
+		buf -= v
+		buf *= 1 - self.beta2
+		v += buf
+		np.sqrt(v, out=buf)
+		buf *= self.d
+		buf += self.eps
+		np.divide(m, buf, out=buf)
+		buf *= self.lr
+		data -= buf
+
+	def _update_gpu(self, scale):
+		cuda.elementwise(
+			'T grad, T scale, T weight_decay, T lr, T one_minus_beta1, T one_minus_beta2, T eps, T d',
+			'T param, T m, T v',
+			'''T g = grad * scale + weight_decay * param;
+			   m += one_minus_beta1 * (g - m);
+			   v += one_minus_beta2 * (g * g - v);
+			   param -= lr * m / (d * sqrt(v) + eps);''',
+			'flat_adam')(self.params.grad, scale, self.weight_decay, self.lr, 1 - self.beta1, 1 - self.beta2,
+				   self.eps, self.d, self.params.data, self.m, self.v)
+
+# Eve on FlatParameters, the loss feedback d scales the denominator of the Adam step
+class FlatEve(FlatAdam):
+	def __init__(self, alpha=0.001, beta1=0.9, beta2=0.999, beta3=0.999, eps=1e-8, lower_threshold=0.1, upper_threshold=10, grad_clip=None, weight_decay=0):
+		super(FlatEve, self).__init__(alpha, beta1, beta2, eps, grad_clip, weight_decay)
+		self.beta3 = beta3
+		self.lower_threshold = lower_threshold
+		self.upper_threshold = upper_threshold
+		self.f = 0.
+
+	def _update_loss(self, loss):
+		self.d, self.f = update_d_and_f(self.d, self.f, loss, self.t + 1, self.beta3, self.lower_threshold, self.upper_threshold)
+
+# gradients of summed losses were accumulated with backward over several batches
+# they are normalized by the total number of non-PAD tokens and applied in one update
+def update_accumulated(model, optimizer, loss_sum, num_tokens):
+	scale = 1 / max(1, num_tokens)
+	for param in model.params():
+		if param.grad is not None:
+			param.grad *= scale
+	if isinstance(optimizer, (Eve, FlatAdam)):
+		optimizer.update_with_loss(loss_sum * scale)	# eve needs the loss of the whole update
+	else:
+		optimizer.update()
@@ -0,0 +1,112 @@
+from __future__ import division
+from six.moves import xrange, queue
+import threading
+import numpy as np
+from chainer import cuda
+
+# returns a view of a reusable buffer stored in buffers[name]
+# the underlying array only grows, so steady-state batches do not allocate
+def get_buffer(buffers, name, shape, dtype=np.int32):
+	size = int(np.prod(shape))
+	buf = buffers.get(name)
+	if buf is None or buf.size < size or buf.dtype != dtype:
+		buf = np.empty((size,), dtype=dtype)
+		buffers[name] = buf
+	return buf[:size].reshape(shape)
+
+class _Sentinel(object):
+	pass
+
+class BatchPrefetcher(object):
+	# requests:		iterable of batch requests, consumed in the background thread
+	#				e.g. (bucket_index, indices)
+	# fill_batch:	fill_batch(buffers, request) -> tuple of host arrays
+	#				arrays must be views of get_buffer(buffers, ...)
+	# num_prefetch:	max number of ready batches waiting in the queue
+	# device:		if >= 0 batches are transferred to this GPU in the background thread
+	def __init__(self, requests, fill_batch, num_prefetch=4, device=-1):
+		assert num_prefetch > 0
+		self.fill_batch = fill_batch
+		self.device = device
+		# one slot is being filled, num_prefetch slots are queued, one slot is used by the consumer
+		self._free_slots = queue.Queue()
+		for _ in xrange(num_prefetch + 2):
+			self._free_slots.put({})
+		self._ready = queue.Queue(maxsize=num_prefetch)
+		self._slot_in_use = None
+		self._closed = False
+		self._thread = threading.Thread(target=self._produce, args=(iter(requests),))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _produce(self, requests):
+		try:
+			for request in requests:
+				buffers = self._free_slots.get()
+				if self._closed:
+					return
+				batch = self.fill_batch(buffers, request)
+				if self.device >= 0:
+					batch = tuple(cuda.to_gpu(array, device=self.device) for array in batch)
+				self._ready.put((buffers, batch))
+			self._ready.put((None, _Sentinel))
+		except Exception as e:
+			self._ready.put((None, e))
+
+	def _release(self):
+		if self._slot_in_use is not None:
+			self._free_slots.put(self._slot_in_use)
+			self._slot_in_use = None
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		# the previous batch is no longer used by the caller
+		self._release()
+		buffers, batch = self._ready.get()
+		if batch is _Sentinel:
+			raise StopIteration
+		if isinstance(batch, Exception):
+			raise batch
+		self._slot_in_use = buffers
+		return batch
+
+	next = __next__
+
+	def close(self):
+		self._closed = True
+		self._release()
+		# unblock the producer
+		self._free_slots.put({})
+		while True:
+			try:
+				self._ready.get_nowait()
+			except queue.Empty:
+				break
+
+class BucketIterator(object):
+	# num_data:		number of samples in each bucket
+	# every sample is visited exactly once per epoch;
+	# each bucket is permuted once per epoch and walked in contiguous slices
+	def __init__(self, num_data, batchsize, seed=0):
+		self.num_data = list(num_data)
+		self.batchsize = batchsize
+		self.rng = np.random.RandomState(seed)
+
+	@property
+	def num_batches_per_epoch(self):
+		return sum((n + self.batchsize - 1) // self.batchsize for n in self.num_data)
+
+	# yields (bucket_index, indices)
+	def epoch(self):
+		permutations = [self.rng.permutation(n).astype(np.int32) for n in self.num_data]
+		# interleave buckets in a random order, bigger buckets appear proportionally more often
+		schedule = np.repeat(np.arange(len(self.num_data)), [(n + self.batchsize - 1) // self.batchsize for n in self.num_data])
+		self.rng.shuffle(schedule)
+		cursors = [0] * len(self.num_data)
+		for bucket_index in schedule:
+			start = cursors[bucket_index]
+			end = min(start + self.batchsize, self.num_data[bucket_index])
+			cursors[bucket_index] = end
+			yield bucket_index, permutations[bucket_index][start:end]
@@ -0,0 +1,211 @@
+from __future__ import division
+from six.moves import xrange
+import six
+import numpy as np
+import chainer
+import chainer.functions
+from chainer import cuda, function
+from chainer.functions.activation import log_softmax
+
+class SoftmaxCrossEntropy(chainer.functions.loss.softmax_cross_entropy.SoftmaxCrossEntropy):
+
+	def forward_gpu(self, inputs):
+		cupy = cuda.cupy
+		x, t = inputs
+		if chainer.is_debug():
+			self._check_input_values(x, t)
+
+		log_y = log_softmax._log_softmax(x, self.use_cudnn)
+		if self.cache_score:
+			self.y = cupy.exp(log_y)
+		if self.class_weight is not None:
+			shape = [1 if d != 1 else -1 for d in six.moves.range(x.ndim)]
+			log_y *= cupy.broadcast_to(
+				self.class_weight.reshape(shape), x.shape)
+		if self.normalize:
+			coeff = cupy.maximum(1, (t != self.ignore_label).sum())
+		else:
+			coeff = max(1, len(t))
+		self._coeff = cupy.divide(1.0, coeff, dtype=x.dtype)
+
+		log_y = cupy.rollaxis(log_y, 1, log_y.ndim)
+		ret = cuda.reduce(
+			'S t, raw T log_y, int32 n_channel, raw T coeff, S ignore_label', 'T out',
+			't == ignore_label ? T(0) : log_y[_j * n_channel + t]',
+			'a + b', 'out = a * -coeff[0]', '0', 'crossent_fwd'
+		)(t, log_y.reduced_view(), log_y.shape[-1], self._coeff, self.ignore_label)
+		return ret,
+
+	def backward_gpu(self, inputs, grad_outputs):
+		cupy = cuda.cupy
+		x, t = inputs
+		if hasattr(self, 'y'):
+			y = self.y
+		else:
+			y = log_softmax._log_softmax(x, self.use_cudnn)
+			cupy.exp(y, out=y)
+		gloss = grad_outputs[0]
+		n_unit = t.size // len(t)
+		coeff = gloss * self._coeff
+		if self.class_weight is None:
+			gx = cuda.elementwise(
+				'T y, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
+				'T gx',
+				'''
+					const int c = (i / n_unit % n_channel);
+					gx = (t == ignore_label) ? 0 : (coeff[0] * (y - (c == t)));
+				''',
+				'softmax_crossent_bwd')(
+					y, cupy.expand_dims(t, 1), coeff, x.shape[1], n_unit, self.ignore_label)
+		else:
+			gx = cuda.elementwise(
+				'T y, raw T w, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
+				'T gx',
+				'''
+					const int c = (i / n_unit % n_channel);
+					gx = t == ignore_label ? 0 : coeff[0] * (y - (c == t)) * w[t];
+				''',
+				'softmax_crossent_bwd')(
+					y, self.class_weight, cupy.expand_dims(t, 1), coeff,
+					x.shape[1], n_unit, self.ignore_label)
+		return gx, None
+
+	# rows of x processed at once on cpu, about 4MB of float32 per block
+	def _rows_per_block(self, x):
+		return max(1, (1 << 20) // x.shape[1])
+
+	# log-sum-exp and target log-probs are computed block by block over the non-ignored rows only
+	# the (N, V) log-softmax and probabilities are never materialised
+	def forward_cpu(self, inputs):
+		x, t = inputs
+		if x.ndim != 2:
+			return super(SoftmaxCrossEntropy, self).forward_cpu(inputs)
+		if chainer.is_debug():
+			self._check_input_values(x, t)
+
+		rows = np.flatnonzero(t != self.ignore_label)
+		log_z = np.empty((len(rows),), dtype=x.dtype)
+		block = self._rows_per_block(x)
+		loss = 0
+		for start in xrange(0, len(rows), block):
+			r = rows[start:start + block]
+			t_block = t[r]
+			x_block = x[r]
+			x_max = x_block.max(axis=1)
+			x_block -= x_max[:, None]
+			np.exp(x_block, out=x_block)
+			lz = np.log(x_block.sum(axis=1)) + x_max
+			log_z[start:start + block] = lz
+			neglogp = lz - x[r, t_block]
+			if self.class_weight is not None:
+				neglogp *= self.class_weight[t_block]
+			loss += float(neglogp.sum())
+
+		if self.normalize:
+			coeff = max(1, len(rows))
+		else:
+			coeff = max(1, len(t))
+		self._coeff = 1.0 / coeff
+		self._rows = rows
+		self._log_z = log_z
+		return np.asarray(loss * self._coeff, dtype=x.dtype),
+
+	# the gradient is written block by block into a single zero-initialised buffer, ignored rows stay zero
+	def backward_cpu(self, inputs, grad_outputs):
+		x, t = inputs
+		if x.ndim != 2:
+			return super(SoftmaxCrossEntropy, self).backward_cpu(inputs, grad_outputs)
+		coeff = grad_outputs[0] * self._coeff
+		rows, log_z = self._rows, self._log_z
+		gx = np.zeros_like(x)
+		block = self._rows_per_block(x)
+		for start in xrange(0, len(rows), block):
+			r = rows[start:start + block]
+			t_block = t[r]
+			y_block = x[r]
+			y_block -= log_z[start:start + block, None]
+			np.exp(y_block, out=y_block)
+			y_block[np.arange(len(r)), t_block] -= 1
+			if self.class_weight is not None:
+				y_block *= (coeff * self.class_weight[t_block])[:, None]
+			else:
+				y_block *= coeff
+			gx[r] = y_block
+		return gx, None
+
+
+def softmax_cross_entropy(x, t, use_cudnn=True, normalize=True, cache_score=True, class_weight=None, ignore_label=-1):
+	return SoftmaxCrossEntropy(use_cudnn, normalize, cache_score, class_weight, ignore_label)(x, t)
+
+# softmax cross entropy of linear(h, W, b) without materialising the (N, V) logits
+# logits are computed chunk_size rows at a time and freed, backward recomputes them chunk by chunk
+# and accumulates the gradients of h, W and b; the loss is normalized by the number of non-ignored rows
+class LinearSoftmaxCrossEntropy(function.Function):
+	def __init__(self, chunk_size=1024, ignore_label=-1):
+		self.chunk_size = chunk_size
+		self.ignore_label = ignore_label
+
+	def _unpack(self, inputs):
+		if len(inputs) == 4:
+			return inputs
+		h, W, t = inputs
+		return h, W, None, t
+
+	def _logits(self, h, W, b, start):
+		y = h[start:start + self.chunk_size].dot(W.T)
+		if b is not None:
+			y += b
+		return y
+
+	def forward(self, inputs):
+		xp = cuda.get_array_module(*inputs)
+		h, W, b, t = self._unpack(inputs)
+		self._log_z = xp.empty((len(h),), dtype=h.dtype)
+		loss = xp.zeros((), dtype=h.dtype)
+		for start in xrange(0, len(h), self.chunk_size):
+			y = self._logits(h, W, b, start)
+			t_chunk = t[start:start + self.chunk_size]
+			mask = t_chunk != self.ignore_label
+			y_t = y[xp.arange(len(y)), xp.where(mask, t_chunk, 0)]
+			y_max = y.max(axis=1)
+			y -= y_max[:, None]
+			xp.exp(y, out=y)
+			log_z = xp.log(y.sum(axis=1)) + y_max
+			self._log_z[start:start + self.chunk_size] = log_z
+			loss += ((log_z - y_t) * mask).sum()
+			del y
+		self._coeff = 1.0 / max(1, int((t != self.ignore_label).sum()))
+		return xp.asarray(loss * self._coeff, dtype=h.dtype),
+
+	def backward(self, inputs, grad_outputs):
+		xp = cuda.get_array_module(*inputs)
+		h, W, b, t = self._unpack(inputs)
+		coeff = grad_outputs[0] * self._coeff
+		gh = xp.empty_like(h)
+		gW = xp.zeros_like(W)
+		gb = None if b is None else xp.zeros_like(b)
+		for start in xrange(0, len(h), self.chunk_size):
+			end = start + self.chunk_size
+			y = self._logits(h, W, b, start)
+			t_chunk = t[start:end]
+			mask = t_chunk != self.ignore_label
+			# softmax minus one-hot, zero for ignored rows
+			y -= self._log_z[start:end, None]
+			xp.exp(y, out=y)
+			y[xp.arange(len(y)), xp.where(mask, t_chunk, 0)] -= 1
+			y *= (mask * coeff).astype(y.dtype)[:, None]
+			gh[start:end] = y.dot(W)
+			gW += y.T.dot(h[start:end])
+			if gb is not None:
+				gb += y.sum(axis=0)
+			del y
+		if b is None:
+			return gh, gW, None
+		return gh, gW, gb, None
+
+
+# h: (N, ndim_h) hidden states, e.g. model(X, return_hidden=True); W, b: parameters of the output layer
+def linear_softmax_cross_entropy(h, W, b, t, chunk_size=1024, ignore_label=-1):
+	if b is None:
+		return LinearSoftmaxCrossEntropy(chunk_size, ignore_label)(h, W, t)
+	return LinearSoftmaxCrossEntropy(chunk_size, ignore_label)(h, W, b, t)
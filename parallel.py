@@ -0,0 +1,220 @@
+from __future__ import division
+from __future__ import print_function
+from six.moves import xrange
+import argparse, ctypes, itertools, multiprocessing, time
+import numpy as np
+import chainer
+import chainer.functions as F
+from qrnn import QRNNEncoder
+from flat import FlatAdam
+
+# reusable barrier for processes, multiprocessing.Barrier is not available on python 2
+# is_alive() is polled while waiting so that a crashed peer raises instead of hanging
+class Barrier(object):
+	def __init__(self, num_workers):
+		self.num_workers = num_workers
+		self._count = multiprocessing.RawValue(ctypes.c_int, 0)
+		self._lock = multiprocessing.Lock()
+		self._arrive = multiprocessing.Semaphore(0)
+		self._leave = multiprocessing.Semaphore(0)
+
+	def _acquire(self, semaphore, is_alive):
+		while not semaphore.acquire(True, 1):
+			if is_alive is not None and not is_alive():
+				raise RuntimeError("a worker exited during training")
+
+	# two phases so that no process can run ahead into the next wait() before everyone has left this one
+	def wait(self, is_alive=None):
+		with self._lock:
+			self._count.value += 1
+			if self._count.value == self.num_workers:
+				for _ in xrange(self.num_workers):
+					self._arrive.release()
+		self._acquire(self._arrive, is_alive)
+		with self._lock:
+			self._count.value -= 1
+			if self._count.value == 0:
+				for _ in xrange(self.num_workers):
+					self._leave.release()
+		self._acquire(self._leave, is_alive)
+
+# sums a float32 vector over all workers through shared memory
+# reduce-scatter: every worker sums its own 1/num_workers slice over the slots of all workers,
+# all-gather: every worker copies the reduced vector back, so each one reads and writes size floats per step
+# num_scalars float64 values can be summed along with the vector, e.g. token counts that must stay exact
+class SharedAllReduce(object):
+	def __init__(self, size, num_workers, num_scalars=0):
+		self.size = size
+		self.num_workers = num_workers
+		self.slots = np.frombuffer(multiprocessing.RawArray(ctypes.c_float, num_workers * size), dtype=np.float32).reshape((num_workers, size))
+		self.reduced = np.frombuffer(multiprocessing.RawArray(ctypes.c_float, size), dtype=np.float32)
+		self.scalar_slots = np.frombuffer(multiprocessing.RawArray(ctypes.c_double, num_workers * num_scalars), dtype=np.float64).reshape((num_workers, num_scalars))
+		self.reduced_scalars = np.frombuffer(multiprocessing.RawArray(ctypes.c_double, num_scalars), dtype=np.float64)
+		self.bounds = np.linspace(0, size, num_workers + 1).astype(np.int64)
+		self.barrier = Barrier(num_workers)
+
+	# array (and scalars, float64) are replaced in place by the sum over all workers
+	def __call__(self, worker_index, array, is_alive=None, scalars=None):
+		self.slots[worker_index] = array
+		if scalars is not None:
+			self.scalar_slots[worker_index] = scalars
+		self.barrier.wait(is_alive)
+		start, end = self.bounds[worker_index], self.bounds[worker_index + 1]
+		np.add.reduce(self.slots[:, start:end], axis=0, out=self.reduced[start:end])
+		if scalars is not None and worker_index == 0:
+			np.add.reduce(self.scalar_slots, axis=0, out=self.reduced_scalars)
+		self.barrier.wait(is_alive)
+		array[...] = self.reduced
+		if scalars is not None:
+			scalars[...] = self.reduced_scalars
+
+	# array (at most size floats) of every worker is replaced by the one of worker 0
+	# goes through the slot of worker 0, other workers may still be copying the last reduced vector
+	def broadcast(self, worker_index, array, is_alive=None):
+		if worker_index == 0:
+			self.slots[0, :array.size] = array
+		self.barrier.wait(is_alive)
+		if worker_index != 0:
+			array[...] = self.slots[0, :array.size]
+		self.barrier.wait(is_alive)
+
+# every worker takes every num_workers-th batch, all workers get num_steps batches
+def shard(requests, worker_index, num_workers, num_steps):
+	return itertools.islice(requests, worker_index, num_steps * num_workers, num_workers)
+
+# the synchronous step shared by DataParallel and distributed.DistributedDataParallel
+# every worker holds a replica of model and optimizer, subclasses implement _all_reduce
+# optimizer must be a FlatAdam or FlatEve that has been set up with model
+class DataParallelBase(object):
+	def __init__(self, model, optimizer, all_reduce, worker_index, num_workers, sync_interval=100):
+		self.model = model
+		self.optimizer = optimizer
+		self.all_reduce = all_reduce
+		self.worker_index = worker_index
+		self.num_workers = num_workers
+		self.sync_interval = sync_interval
+		self.params = optimizer.params
+		self.num_skipped = 0
+
+	# called while waiting for other workers, raises if one of them has died
+	def _get_is_alive(self):
+		return None
+
+	# scalars (float64) are summed over all workers in place
+	# grad becomes the sum over all workers divided by the total number of tokens scalars[1]
+	def _all_reduce(self, grad, scalars, is_alive=None):
+		raise NotImplementedError()
+
+	# loss_fn() -> (loss averaged over the tokens of this worker's batch, number of tokens)
+	# the gradients of all workers are summed, normalized by the total number of tokens
+	# and every worker applies the same update
+	def step(self, loss_fn):
+		is_alive = self._get_is_alive()
+		self.model.zerograds()
+		loss, num_tokens = loss_fn()
+		(loss * num_tokens).backward()
+		self.params.gather_grads()
+
+		# token-weighted loss, number of tokens and the learning rate, which is decided by worker 0
+		scalars = np.asarray([float(loss.data) * num_tokens, num_tokens, self.optimizer.alpha if self.worker_index == 0 else 0], dtype=np.float64)
+		del loss
+		self._all_reduce(self.params.grad, scalars, is_alive)
+
+		# every worker sees the same reduced gradients and skips the same steps
+		if not np.isfinite(float(self.params.grad.dot(self.params.grad))):
+			self.num_skipped += 1
+			return
+		self.optimizer.alpha = float(scalars[2])
+		self.optimizer.update_with_loss(float(scalars[0]) / max(1, float(scalars[1])))
+
+		# replicas apply identical updates, a periodic broadcast removes rounding drift
+		if self.optimizer.t % self.sync_interval == 0:
+			self.all_reduce.broadcast(self.worker_index, self.params.data, is_alive)
+
+# synchronous data-parallel training on cpu
+# the calling process is worker 0, start() forks workers 1..num_workers-1 which inherit model and optimizer,
+# so every replica starts from the same weights and moments
+class DataParallel(DataParallelBase):
+	def __init__(self, model, optimizer, num_workers, sync_interval=100):
+		super(DataParallel, self).__init__(model, optimizer, SharedAllReduce(optimizer.params.size, num_workers, num_scalars=3), 0, num_workers, sync_interval)
+		self.processes = []
+
+	# worker_fn(worker_index) runs in each forked worker and must call step() as often as worker 0 does
+	def start(self, worker_fn):
+		for worker_index in xrange(1, self.num_workers):
+			process = multiprocessing.Process(target=self._run_worker, args=(worker_fn, worker_index))
+			process.daemon = True
+			process.start()
+			self.processes.append(process)
+
+	def _run_worker(self, worker_fn, worker_index):
+		self.worker_index = worker_index
+		self.processes = []
+		worker_fn(worker_index)
+
+	def _is_alive(self):
+		return all(process.exitcode is None for process in self.processes)
+
+	def _get_is_alive(self):
+		if self.worker_index == 0 and len(self.processes) > 0:
+			return self._is_alive
+		return None
+
+	def _all_reduce(self, grad, scalars, is_alive=None):
+		self.all_reduce(self.worker_index, grad, is_alive, scalars)
+		grad *= 1 / max(1, float(scalars[1]))
+
+	def join(self):
+		for process in self.processes:
+			process.join()
+		failed = [process.exitcode for process in self.processes if process.exitcode != 0]
+		self.processes = []
+		if len(failed) > 0:
+			raise RuntimeError("a worker exited with code {}".format(failed[0]))
+
+# language model on random tokens, only used to measure throughput
+def _make_benchmark_model(vocab_size, ndim_h):
+	return chainer.Chain(embed=chainer.links.EmbedID(vocab_size, ndim_h), rnn=QRNNEncoder(ndim_h, ndim_h, kernel_size=4, pooling="fo"), dense=chainer.links.Linear(ndim_h, vocab_size))
+
+def _benchmark_loss(model, batch):
+	source, target = batch[:, :-1], batch[:, 1:].ravel()
+	model.rnn.reset_state()
+	H = model.rnn(F.swapaxes(model.embed(source), 1, 2))
+	Y = model.dense(F.reshape(F.swapaxes(H, 1, 2), (-1, H.shape[1])))
+	return F.softmax_cross_entropy(Y, target), len(target)
+
+# tokens per second for each number of workers, every worker processes batches of batchsize sentences
+def benchmark(worker_counts, num_steps=20, batchsize=32, seq_length=50, vocab_size=10000, ndim_h=320):
+	results = []
+	for num_workers in worker_counts:
+		model = _make_benchmark_model(vocab_size, ndim_h)
+		optimizer = FlatAdam(alpha=0.001, grad_clip=5)
+		optimizer.setup(model)
+		trainer = DataParallel(model, optimizer, num_workers)
+
+		def run(worker_index):
+			rng = np.random.RandomState(worker_index)
+			for step in xrange(num_steps):
+				batch = rng.randint(1, vocab_size, size=(batchsize, seq_length + 1)).astype(np.int32)
+				trainer.step(lambda: _benchmark_loss(model, batch))
+
+		start_time = time.time()
+		trainer.start(run)
+		run(0)
+		trainer.join()
+		elapsed_time = time.time() - start_time
+		tokens_per_second = num_workers * num_steps * batchsize * seq_length / elapsed_time
+		results.append((num_workers, tokens_per_second))
+		print("workers	{}	{:.0f} tokens/s	speedup {:.2f}".format(num_workers, tokens_per_second, tokens_per_second / results[0][1]))
+	return results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--workers", "-w", type=int, nargs="+", default=[1, 2, 4, 8])
+	parser.add_argument("--steps", type=int, default=20)
+	parser.add_argument("--batchsize", "-b", type=int, default=32)
+	parser.add_argument("--seq-length", type=int, default=50)
+	parser.add_argument("--vocab-size", type=int, default=10000)
+	parser.add_argument("--ndim-h", "-nh", type=int, default=320)
+	args = parser.parse_args()
+	benchmark(args.workers, num_steps=args.steps, batchsize=args.batchsize, seq_length=args.seq_length, vocab_size=args.vocab_size, ndim_h=args.ndim_h)
@@ -31,6 +31,17 @@ class Zoneout(function.Function):
 def zoneout(x, ratio=.5):
 	return Zoneout(ratio)(x)
 
+# gathers rows of a state variable, used for reordering beams at inference time
+# if zero_fill is True, index -1 selects a row of zeros (a fresh sequence)
+def take_rows(x, indices, zero_fill=False):
+	if x is None:
+		return None
+	xp = cuda.get_array_module(x.data)
+	data = x.data
+	if zero_fill:
+		data = xp.concatenate((data, xp.zeros((1,) + data.shape[1:], dtype=data.dtype)), axis=0)
+	return Variable(xp.take(data, indices, axis=0))
+
 class QRNN(link.Chain):
 	def __init__(self, in_channels, out_channels, kernel_size=2, pooling="f", zoneout=False, zoneout_ratio=0.1, wgain=1):
 		self.num_split = len(pooling) + 1
@@ -58,9 +69,19 @@ class QRNN(link.Chain):
 
 		return self.pool(functions.split_axis(WX, self.num_split, axis=1), skip_mask=skip_mask)
 
+	# X is the newest input (batchsize, channels, 1)
+	# the last kernel_size inputs are kept in self.window, zeros play the role of the left padding
 	def forward_one_step(self, X, skip_mask=None, test=False):
 		self._test = test
 		pad = self._kernel_size - 1
+		if pad > 0:
+			if self.window is None:
+				data = X.data if isinstance(X, Variable) else X
+				xp = cuda.get_array_module(data)
+				X = functions.concat((Variable(xp.zeros(data.shape[:2] + (pad,), dtype=data.dtype)), X), axis=2)
+			else:
+				X = functions.concat((self.window[:, :, 1:], X), axis=2)
+			self.window = X
 		WX = self.W(X)[:, :, -pad-1, None]
 		return self.pool(functions.split_axis(WX, self.num_split, axis=1), skip_mask=skip_mask)
 
@@ -126,12 +147,21 @@ class QRNN(link.Chain):
 
 	def reset_state(self):
 		self.set_state(None, None, None)
+		self.window = None	# last kernel_size inputs of forward_one_step
 
 	def set_state(self, ct, ht, H):
 		self.ct = ct	# last cell state
 		self.ht = ht	# last hidden state
 		self.H = H		# all hidden states
 
+	# selects (and duplicates) rows of the batch
+	# only the last step of H is kept since forward_one_step never looks further back
+	# with zero_fill, index -1 inserts a row with zero state (exact for f and fo pooling)
+	def reorder_state(self, indices, zero_fill=False):
+		H = None if self.H is None else self.H[:, :, -1, None]
+		self.set_state(take_rows(self.ct, indices, zero_fill), take_rows(self.ht, indices, zero_fill), take_rows(H, indices, zero_fill))
+		self.window = take_rows(self.window, indices, zero_fill)
+
 	def get_last_hidden_state(self):
 		return self.ht
 
@@ -312,6 +342,11 @@ class QRNNGlobalAttentiveDecoder(QRNNDecoder):
 	def reset_state(self):
 		self.set_state(None, None, None, None)
 
+	def reorder_state(self, indices, zero_fill=False):
+		H = None if self.H is None else self.H[:, :, -1, None]
+		contexts = None if self.contexts is None else [take_rows(self.contexts[-1], indices, zero_fill)]
+		self.set_state(take_rows(self.ct, indices, zero_fill), take_rows(self.ht, indices, zero_fill), take_rows(H, indices, zero_fill), contexts)
+
 	def set_state(self, ct, ht, H, contexts):
 		self.ct = ct	# last cell state
 		self.ht = ht	# last hidden state
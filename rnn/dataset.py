@@ -1,6 +1,10 @@
 # coding: utf-8
-import codecs, random
+import codecs, random, sys, os
 import numpy as np
+sys.path.append(os.path.split(os.getcwd())[0])
+from iterator import get_buffer
+from bucket import flatten, assign_buckets, pack
+from cache import hash_file, make_key, load_cache, save_cache
 from common import ID_UNK, ID_PAD, ID_BOS, ID_EOS, bucket_sizes
 
 def read_data(filepath, train_split_ratio=0.9, dev_split_ratio=0.05, seed=0):
@@ -46,44 +50,71 @@ def read_data(filepath, train_split_ratio=0.9, dev_split_ratio=0.05, seed=0):
 
 	return train_dataset, dev_dataset, test_dataset, vocab, vocab_inv
 
+# read_data + make_buckets for every split
+# the result is cached by the content of the file and the preprocessing config
+def load_buckets(filepath, train_split_ratio=0.9, dev_split_ratio=0.05, seed=0, cache_dir=None):
+	key = make_key(hash_file(filepath), train_split_ratio, dev_split_ratio, seed, bucket_sizes)
+	data = None if cache_dir is None else load_cache(cache_dir, key)
+	if data is None:
+		train_dataset, dev_dataset, test_dataset, vocab, vocab_inv = read_data(filepath, train_split_ratio=train_split_ratio, dev_split_ratio=dev_split_ratio, seed=seed)
+		data = {
+			"num_data": (len(train_dataset), len(dev_dataset), len(test_dataset)),
+			"buckets": (make_buckets(train_dataset), make_buckets(dev_dataset), make_buckets(test_dataset)),
+			"bucket_sizes": list(bucket_sizes),
+			"vocab": vocab,
+			"vocab_inv": vocab_inv,
+		}
+		if cache_dir is not None:
+			save_cache(cache_dir, key, data)
+	else:
+		bucket_sizes[:] = data["bucket_sizes"]	# make_buckets appends the max length
+	return data["buckets"], data["num_data"], data["vocab"], data["vocab_inv"], key
+
 # input:
 # [0, a, b, c, 1]
 # [0, d, e, 1]
 # output:
 # [[0, a, b, c,  1]
 #  [0, d, e, 1, -1]]
-def make_buckets(dataset):
-	max_length = 0
-	for word_ids in dataset:
-		if len(word_ids) > max_length:
-			max_length = len(word_ids)
+def make_buckets(dataset, return_masks=False):
+	tokens, lengths, offsets = flatten(dataset)
+	max_length = int(lengths.max()) if len(lengths) > 0 else 0
 	bucket_sizes.append(max_length)
-	buckets_list = [[] for _ in xrange(len(bucket_sizes))]
-	for word_ids in dataset:
-		length = len(word_ids)
-		bucket_index = 0
-		for size in bucket_sizes:
-			if length <= size:
-				if size - length > 0:
-					for _ in xrange(size - length):
-						word_ids.append(ID_PAD)
-				break
-			bucket_index += 1
-		buckets_list[bucket_index].append(word_ids)
+	bucket_indices = assign_buckets(lengths, bucket_sizes)
 	buckets = []
-	for bucket in buckets_list:
-		if len(bucket) == 0:
+	masks = []
+	for bucket_index, size in enumerate(bucket_sizes):
+		indices = np.flatnonzero(bucket_indices == bucket_index)
+		if len(indices) == 0:
 			continue
-		buckets.append(np.asarray(bucket).astype(np.int32))
+		bucket, mask = pack(tokens, lengths, offsets, indices, size, ID_PAD)
+		buckets.append(bucket)
+		masks.append(mask)
+	if return_masks:
+		return buckets, masks
 	return buckets
 
+def sample_indices(bucket_size, num_samples):
+	num_samples = num_samples if bucket_size >= num_samples else bucket_size
+	return np.random.choice(np.arange(bucket_size, dtype=np.int32), size=num_samples, replace=False)
+
 def sample_batch_from_bucket(bucket, num_samples):
-	num_samples = num_samples if len(bucket) >= num_samples else len(bucket)
-	indices = np.random.choice(np.arange(len(bucket), dtype=np.int32), size=num_samples, replace=False)
-	return bucket[indices]
+	return bucket[sample_indices(len(bucket), num_samples)]
 
 def make_source_target_pair(batch):
 	source = batch[:, :-1]
 	target = batch[:, 1:]
 	target = np.reshape(target, (-1,))
+	return source, target
+
+# same as make_source_target_pair(bucket[indices]) but writes into reusable buffers
+def fill_batch(buffers, bucket, indices):
+	num_samples = len(indices)
+	seq_length = bucket.shape[1]
+	batch = get_buffer(buffers, "batch", (num_samples, seq_length))
+	np.take(bucket, indices, axis=0, out=batch)
+	source = get_buffer(buffers, "source", (num_samples, seq_length - 1))
+	target = get_buffer(buffers, "target", (num_samples * (seq_length - 1),))
+	source[...] = batch[:, :-1]
+	target.reshape((num_samples, seq_length - 1))[...] = batch[:, 1:]
 	return source, target
\ No newline at end of file
@@ -1,208 +1,84 @@
 # coding: utf-8
-import math, sys, argparse, six
+from __future__ import division
+from six.moves import xrange
+import math, sys, argparse
 import numpy as np
 import chainer.functions as F
 import chainer
-from chainer import cuda, function
-from chainer.utils import type_check
-from chainer.functions.activation import log_softmax
-from dataset import sample_batch_from_bucket, make_source_target_pair, read_data, make_buckets
+from chainer import cuda, Variable
+from dataset import sample_batch_from_bucket, make_source_target_pair, load_buckets
 from common import ID_UNK, ID_PAD, ID_BOS, ID_EOS, stdout, print_bold, bucket_sizes
 from model import load_model
 
-
-class SoftmaxCrossEntropy(chainer.functions.loss.softmax_cross_entropy.SoftmaxCrossEntropy):
-
-	def forward_gpu(self, inputs):
-		cupy = cuda.cupy
-		x, t = inputs
-		if chainer.is_debug():
-			self._check_input_values(x, t)
-
-		log_y = log_softmax._log_softmax(x, self.use_cudnn)
-		if self.cache_score:
-			self.y = cupy.exp(log_y)
-		if self.class_weight is not None:
-			shape = [1 if d != 1 else -1 for d in six.moves.range(x.ndim)]
-			log_y *= cupy.broadcast_to(
-				self.class_weight.reshape(shape), x.shape)
-		if self.normalize:
-			coeff = cupy.maximum(1, (t != self.ignore_label).sum())
-		else:
-			coeff = max(1, len(t))
-		self._coeff = cupy.divide(1.0, coeff, dtype=x.dtype)
-
-		log_y = cupy.rollaxis(log_y, 1, log_y.ndim)
-		ret = cuda.reduce(
-			'S t, raw T log_y, int32 n_channel, raw T coeff, S ignore_label', 'T out',
-			't == ignore_label ? T(0) : log_y[_j * n_channel + t]',
-			'a + b', 'out = a * -coeff[0]', '0', 'crossent_fwd'
-		)(t, log_y.reduced_view(), log_y.shape[-1], self._coeff, self.ignore_label)
-		return ret,
-
-	def backward_gpu(self, inputs, grad_outputs):
-		cupy = cuda.cupy
-		x, t = inputs
-		if hasattr(self, 'y'):
-			y = self.y
-		else:
-			y = log_softmax._log_softmax(x, self.use_cudnn)
-			cupy.exp(y, out=y)
-		gloss = grad_outputs[0]
-		n_unit = t.size // len(t)
-		coeff = gloss * self._coeff
-		if self.class_weight is None:
-			gx = cuda.elementwise(
-				'T y, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
-				'T gx',
-				'''
-					const int c = (i / n_unit % n_channel);
-					gx = (t == ignore_label) ? 0 : (coeff[0] * (y - (c == t)));
-				''',
-				'softmax_crossent_bwd')(
-					y, cupy.expand_dims(t, 1), coeff, x.shape[1], n_unit, self.ignore_label)
-		else:
-			gx = cuda.elementwise(
-				'T y, raw T w, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
-				'T gx',
-				'''
-					const int c = (i / n_unit % n_channel);
-					gx = t == ignore_label ? 0 : coeff[0] * (y - (c == t)) * w[t];
-				''',
-				'softmax_crossent_bwd')(
-					y, self.class_weight, cupy.expand_dims(t, 1), coeff,
-					x.shape[1], n_unit, self.ignore_label)
-		return gx, None
-
-
-def softmax_cross_entropy(x, t, use_cudnn=True, normalize=True, cache_score=True, class_weight=None, ignore_label=-1):
-	return SoftmaxCrossEntropy(use_cudnn, normalize, cache_score, class_weight, ignore_label)(x, t)
-
-
-def compute_accuracy_batch(model, batch):
-	source, target = make_source_target_pair(batch)
-	if model.xp is cuda.cupy:
-		source = cuda.to_gpu(source)
-		target = cuda.to_gpu(target)
-	model.reset_state()
-	Y = model(source, test=True)
-	return float(F.accuracy(Y, target, ignore_label=ID_PAD).data)
-
-def compute_accuracy(model, buckets, batchsize=100):
-	result = []
-	for bucket_index, dataset in enumerate(buckets):
-		acc = []
-		# split into minibatch
-		if len(dataset) > batchsize:
-			num_sections = len(dataset) // batchsize - 1
-			if len(dataset) % batchsize > 0:
-				num_sections += 1
-			indices = [(i + 1) * batchsize for i in xrange(num_sections)]
-			sections = np.split(dataset, indices, axis=0)
-		else:
-			sections = [dataset]
-		# compute accuracy
-		for batch_index, batch in enumerate(sections):
-			sys.stdout.write("\rcomputing accuracy ... bucket {}/{} (batch {}/{})".format(bucket_index + 1, len(buckets), batch_index + 1, len(sections)))
-			sys.stdout.flush()
-			acc.append(compute_accuracy_batch(model, batch))
-
-		result.append(reduce(lambda x, y: x + y, acc) / len(acc))
-		sys.stdout.write("\r" + stdout.CLEAR)
-		sys.stdout.flush()
-
-	return result
-
-def compute_random_accuracy(model, buckets, batchsize=100):
-	acc = []
-	for dataset in buckets:
-		batch = sample_batch_from_bucket(dataset, batchsize)
-		acc.append(compute_accuracy_batch(model, batch))
-	return acc
-
-def compute_perplexity_batch(model, batch):
-	sum_log_likelihood = 0
+# sums of one batch computed from a single graph-free forward pass
+# returns a device array [summed NLL, #tokens, #correct, #correct in top k]
+def evaluate_batch(model, batch, top_k=0):
 	source, target = make_source_target_pair(batch)
 	xp = model.xp
 	if xp is cuda.cupy:
 		source = cuda.to_gpu(source)
 		target = cuda.to_gpu(target)
 	model.reset_state()
-	Y = model(source, test=True)
-	neglogp = softmax_cross_entropy(Y, target, ignore_label=ID_PAD)
-	return  math.exp(float(neglogp.data))
-
-	# Y = F.softmax(Y)
-	# Y.unchain_backward()
-	# P = Y.data[xp.arange(0, len(target)), target] + 1e-32
-	# log_P = xp.log(P)
-	# mask = target != ID_PAD
-	# log_P *= mask
-	# num_tokens = xp.count_nonzero(mask)
-	# mean_log_P = xp.sum(log_P) / num_tokens
-	# ppl =  math.exp(-float(mean_log_P))
-	# print(ppl, ppl1)
-	# return ppl
-
-	# batchsize = batch.shape[0]
-	# seq_batch = xp.split(Y, batchsize)
-	# target_batch = xp.split(target, batchsize)
-	# for seq, target in zip(seq_batch, target_batch):
-	# 	assert len(seq) == len(target)
-	# 	log_likelihood = 0
-	# 	num_tokens = 0
-	# 	for t in xrange(len(seq)):
-	# 		if target[t] == ID_PAD:
-	# 			break
-	# 		log_likelihood += math.log(seq[t, target[t]] + 1e-32)
-	# 		num_tokens += 1
-	# 	assert num_tokens > 0
-	# 	sum_log_likelihood += log_likelihood / num_tokens
-	# return math.exp(-sum_log_likelihood / batchsize)
-
-def compute_perplexity(model, buckets, batchsize=100):
-	result = []
+	Y = model(Variable(source, volatile="on"), test=True)
+	log_p = F.log_softmax(Y).data
+	mask = target != ID_PAD
+	target_log_p = log_p[xp.arange(len(target)), xp.where(mask, target, 0)]
+	correct = (xp.argmax(log_p, axis=1) == target) & mask
+	if top_k > 0:
+		correct_top_k = ((log_p > target_log_p[:, None]).sum(axis=1) < top_k) & mask
+	else:
+		correct_top_k = correct
+	return xp.stack([-xp.sum(target_log_p * mask), xp.sum(mask), xp.sum(correct), xp.sum(correct_top_k)]).astype(xp.float64)
+
+# accuracy, perplexity and top-k accuracy of each bucket and of the whole corpus
+# every batch goes through the model once, sums are accumulated on the device and copied to the host once at the end
+# if num_samples is given, one random batch of num_samples sentences is taken from each bucket
+def evaluate(model, buckets, batchsize=100, top_k=0, num_samples=None):
+	xp = model.xp
+	sums = xp.zeros((len(buckets), 4), dtype=xp.float64)
 	for bucket_index, dataset in enumerate(buckets):
-		ppl = []
-		# split into minibatch
-		if len(dataset) > batchsize:
-			num_sections = len(dataset) // batchsize - 1
-			if len(dataset) % batchsize > 0:
-				num_sections += 1
-			indices = [(i + 1) * batchsize for i in xrange(num_sections)]
-			sections = np.split(dataset, indices, axis=0)
-		else:
-			sections = [dataset]
-		# compute accuracy
-		for batch_index, batch in enumerate(sections):
-			sys.stdout.write("\rcomputing perplexity ... bucket {}/{} (batch {}/{})".format(bucket_index + 1, len(buckets), batch_index + 1, len(sections)))
+		if num_samples is not None:
+			sums[bucket_index] += evaluate_batch(model, sample_batch_from_bucket(dataset, num_samples), top_k)
+			continue
+		num_batches = (len(dataset) + batchsize - 1) // batchsize
+		for batch_index in xrange(num_batches):
+			sys.stdout.write("\revaluating ... bucket {}/{} (batch {}/{})".format(bucket_index + 1, len(buckets), batch_index + 1, num_batches))
 			sys.stdout.flush()
-			ppl.append(compute_perplexity_batch(model, batch))
-
-		result.append(reduce(lambda x, y: x + y, ppl) / len(ppl))
+			sums[bucket_index] += evaluate_batch(model, dataset[batch_index * batchsize:(batch_index + 1) * batchsize], top_k)
 		sys.stdout.write("\r" + stdout.CLEAR)
 		sys.stdout.flush()
-	return result
 
-def compute_random_perplexity(model, buckets, batchsize=100):
-	ppl = []
-	for dataset in buckets:
-		batch = sample_batch_from_bucket(dataset, batchsize)
-		ppl.append(compute_perplexity_batch(model, batch))
-	return ppl
+	# synchronize once
+	sums = cuda.to_cpu(sums)
+	neglogp, num_tokens, num_correct, num_correct_top_k = sums.T
+	total_tokens = max(num_tokens.sum(), 1)
+	safe_num_tokens = np.maximum(num_tokens, 1)
+	return {
+		"perplexity": math.exp(neglogp.sum() / total_tokens),
+		"accuracy": num_correct.sum() / total_tokens,
+		"top_k_accuracy": num_correct_top_k.sum() / total_tokens,
+		"bucket_perplexity": np.where(num_tokens > 0, np.exp(neglogp / safe_num_tokens), np.nan).tolist(),
+		"bucket_accuracy": (num_correct / safe_num_tokens).tolist(),
+		"bucket_top_k_accuracy": (num_correct_top_k / safe_num_tokens).tolist(),
+		"num_tokens": int(num_tokens.sum()),
+	}
+
+# exact token-weighted perplexity
+# returns (corpus perplexity, list of perplexities of each bucket)
+def compute_corpus_perplexity(model, buckets, batchsize=100):
+	result = evaluate(model, buckets, batchsize)
+	return result["perplexity"], result["bucket_perplexity"]
 
 def main(args):
-	# load textfile
-	train_dataset, dev_dataset, test_dataset, vocab, vocab_inv = read_data(args.text_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed)
+	# load textfile and split into buckets
+	(train_buckets, dev_buckets, test_buckets), (num_train, num_dev, num_test), vocab, vocab_inv, data_hash = load_buckets(args.text_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed, cache_dir=args.cache_dir)
 	vocab_size = len(vocab)
 	print_bold("data	#")
-	print("train	{}".format(len(train_dataset)))
-	print("dev	{}".format(len(dev_dataset)))
-	print("test	{}".format(len(test_dataset)))
+	print("train	{}".format(num_train))
+	print("dev	{}".format(num_dev))
+	print("test	{}".format(num_test))
 	print("vocab	{}".format(vocab_size))
-
-	# split into buckets
-	train_buckets = make_buckets(train_dataset)
+	print("hash	{}".format(data_hash))
 
 	print_bold("buckets	#data	(train)")
 	if args.buckets_limit is not None:
@@ -211,14 +87,12 @@ def main(args):
 		print("{}	{}".format(size, len(data)))
 
 	print_bold("buckets	#data	(dev)")
-	dev_buckets = make_buckets(dev_dataset)
 	if args.buckets_limit is not None:
 		dev_buckets = dev_buckets[:args.buckets_limit+1]
 	for size, data in zip(bucket_sizes, dev_buckets):
 		print("{}	{}".format(size, len(data)))
 
 	print_bold("buckets	#data	(test)")
-	test_buckets = make_buckets(test_dataset)
 	for size, data in zip(bucket_sizes, test_buckets):
 		print("{}	{}".format(size, len(data)))
 
@@ -230,25 +104,14 @@ def main(args):
 		model.to_gpu()
 
 	# show log
-	def mean(l):
-		return sum(l) / len(l)
 	sys.stdout.write("\r" + stdout.CLEAR)
 	sys.stdout.flush()
-	# print_bold("accuracy (train)")
-	# acc_train = compute_accuracy(model, train_buckets, args.batchsize)
-	# print(mean(acc_train), acc_train)
-	# print_bold("accuracy (dev)")
-	# acc_dev = compute_accuracy(model, dev_buckets, args.batchsize)
-	# print(mean(acc_dev), acc_dev)
-	print_bold("ppl (train)")
-	ppl_train = compute_perplexity(model, train_buckets, args.batchsize)
-	print(mean(ppl_train), ppl_train)
-	print_bold("ppl (dev)")
-	ppl_dev = compute_perplexity(model, dev_buckets, args.batchsize)
-	print(mean(ppl_dev), ppl_dev)
-	print_bold("ppl (test)")
-	ppl_test = compute_perplexity(model, test_buckets, args.batchsize)
-	print(mean(ppl_test), ppl_dev)
+	for name, buckets in [("train", train_buckets), ("dev", dev_buckets), ("test", test_buckets)]:
+		result = evaluate(model, buckets, args.batchsize)
+		print_bold("accuracy ({})".format(name))
+		print(result["accuracy"], result["bucket_accuracy"])
+		print_bold("ppl ({})".format(name))
+		print(result["perplexity"], result["bucket_perplexity"])
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -260,5 +123,6 @@ if __name__ == "__main__":
 	parser.add_argument("--buckets-limit", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	parser.add_argument("--text-filename", "-f", default=None)
+	parser.add_argument("--cache-dir", type=str, default="cache")
 	args = parser.parse_args()
 	main(args)
\ No newline at end of file
@@ -19,42 +19,35 @@ def main(args):
 
 	vocab_size = model.vocab_size
 
+	# all sentences are generated as one batch
+	# tokens are written into a buffer allocated once, lengths[n] is the number of tokens of sentence n
 	# np.random.seed(0)	# debug
-	for n in xrange(args.num_generate):
-		word_ids = np.arange(0, vocab_size, dtype=np.int32)
-		token = ID_BOS
-		x = np.asarray([[token]]).astype(np.int32)
-		model.reset_state()
-		while token != ID_EOS and x.shape[1] < args.max_sentence_length:
-			u = model.forward_one_step(x, test=True)
-			p = F.softmax(u).data[-1]
-			token = np.random.choice(word_ids, size=1, p=p)
-			x = np.append(x, np.asarray([token]).astype(np.int32), axis=1)
-
+	num_generate = args.num_generate
+	x = np.full((num_generate, args.max_sentence_length), ID_EOS, dtype=np.int32)
+	x[:, 0] = ID_BOS
+	lengths = np.ones((num_generate,), dtype=np.int32)
+	finished = np.zeros((num_generate,), dtype=bool)
+	model.reset_state()
+	for t in xrange(1, args.max_sentence_length):
+		u = model.forward_one_step(x[:, t - 1, None], test=True)
+		p = F.softmax(u).data
+		# inverse transform sampling of every row at once
+		cdf = np.cumsum(p, axis=1)
+		r = np.random.uniform(0, 1, size=(num_generate, 1)) * cdf[:, -1, None]
+		tokens = np.minimum((cdf < r).sum(axis=1), vocab_size - 1).astype(np.int32)
+		x[:, t] = np.where(finished, ID_EOS, tokens)
+		lengths += ~finished
+		finished |= tokens == ID_EOS
+		if np.all(finished):
+			break
+
+	for n in xrange(num_generate):
 		sentence = []
-		for token in x[0]:
+		for token in x[n, :lengths[n]]:
 			word = vocab_inv[token]
 			sentence.append(word)
 		print(" ".join(sentence))
 
-	# np.random.seed(0)	# debug
-	# for n in xrange(args.num_generate):
-	# 	word_ids = np.arange(0, vocab_size, dtype=np.int32)
-	# 	token = ID_BOS
-	# 	x = np.asarray([[token]]).astype(np.int32)
-	# 	while token != ID_EOS and x.shape[1] < args.max_sentence_length:
-	# 		model.reset_state()
-	# 		u = model(x, test=True)
-	# 		p = F.softmax(u).data[-1]
-	# 		token = np.random.choice(word_ids, size=1, p=p)
-	# 		x = np.append(x, np.asarray([token]).astype(np.int32), axis=1)
-
-	# 	sentence = []
-	# 	for token in x[0]:
-	# 		word = vocab_inv[token]
-	# 		sentence.append(word)
-	# 	print(" ".join(sentence))
-
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--gpu-device", "-g", type=int, default=0) 
@@ -3,37 +3,36 @@ import chainer.functions as F
 from chainer import Chain, serializers
 sys.path.append(os.path.split(os.getcwd())[0])
 import qrnn as L
+from vocab import Vocabulary
 
 def save_vocab(dirname, vocab, vocab_inv):
-	vocab_filename = dirname + "/vocab.pickle"
-	inv_filename = dirname + "/inv.pickle"
-	
 	try:
 		os.mkdir(dirname)
 	except:
 		pass
 
-	with open(vocab_filename, mode="wb") as f:
-		pickle.dump(vocab, f)
-	
-	with open(inv_filename, mode="wb") as f:
-		pickle.dump(vocab_inv, f)
+	# vocab_inv is derived from vocab
+	Vocabulary.from_dict(vocab).save(dirname + "/vocab")
 
 def load_vocab(dirname):
-	vocab = None
-	vocab_inv = None
+	prefix = dirname + "/vocab"
+	if not Vocabulary.exists(prefix):
+		convert_vocab(dirname)
+	if not Vocabulary.exists(prefix):
+		return None, None
+	vocab = Vocabulary.load(prefix)
+	return vocab, vocab.inv
+
+# converts vocab.pickle written by older versions into the array-backed format
+def convert_vocab(dirname):
 	vocab_filename = dirname + "/vocab.pickle"
-	inv_filename = dirname + "/inv.pickle"
-	
-	if os.path.isfile(vocab_filename):
-		with open(vocab_filename, mode="rb") as f:
-			vocab = pickle.load(f)
-	
-	if os.path.isfile(inv_filename):
-		with open(inv_filename, mode="rb") as f:
-			vocab_inv = pickle.load(f)
-
-	return vocab, vocab_inv
+	if not os.path.isfile(vocab_filename):
+		return False
+	print("converting {} ...".format(vocab_filename))
+	with open(vocab_filename, mode="rb") as f:
+		vocab = pickle.load(f)
+	save_vocab(dirname, vocab, None)
+	return True
 
 def save_model(dirname, qrnn):
 	model_filename = dirname + "/model.hdf5"
@@ -130,7 +129,8 @@ class RNNModel(Chain):
 
 	# we use "dense convolution"
 	# https://arxiv.org/abs/1608.06993
-	def __call__(self, X, test=False, return_last=False):
+	# return_hidden: return the (batchsize * seq_length, ndim_h) inputs of the output layer instead of the logits
+	def __call__(self, X, test=False, return_last=False, return_hidden=False):
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
 		enmbedding = self.embed(X)
@@ -154,6 +154,9 @@ class RNNModel(Chain):
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.ndim_h))
+		if return_hidden:
+			return out_data
+
 		Y = self.dense(out_data)
 
 		if test:
@@ -172,24 +175,16 @@ class RNNModel(Chain):
 			out_data.unchain_backward()
 		return out_data
 
+	# X is the newest token (batchsize, 1), previous inputs are kept by each layer
 	def forward_one_step(self, X, test=False):
-		batchsize = X.shape[0]
-		seq_length = X.shape[1]
-		ksize = self.kernel_size
-
-		if seq_length < ksize:
-			self.reset_state()
-			return self.__call__(X, test=test, return_last=True)
-
-		xt = X[:, -ksize:]
-		enmbedding = self.embed(xt)
+		enmbedding = self.embed(X)
 		enmbedding = F.swapaxes(enmbedding, 1, 2)
 
-		out_data = self._forward_layer_one_step(0, enmbedding, test=test)[:, :, -ksize:]
+		out_data = self._forward_layer_one_step(0, enmbedding, test=test)[:, :, -1, None]
 		in_data = [out_data]
 		
 		for layer_index in xrange(1, self.num_layers):
-			out_data = self._forward_layer_one_step(layer_index, sum(in_data) if self.densely_connected else in_data[-1], test=test)[:, :, -ksize:]	# dense conv
+			out_data = self._forward_layer_one_step(layer_index, sum(in_data) if self.densely_connected else in_data[-1], test=test)[:, :, -1, None]	# dense conv
 			in_data.append(out_data)
 
 		out_data = sum(in_data) if self.densely_connected else out_data	# dense conv
@@ -200,7 +195,6 @@ class RNNModel(Chain):
 		if self.dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 			
-		out_data = out_data[:, :, -1, None]
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.ndim_h))
 		Y = self.dense(out_data)
 
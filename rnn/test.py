@@ -2,12 +2,16 @@
 from __future__ import division
 from __future__ import print_function
 import numpy as np
-import chainer, sys
+import chainer, sys, os, shutil, tempfile
 import chainer.links as L
 import chainer.functions as F
 from chainer import Variable, Chain, cuda
 from model import RNNModel
-from dataset import make_source_target_pair
+import dataset
+from dataset import make_source_target_pair, load_buckets
+from common import bucket_sizes
+from iterator import BucketIterator
+from error import compute_corpus_perplexity, evaluate
 
 def test_rnn():
 	np.random.seed(0)
@@ -26,11 +30,96 @@ def test_rnn():
 	model.reset_state()
 	np.random.seed(0)
 	for t in xrange(source.shape[1]):
-		y = model.forward_one_step(source[:, :t+1], test=True).data
+		y = model.forward_one_step(source[:, t, None], test=True).data
 		target = np.swapaxes(np.reshape(Y, (batchsize, -1, vocab_size)), 1, 2)
 		target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
 		assert np.sum((y - target) ** 2) == 0
 		print("t = {} OK".format(t))
 
+def test_bucket_iterator():
+	num_data = [7, 30, 1, 16]
+	batchsize = 4
+	iterator = BucketIterator(num_data, batchsize, seed=0)
+	for epoch in xrange(3):
+		visited = [[] for _ in num_data]
+		num_batches = 0
+		for bucket_index, indices in iterator.epoch():
+			assert 0 < len(indices) <= batchsize
+			visited[bucket_index].extend(indices.tolist())
+			num_batches += 1
+		assert num_batches == iterator.num_batches_per_epoch
+		for n, indices in zip(num_data, visited):
+			assert sorted(indices) == list(range(n))
+		print("epoch {} OK".format(epoch))
+
+def test_corpus_perplexity():
+	np.random.seed(0)
+	model = RNNModel(6, 4, 2, 4, kernel_size=2, ignore_label=0)
+	buckets = [np.random.randint(1, 6, size=(5, 6)).astype(np.int32), np.random.randint(0, 6, size=(3, 11)).astype(np.int32)]
+	# token-weighted, so the result does not depend on how the data is split into batches
+	ppl, bucket_ppl = compute_corpus_perplexity(model, buckets, batchsize=2)
+	expected_ppl, expected_bucket_ppl = compute_corpus_perplexity(model, buckets, batchsize=100)
+	assert np.allclose(ppl, expected_ppl) and np.allclose(bucket_ppl, expected_bucket_ppl)
+	assert min(bucket_ppl) <= ppl <= max(bucket_ppl)
+	print("corpus perplexity OK")
+
+def test_evaluate():
+	np.random.seed(0)
+	model = RNNModel(6, 4, 2, 4, kernel_size=2, ignore_label=0)
+	batch = np.random.randint(0, 6, size=(4, 9)).astype(np.int32)
+	source, target = make_source_target_pair(batch)
+	model.reset_state()
+	Y = model(source, test=True)
+	result = evaluate(model, [batch], top_k=6)
+	assert np.allclose(result["accuracy"], float(F.accuracy(Y, target, ignore_label=0).data))
+	assert result["num_tokens"] == np.sum(target != 0)
+	assert result["top_k_accuracy"] == 1
+	print("evaluate OK")
+
+def test_load_buckets_cache():
+	directory = tempfile.mkdtemp()
+	filename = os.path.join(directory, "text.txt")
+	with open(filename, "w") as f:
+		for i in xrange(60):
+			f.write(" ".join("w{}".format((i * 7 + j) % 13) for j in xrange(i % 25 + 1)) + "\n")
+	cache_dir = os.path.join(directory, "cache")
+	original_bucket_sizes = list(bucket_sizes)
+	read_data = dataset.read_data
+	def fail(*args, **kwargs):
+		raise AssertionError("cache miss")
+	try:
+		buckets, num_data, vocab, vocab_inv, key = load_buckets(filename, cache_dir=cache_dir)
+		expected_bucket_sizes = list(bucket_sizes)
+
+		# a new process starts from the configured bucket sizes and must not read the text again
+		bucket_sizes[:] = original_bucket_sizes
+		dataset.read_data = fail
+		cached_buckets, cached_num_data, cached_vocab, cached_vocab_inv, cached_key = load_buckets(filename, cache_dir=cache_dir)
+		dataset.read_data = read_data
+		assert cached_key == key and cached_num_data == num_data
+		assert cached_vocab == vocab and cached_vocab_inv == vocab_inv
+		assert bucket_sizes == expected_bucket_sizes
+		for split, cached_split in zip(buckets, cached_buckets):
+			assert len(split) == len(cached_split)
+			for bucket, cached_bucket in zip(split, cached_split):
+				assert np.array_equal(bucket, cached_bucket)
+
+		# the seed and the split ratios are part of the key
+		bucket_sizes[:] = original_bucket_sizes
+		assert load_buckets(filename, seed=1, cache_dir=cache_dir)[4] != key
+		bucket_sizes[:] = original_bucket_sizes
+		assert load_buckets(filename, train_split_ratio=0.8, cache_dir=cache_dir)[4] != key
+		bucket_sizes[:] = original_bucket_sizes
+		assert load_buckets(filename, dev_split_ratio=0.1, cache_dir=cache_dir)[4] != key
+	finally:
+		dataset.read_data = read_data
+		bucket_sizes[:] = original_bucket_sizes
+		shutil.rmtree(directory)
+	print("load buckets cache OK")
+
 if __name__ == "__main__":
 	test_rnn()
+	test_bucket_iterator()
+	test_corpus_perplexity()
+	test_evaluate()
+	test_load_buckets_cache()
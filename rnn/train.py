@@ -10,24 +10,41 @@ from chainer import training, Variable, optimizers, cuda
 from chainer.training import extensions
 sys.path.append(os.path.split(os.getcwd())[0])
 from eve import Eve
+from flat import FlatAdam, FlatEve, update_accumulated
+from parallel import DataParallel, shard
+from async_eval import AsyncEvaluator
+from iterator import BatchPrefetcher, BucketIterator
 from model import RNNModel, load_model, save_model, save_vocab
 from common import ID_UNK, ID_PAD, ID_BOS, ID_EOS, bucket_sizes, stdout, print_bold
-from dataset import read_data, make_buckets, sample_batch_from_bucket, make_source_target_pair
-from error import compute_accuracy, compute_random_accuracy, compute_perplexity, compute_random_perplexity, softmax_cross_entropy
+from dataset import load_buckets, fill_batch
+from error import evaluate
+from loss import softmax_cross_entropy, linear_softmax_cross_entropy
+
+def print_results(result_train, result_dev, top_k=0):
+	print_bold("	accuracy (sampled train)")
+	print("	", result_train["accuracy"], result_train["bucket_accuracy"])
+	print_bold("	accuracy (dev)")
+	print("	", result_dev["accuracy"], result_dev["bucket_accuracy"])
+	if top_k > 0:
+		print_bold("	top-{} accuracy (dev)".format(top_k))
+		print("	", result_dev["top_k_accuracy"], result_dev["bucket_top_k_accuracy"])
+	print_bold("	ppl (sampled train)")
+	print("	", result_train["perplexity"], result_train["bucket_perplexity"])
+	print_bold("	ppl (dev)")
+	print("	", result_dev["perplexity"], result_dev["bucket_perplexity"])	# token-weighted over all buckets
 
 def main(args):
-	# load textfile
-	train_dataset, dev_dataset, test_dataset, vocab, vocab_inv = read_data(args.text_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed)
+	assert args.accumulate >= 1
+	# load textfile and split into buckets
+	(train_buckets, dev_buckets, test_buckets), (num_train, num_dev, num_test), vocab, vocab_inv, data_hash = load_buckets(args.text_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed, cache_dir=args.cache_dir)
 	save_vocab(args.model_dir, vocab, vocab_inv)
 	vocab_size = len(vocab)
-	print_bold("data	#	hash")
-	print("train	{}	{}".format(len(train_dataset), hash(str(train_dataset))))
-	print("dev	{}	{}".format(len(dev_dataset), hash(str(dev_dataset))))
-	print("test	{}	{}".format(len(test_dataset), hash(str(test_dataset))))
+	print_bold("data	#")
+	print("train	{}".format(num_train))
+	print("dev	{}".format(num_dev))
+	print("test	{}".format(num_test))
 	print("vocab	{}".format(vocab_size))
-
-	# split into buckets
-	train_buckets = make_buckets(train_dataset)
+	print("hash	{}".format(data_hash))
 
 	print_bold("buckets	#data	(train)")
 	if args.buckets_limit is not None:
@@ -36,32 +53,33 @@ def main(args):
 		print("{}	{}".format(size, len(data)))
 
 	print_bold("buckets	#data	(dev)")
-	dev_buckets = make_buckets(dev_dataset)
 	if args.buckets_limit is not None:
 		dev_buckets = dev_buckets[:args.buckets_limit+1]
 	for size, data in zip(bucket_sizes, dev_buckets):
 		print("{}	{}".format(size, len(data)))
 
 	print_bold("buckets	#data	(test)")
-	test_buckets = make_buckets(test_dataset)
 	for size, data in zip(bucket_sizes, test_buckets):
 		print("{}	{}".format(size, len(data)))
 
-	# to maintain equilibrium
-	min_num_data = 0
-	for data in train_buckets:
-		if min_num_data == 0 or len(data) < min_num_data:
-			min_num_data = len(data)
-	repeats = []
-	for data in train_buckets:
-		repeat = len(data) // min_num_data
-		repeat = repeat + 1 if repeat == 0 else repeat
-		repeats.append(repeat)
-
-	num_updates_per_iteration = 0
-	for repeat, data in zip(repeats, train_buckets):
-		num_updates_per_iteration += repeat * args.batchsize
-	num_iteration = len(train_dataset) // num_updates_per_iteration + 1
+	# every training sentence is used exactly once per epoch
+	train_iterator = BucketIterator([len(data) for data in train_buckets], args.batchsize, seed=args.seed)
+	num_iteration = train_iterator.num_batches_per_epoch
+
+	def fill_train_batch(buffers, request):
+		bucket_index, indices = request
+		return fill_batch(buffers, train_buckets[bucket_index], indices)
+
+	# one forward pass per batch gives every metric
+	def evaluate_model(model):
+		result_train = evaluate(model, train_buckets, args.batchsize, top_k=args.top_k, num_samples=args.batchsize)
+		result_dev = evaluate(model, dev_buckets, args.batchsize, top_k=args.top_k)
+		return result_train, result_dev
+
+	# the evaluation process has to be forked before cuda is initialized
+	evaluator = None
+	if args.async_eval:
+		evaluator = AsyncEvaluator(evaluate_model, load_model, save_model, gpu_device=args.gpu_device)
 
 	# init
 	model = load_model(args.model_dir)
@@ -72,68 +90,120 @@ def main(args):
 		model.to_gpu()
 
 	# setup an optimizer
-	if args.eve:
-		optimizer = Eve(alpha=args.learning_rate, beta1=0.9)
+	if args.flat:
+		# parameters, gradients and moments in contiguous buffers, clipping and decay fused into the update
+		if args.eve:
+			optimizer = FlatEve(alpha=args.learning_rate, beta1=0.9, grad_clip=args.grad_clip, weight_decay=args.weight_decay)
+		else:
+			optimizer = FlatAdam(alpha=args.learning_rate, beta1=0.9, grad_clip=args.grad_clip, weight_decay=args.weight_decay)
+		optimizer.setup(model)
 	else:
-		optimizer = optimizers.Adam(alpha=args.learning_rate, beta1=0.9)
-	optimizer.setup(model)
-	optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
-	optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
+		if args.eve:
+			optimizer = Eve(alpha=args.learning_rate, beta1=0.9)
+		else:
+			optimizer = optimizers.Adam(alpha=args.learning_rate, beta1=0.9)
+		optimizer.setup(model)
+		optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
+		optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
 	min_learning_rate = 1e-7
 	prev_ppl = None
 	total_time = 0
 
-	def mean(l):
-		return sum(l) / len(l)
+	# mean over the non-PAD tokens of the batch
+	def compute_loss(source, target):
+		model.reset_state()
+		if args.loss_chunk_size > 0:
+			# the full logits matrix is never materialised
+			H = model(source, return_hidden=True)
+			return linear_softmax_cross_entropy(H, model.dense.W, model.dense.b, target, chunk_size=args.loss_chunk_size, ignore_label=ID_PAD)
+		Y = model(source)
+		return softmax_cross_entropy(Y, target, ignore_label=ID_PAD)
+
+	# synchronous data parallel training on cpu, this process is worker 0
+	# every worker takes num_iteration batches per epoch from the same schedule
+	trainer = None
+	if args.workers > 1:
+		assert args.flat and args.gpu_device < 0 and args.accumulate == 1
+		num_iteration = train_iterator.num_batches_per_epoch // args.workers
+		trainer = DataParallel(model, optimizer, args.workers)
+
+		def train_worker(worker_index):
+			for epoch in xrange(1, args.epoch + 1):
+				loader = BatchPrefetcher(shard(train_iterator.epoch(), worker_index, args.workers, num_iteration), fill_train_batch, num_prefetch=args.prefetch)
+				for source, target in loader:
+					trainer.step(lambda: (compute_loss(source, target), int((target != ID_PAD).sum())))
+				loader.close()
+
+		trainer.start(train_worker)
 
 	# training
 	for epoch in xrange(1, args.epoch + 1):
 		print("Epoch", epoch)
 		start_time = time.time()
-		for itr in xrange(1, num_iteration + 1):
+		requests = train_iterator.epoch()
+		if trainer is not None:
+			requests = shard(requests, 0, args.workers, num_iteration)
+		loader = BatchPrefetcher(requests, fill_train_batch, num_prefetch=args.prefetch, device=args.gpu_device if model.xp is cuda.cupy else -1)
+		num_accumulated = 0
+		for itr, (source, target) in enumerate(loader, 1):
 			sys.stdout.write("\r{} / {}".format(itr, num_iteration))
 			sys.stdout.flush()
 
-			for repeat, dataset in zip(repeats, train_buckets):
-				for r in xrange(repeat):
-					batch = sample_batch_from_bucket(dataset, args.batchsize)
-					source, target = make_source_target_pair(batch)
-					if model.xp is cuda.cupy:
-						source = cuda.to_gpu(source)
-						target = cuda.to_gpu(target)
-					model.reset_state()
-					Y = model(source)
-					loss = softmax_cross_entropy(Y, target, ignore_label=ID_PAD)
-					optimizer.update(lossfun=lambda: loss)
-
+			if trainer is not None:
+				trainer.step(lambda: (compute_loss(source, target), int((target != ID_PAD).sum())))
+			elif args.accumulate == 1:
+				loss = compute_loss(source, target)
+				optimizer.update(lossfun=lambda: loss)
+			else:
+				# token-weighted losses are backpropagated right away, the batch buffers are reused by the loader
+				if num_accumulated == 0:
+					model.zerograds()
+					loss_sum, num_tokens = 0, 0
+				n = int((target != ID_PAD).sum())
+				weighted_loss = compute_loss(source, target) * n
+				weighted_loss.backward()
+				loss_sum += weighted_loss.data
+				num_tokens += n
+				num_accumulated += 1
+				del weighted_loss
+				if num_accumulated == args.accumulate or itr == num_iteration:
+					update_accumulated(model, optimizer, float(loss_sum), num_tokens)
+					num_accumulated = 0
 
 			if itr % args.interval == 0 or itr == num_iteration:
 				save_model(args.model_dir, model)
+		loader.close()
 
 		# show log
 		sys.stdout.write("\r" + stdout.CLEAR)
 		sys.stdout.flush()
-		print_bold("	accuracy (sampled train)")
-		acc_train = compute_random_accuracy(model, train_buckets, args.batchsize)
-		print("	", mean(acc_train), acc_train)
-		print_bold("	accuracy (dev)")
-		acc_dev = compute_accuracy(model, dev_buckets, args.batchsize)
-		print("	", mean(acc_dev), acc_dev)
-		print_bold("	ppl (sampled train)")
-		ppl_train = compute_random_perplexity(model, train_buckets, args.batchsize)
-		print("	", mean(ppl_train), ppl_train)
-		print_bold("	ppl (dev)")
-		ppl_dev = compute_perplexity(model, dev_buckets, args.batchsize)
-		ppl_dev_mean = mean(ppl_dev)
-		print("	", ppl_dev_mean, ppl_dev)
+		if evaluator is None:
+			results = [(epoch, evaluate_model(model))]
+		else:
+			# training continues while the snapshot is evaluated
+			evaluator.submit(epoch, model)
+			results = evaluator.poll()
+		for result_epoch, (result_train, result_dev) in results:
+			if evaluator is not None:
+				print_bold("	evaluation of epoch {}".format(result_epoch))
+			print_results(result_train, result_dev, args.top_k)
+
+			# decay learning rate on the latest available result
+			ppl_dev_mean = result_dev["perplexity"]
+			if prev_ppl is not None and ppl_dev_mean >= prev_ppl and optimizer.alpha > min_learning_rate:
+				optimizer.alpha *= 0.5
+			prev_ppl = ppl_dev_mean
 		elapsed_time = (time.time() - start_time) / 60.
 		total_time += elapsed_time
 		print("	done in {} min, lr = {}, total {} min".format(int(elapsed_time), optimizer.alpha, int(total_time)))
 
-		# decay learning rate
-		if prev_ppl is not None and ppl_dev_mean >= prev_ppl and optimizer.alpha > min_learning_rate:
-			optimizer.alpha *= 0.5
-		prev_ppl = ppl_dev_mean
+	if trainer is not None:
+		trainer.join()
+
+	if evaluator is not None:
+		for result_epoch, (result_train, result_dev) in evaluator.close():
+			print_bold("	evaluation of epoch {}".format(result_epoch))
+			print_results(result_train, result_dev, args.top_k)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -150,15 +220,23 @@ if __name__ == "__main__":
 	parser.add_argument("--train-split", type=float, default=0.9)
 	parser.add_argument("--dev-split", type=float, default=0.05)
 	parser.add_argument("--interval", type=int, default=100)
+	parser.add_argument("--prefetch", type=int, default=4)
 	parser.add_argument("--pooling", "-p", type=str, default="fo")
 	parser.add_argument("--wgain", "-w", type=float, default=0.01)
 	parser.add_argument("--learning-rate", "-lr", type=float, default=0.01)
 	parser.add_argument("--buckets-limit", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	parser.add_argument("--text-filename", "-f", default=None)
+	parser.add_argument("--cache-dir", type=str, default="cache")
 	parser.add_argument("--densely-connected", "-dense", default=False, action="store_true")
 	parser.add_argument("--zoneout", "-zoneout", default=False, action="store_true")
 	parser.add_argument("--dropout", "-dropout", default=False, action="store_true")
 	parser.add_argument("--eve", default=False, action="store_true")
+	parser.add_argument("--flat", default=False, action="store_true", help="fused optimizer step over flat parameter buffers")
+	parser.add_argument("--top-k", type=int, default=0, help="also report top-k accuracy on dev if > 0")
+	parser.add_argument("--loss-chunk-size", type=int, default=0, help="compute the output layer and loss this many rows at a time, 0 disables")
+	parser.add_argument("--accumulate", type=int, default=1, help="sum gradients over this many batches per update")
+	parser.add_argument("--workers", type=int, default=1, help="data parallel cpu training with this many processes, requires --flat and -g -1")
+	parser.add_argument("--async-eval", default=False, action="store_true", help="evaluate weight snapshots in a separate process")
 	args = parser.parse_args()
 	main(args)
\ No newline at end of file
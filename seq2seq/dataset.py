@@ -1,6 +1,10 @@
 # coding: utf-8
-import codecs, random
+import codecs, random, sys, os
 import numpy as np
+sys.path.append(os.path.split(os.getcwd())[0])
+from iterator import get_buffer
+from bucket import flatten, assign_buckets, pack
+from cache import hash_file, make_key, load_cache, save_cache
 from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes
 
 def read_data(source_filename, target_filename, train_split_ratio=0.9, dev_split_ratio=0.05, seed=0, reverse=True):
@@ -90,65 +94,89 @@ def read_data(source_filename, target_filename, train_split_ratio=0.9, dev_split
 
 	return (source_train, source_dev, source_test), (target_train, target_dev, target_test), (vocab_source, vocab_target), (vocab_inv_source, vocab_inv_target)
 
+# read_data + make_buckets for every split
+# the result is cached by the content of both files and the preprocessing config
+def load_buckets(source_filename, target_filename, train_split_ratio=0.9, dev_split_ratio=0.05, seed=0, reverse=True, cache_dir=None):
+	key = make_key(hash_file(source_filename), hash_file(target_filename), train_split_ratio, dev_split_ratio, seed, reverse, bucket_sizes)
+	data = None if cache_dir is None else load_cache(cache_dir, key)
+	if data is None:
+		source_dataset, target_dataset, vocab, vocab_inv = read_data(source_filename, target_filename, train_split_ratio=train_split_ratio, dev_split_ratio=dev_split_ratio, seed=seed, reverse=reverse)
+		source_buckets = []
+		target_buckets = []
+		for source, target in zip(source_dataset, target_dataset):
+			buckets_source, buckets_target = make_buckets(source, target)
+			source_buckets.append(buckets_source)
+			target_buckets.append(buckets_target)
+		data = {
+			"num_data": tuple(len(source) for source in source_dataset),
+			"source_buckets": tuple(source_buckets),
+			"target_buckets": tuple(target_buckets),
+			"vocab": vocab,
+			"vocab_inv": vocab_inv,
+		}
+		if cache_dir is not None:
+			save_cache(cache_dir, key, data)
+	return data["source_buckets"], data["target_buckets"], data["num_data"], data["vocab"], data["vocab_inv"], key
+
 # input:
 # [34, 1093, 22504, 16399]
 # [0, 202944, 205277, 144530, 111190, 205428, 186775, 111190, 205601, 58779, 2]
 # output:
 # [-1, -1, -1, -1, -1, -1, 34, 1093, 22504, 16399]
 # [0, 202944, 205277, 144530, 111190, 205428, 186775, 111190, 205601, 58779, 2, -1]
-def make_buckets(source, target):
-	buckets_list_source = [[] for _ in xrange(len(bucket_sizes))]
-	buckets_list_target = [[] for _ in xrange(len(bucket_sizes))]
-	for word_ids_source, word_ids_target in zip(source, target):
-		source_length = len(word_ids_source)
-		target_length = len(word_ids_target)
-		# source
-		bucket_index_source = 0
-		for size in bucket_sizes:
-			if source_length <= size[0]:
-				break
-			bucket_index_source += 1
-		# target
-		bucket_index_target = 0
-		for size in bucket_sizes:
-			if target_length <= size[1]:
-				break
-			bucket_index_target += 1
-
-		bucket_index = max(bucket_index_source, bucket_index_target)
-		if bucket_index >= len(bucket_sizes):
-			continue	# ignore long sequence
-
-		source_size, target_size = bucket_sizes[bucket_index]
-		
-		for _ in xrange(max(source_size - source_length, 0)):
-			word_ids_source.insert(0, ID_PAD)	# prepend
-		assert len(word_ids_source) == source_size
-		
-		for _ in xrange(max(target_size - target_length, 0)):
-			word_ids_target.append(ID_PAD)
-		assert len(word_ids_target) == target_size
-
-		buckets_list_source[bucket_index].append(word_ids_source)
-		buckets_list_target[bucket_index].append(word_ids_target)
+def make_buckets(source, target, return_masks=False):
+	source_tokens, source_lengths, source_offsets = flatten(source)
+	target_tokens, target_lengths, target_offsets = flatten(target)
+	source_sizes = [size[0] for size in bucket_sizes]
+	target_sizes = [size[1] for size in bucket_sizes]
+	bucket_indices = np.maximum(assign_buckets(source_lengths, source_sizes), assign_buckets(target_lengths, target_sizes))	# long sequences get len(bucket_sizes) and are ignored
 
 	buckets_source = []
 	buckets_target = []
-	for bucket_source, bucket_target in zip(buckets_list_source, buckets_list_target):
-		if len(bucket_source) == 0:
+	masks_source = []
+	masks_target = []
+	for bucket_index, (source_size, target_size) in enumerate(bucket_sizes):
+		indices = np.flatnonzero(bucket_indices == bucket_index)
+		if len(indices) == 0:
 			continue
-		buckets_source.append(np.asarray(bucket_source).astype(np.int32))
-		buckets_target.append(np.asarray(bucket_target).astype(np.int32))
+		bucket_source, mask_source = pack(source_tokens, source_lengths, source_offsets, indices, source_size, ID_PAD, left_pad=True)
+		bucket_target, mask_target = pack(target_tokens, target_lengths, target_offsets, indices, target_size, ID_PAD)
+		buckets_source.append(bucket_source)
+		buckets_target.append(bucket_target)
+		masks_source.append(mask_source)
+		masks_target.append(mask_target)
+	if return_masks:
+		return buckets_source, buckets_target, masks_source, masks_target
 	return buckets_source, buckets_target
 
+def sample_indices(bucket_size, num_samples):
+	num_samples = num_samples if bucket_size >= num_samples else bucket_size
+	return np.random.choice(np.arange(bucket_size, dtype=np.int32), size=num_samples, replace=False)
+
 def sample_batch_from_bucket(source_bucket, target_bucket, num_samples):
 	assert len(source_bucket) == len(target_bucket)
-	num_samples = num_samples if len(source_bucket) >= num_samples else len(source_bucket)
-	indices = np.random.choice(np.arange(len(source_bucket), dtype=np.int32), size=num_samples, replace=False)
+	indices = sample_indices(len(source_bucket), num_samples)
 	return source_bucket[indices], target_bucket[indices]
 
 def make_source_target_pair(batch):
 	source = batch[:, :-1]
 	target = batch[:, 1:]
 	target = np.reshape(target, (-1,))
-	return source, target
\ No newline at end of file
+	return source, target
+
+# writes source, skip_mask and the decoder input/output pair of bucket[indices] into reusable buffers
+def fill_batch(buffers, source_bucket, target_bucket, indices):
+	num_samples = len(indices)
+	source_length = source_bucket.shape[1]
+	target_length = target_bucket.shape[1]
+	source_batch = get_buffer(buffers, "source", (num_samples, source_length))
+	np.take(source_bucket, indices, axis=0, out=source_batch)
+	skip_mask = get_buffer(buffers, "skip_mask", (num_samples, source_length), dtype=np.bool_)
+	np.not_equal(source_batch, ID_PAD, out=skip_mask)
+	target_batch = get_buffer(buffers, "target", (num_samples, target_length))
+	np.take(target_bucket, indices, axis=0, out=target_batch)
+	target_batch_input = get_buffer(buffers, "target_input", (num_samples, target_length - 1))
+	target_batch_output = get_buffer(buffers, "target_output", (num_samples * (target_length - 1),))
+	target_batch_input[...] = target_batch[:, :-1]
+	target_batch_output.reshape((num_samples, target_length - 1))[...] = target_batch[:, 1:]
+	return source_batch, skip_mask, target_batch_input, target_batch_output
\ No newline at end of file
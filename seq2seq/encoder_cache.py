@@ -0,0 +1,121 @@
+from __future__ import division
+from six.moves import xrange
+import collections
+import numpy as np
+from chainer import Variable, cuda
+from model import AttentiveSeq2SeqModel
+from common import ID_PAD
+
+# bounded LRU cache of encoder outputs keyed by source token ids
+# each entry keeps the last hidden states of all layers as one (num_layers, ndim_h) array
+# and, for attention models, the last layer outputs of the real tokens (ndim_h, length)
+# arrays are stored in dtype (float16 by default) on the device of the model
+class EncoderCache(object):
+	def __init__(self, capacity, dtype=np.float16):
+		self.capacity = capacity	# bytes
+		self.dtype = dtype
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def make_key(word_ids):
+		return np.asarray(word_ids, dtype=np.int32).tobytes()
+
+	def get(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.entries[key] = entry	# most recently used
+		self.hits += 1
+		return entry
+
+	def put(self, key, hidden_states, layer_outputs=None):
+		xp = cuda.get_array_module(hidden_states)
+		hidden_states = xp.ascontiguousarray(hidden_states, dtype=self.dtype)
+		if layer_outputs is not None:
+			layer_outputs = xp.ascontiguousarray(layer_outputs, dtype=self.dtype)
+		entry = (hidden_states, layer_outputs)
+		nbytes = self._nbytes(entry)
+		if key in self.entries:
+			self._remove(key)
+		if nbytes > self.capacity:
+			return entry
+		while self.size + nbytes > self.capacity:
+			self._remove(next(iter(self.entries)))
+		self.entries[key] = entry
+		self.size += nbytes
+		return entry
+
+	def _nbytes(self, entry):
+		hidden_states, layer_outputs = entry
+		return hidden_states.nbytes + (0 if layer_outputs is None else layer_outputs.nbytes)
+
+	def _remove(self, key):
+		self.size -= self._nbytes(self.entries.pop(key))
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get_stats(self):
+		num_lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / num_lookups if num_lookups > 0 else 0,
+			"entries": len(self.entries),
+			"bytes": self.size,
+		}
+
+# drop-in replacement for model.encode(source_batch, skip_mask, test=True)
+# source_batch must be left-padded; only the sentences that miss the cache are encoded
+# PAD positions of the encoder outputs are zero, so a sentence encodes the same with any amount of padding
+def encode_with_cache(model, source_batch, cache):
+	xp = model.xp
+	attention = isinstance(model, AttentiveSeq2SeqModel)
+	source_batch = cuda.to_cpu(source_batch)
+	batchsize, width = source_batch.shape
+	lengths = (source_batch != ID_PAD).sum(axis=1)
+	keys = [cache.make_key(source_batch[n, width - lengths[n]:]) for n in xrange(batchsize)]
+	entries = [cache.get(key) for key in keys]
+
+	# encode each missing sentence once
+	missing = collections.OrderedDict()
+	for n, entry in enumerate(entries):
+		if entry is None:
+			missing.setdefault(keys[n], n)
+	if len(missing) > 0:
+		rows = list(missing.values())
+		sub_batch = source_batch[rows]
+		skip_mask = sub_batch != ID_PAD
+		if xp is cuda.cupy:
+			sub_batch = cuda.to_gpu(sub_batch)
+			skip_mask = cuda.to_gpu(skip_mask)
+		model.reset_encoder_state()
+		if attention:
+			last_hidden_states, last_layer_outputs = model.encode(sub_batch, skip_mask, test=True)
+		else:
+			last_hidden_states, last_layer_outputs = model.encode(sub_batch, skip_mask, test=True), None
+		hidden_states = xp.stack([h.data for h in last_hidden_states], axis=1)	# (batchsize, num_layers, ndim_h)
+		computed = {}
+		for i, (key, n) in enumerate(missing.items()):
+			layer_outputs = None if last_layer_outputs is None else last_layer_outputs.data[i, :, width - lengths[n]:]
+			computed[key] = cache.put(key, hidden_states[i], layer_outputs)
+		entries = [computed[key] if entry is None else entry for key, entry in zip(keys, entries)]
+
+	hidden_states = xp.stack([entry[0] for entry in entries]).astype(xp.float32)
+	last_hidden_states = [Variable(xp.ascontiguousarray(hidden_states[:, i])) for i in xrange(hidden_states.shape[1])]
+	if not attention:
+		return last_hidden_states
+
+	layer_outputs = xp.zeros((batchsize, hidden_states.shape[2], width), dtype=xp.float32)
+	for n, entry in enumerate(entries):
+		if lengths[n] > 0:
+			layer_outputs[n, :, width - lengths[n]:] = entry[1]
+	return last_hidden_states, Variable(layer_outputs)
@@ -1,90 +1,50 @@
 # coding: utf-8
+from __future__ import division
+from six.moves import xrange
 import argparse, sys
 import numpy as np
-import chainer.functions as F
-import chainer
-from chainer import cuda, functions
-from chainer.utils import type_check
-from chainer.functions.activation import log_softmax
-from model import Seq2SeqModel, AttentiveSeq2SeqModel, load_model
+from chainer import cuda
+from model import Seq2SeqModel, load_model
 from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, stdout, print_bold
-from dataset import read_data, make_buckets, make_source_target_pair, sample_batch_from_bucket
-
-class SoftmaxCrossEntropy(functions.loss.softmax_cross_entropy.SoftmaxCrossEntropy):
-
-	def forward_gpu(self, inputs):
-		cupy = cuda.cupy
-		x, t = inputs
-		if chainer.is_debug():
-			self._check_input_values(x, t)
-
-		log_y = log_softmax._log_softmax(x, self.use_cudnn)
-		if self.cache_score:
-			self.y = cupy.exp(log_y)
-		if self.class_weight is not None:
-			shape = [1 if d != 1 else -1 for d in six.moves.range(x.ndim)]
-			log_y *= cupy.broadcast_to(
-				self.class_weight.reshape(shape), x.shape)
-		if self.normalize:
-			coeff = cupy.maximum(1, (t != self.ignore_label).sum())
-		else:
-			coeff = max(1, len(t))
-		self._coeff = cupy.divide(1.0, coeff, dtype=x.dtype)
-
-		log_y = cupy.rollaxis(log_y, 1, log_y.ndim)
-		ret = cuda.reduce(
-			'S t, raw T log_y, int32 n_channel, raw T coeff, S ignore_label', 'T out',
-			't == ignore_label ? T(0) : log_y[_j * n_channel + t]',
-			'a + b', 'out = a * -coeff[0]', '0', 'crossent_fwd'
-		)(t, log_y.reduced_view(), log_y.shape[-1], self._coeff, self.ignore_label)
-		return ret,
-
-	def backward_gpu(self, inputs, grad_outputs):
-		cupy = cuda.cupy
-		x, t = inputs
-		if hasattr(self, 'y'):
-			y = self.y
-		else:
-			y = log_softmax._log_softmax(x, self.use_cudnn)
-			cupy.exp(y, out=y)
-		gloss = grad_outputs[0]
-		n_unit = t.size // len(t)
-		coeff = gloss * self._coeff
-		if self.class_weight is None:
-			gx = cuda.elementwise(
-				'T y, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
-				'T gx',
-				'''
-					const int c = (i / n_unit % n_channel);
-					gx = (t == ignore_label) ? 0 : (coeff[0] * (y - (c == t)));
-				''',
-				'softmax_crossent_bwd')(
-					y, cupy.expand_dims(t, 1), coeff, x.shape[1], n_unit, self.ignore_label)
-		else:
-			gx = cuda.elementwise(
-				'T y, raw T w, S t, raw T coeff, S n_channel, S n_unit, S ignore_label',
-				'T gx',
-				'''
-					const int c = (i / n_unit % n_channel);
-					gx = t == ignore_label ? 0 : coeff[0] * (y - (c == t)) * w[t];
-				''',
-				'softmax_crossent_bwd')(
-					y, self.class_weight, cupy.expand_dims(t, 1), coeff,
-					x.shape[1], n_unit, self.ignore_label)
-		return gx, None
-
-
-def softmax_cross_entropy(x, t, use_cudnn=True, normalize=True, cache_score=True, class_weight=None, ignore_label=-1):
-	return SoftmaxCrossEntropy(use_cudnn, normalize, cache_score, class_weight, ignore_label)(x, t)
+from dataset import load_buckets, sample_batch_from_bucket
+from translate import translate_batch
 
 # https://github.com/zszyellow/WER-in-python
+# edit distances of a batch of (reference, hypothesis) pairs
+# references: (batchsize, max_reference_length), hypotheses: (batchsize, max_hypothesis_length), int token ids
+# only the first reference_lengths[n] / hypothesis_lengths[n] tokens of row n are used
+# the DP runs row by row over the reference, every row is computed for the whole batch at once:
+# substitutions and deletions are elementwise, insertions are a running minimum along the hypothesis
+def compute_edit_distance_batch(references, reference_lengths, hypotheses, hypothesis_lengths):
+	references = np.asarray(references)
+	hypotheses = np.asarray(hypotheses)
+	reference_lengths = np.asarray(reference_lengths, dtype=np.int32)
+	hypothesis_lengths = np.asarray(hypothesis_lengths, dtype=np.int32)
+	batchsize, max_hypothesis_length = hypotheses.shape
+	rows = np.arange(batchsize)
+	columns = np.arange(max_hypothesis_length + 1, dtype=np.int32)
+
+	d = np.broadcast_to(columns, (batchsize, max_hypothesis_length + 1)).copy()	# distance to the empty reference
+	distance = hypothesis_lengths.copy()
+	for i in xrange(1, int(reference_lengths.max()) + 1 if batchsize > 0 else 1):
+		substitute = d[:, :-1] + (references[:, i - 1, None] != hypotheses)
+		delete = d[:, 1:] + 1
+		# d[i, j] = min(i + j, min_k<=j (min(substitute, delete)[k] - k) + j)
+		d[:, 0] = i
+		d[:, 1:] = np.minimum(substitute, delete) - columns[1:]
+		d = np.minimum.accumulate(d, axis=1) + columns
+		distance = np.where(reference_lengths == i, d[rows, hypothesis_lengths], distance)
+	return distance
+
+def compute_word_error_rate_batch(references, reference_lengths, hypotheses, hypothesis_lengths):
+	distance = compute_edit_distance_batch(references, reference_lengths, hypotheses, hypothesis_lengths)
+	return distance / np.maximum(np.asarray(reference_lengths), 1).astype(np.float64)
+
+# the plain DP over a single pair, slow but obviously correct
 def compute_word_error_rate_of_sequence(r, h):
-	# build the matrix
-	d = np.zeros((len(r) + 1) * (len(h) + 1), dtype=np.uint8).reshape((len(r) + 1, len(h) + 1))
-	for i in xrange(len(r) + 1):
-		for j in xrange(len(h) + 1):
-			if i == 0: d[0][j] = j
-			elif j == 0: d[i][0] = i
+	d = np.zeros((len(r) + 1, len(h) + 1), dtype=np.int32)
+	d[:, 0] = np.arange(len(r) + 1)
+	d[0, :] = np.arange(len(h) + 1)
 	for i in xrange(1, len(r) + 1):
 		for j in xrange(1, len(h) + 1):
 			if r[i-1] == h[j-1]:
@@ -94,87 +54,28 @@ def compute_word_error_rate_of_sequence(r, h):
 				insert = d[i][j-1] + 1
 				delete = d[i-1][j] + 1
 				d[i][j] = min(substitute, insert, delete)
-	return float(d[len(r)][len(h)]) / len(r)
+	return float(d[len(r)][len(h)]) / max(len(r), 1)
+
+# left-aligns the word tokens of each row, stopping at the first <eos> or <pad> and skipping <go>
+# returns (tokens, lengths)
+def _extract_words(batch):
+	batchsize, width = batch.shape
+	stop = (batch == ID_EOS) | (batch == ID_PAD)
+	ends = np.where(np.any(stop, axis=1), np.argmax(stop, axis=1), width)
+	valid = (np.arange(width) < ends[:, None]) & (batch != ID_GO)
+	order = np.argsort(~valid, axis=1, kind="mergesort")
+	return batch[np.arange(batchsize)[:, None], order], valid.sum(axis=1)
 
 def _compute_batch_wer_mean(model, source_batch, target_batch, target_vocab_size, argmax=True):
-	xp = model.xp
-	num_calculation = 0
-	sum_wer = 0
-	skip_mask = source_batch != ID_PAD
-	batchsize = source_batch.shape[0]
 	target_seq_length = target_batch.shape[1]
+	x, lengths = translate_batch(model, source_batch, target_seq_length * 2, argmax=argmax, return_lengths=True)
+	x = cuda.to_cpu(x)
+	lengths = cuda.to_cpu(lengths)
 
-	# to gpu
-	if xp is cuda.cupy:
-		source_batch = cuda.to_gpu(source_batch)
-		target_batch = cuda.to_gpu(target_batch)
-		skip_mask = cuda.to_gpu(skip_mask)
-
-	word_ids = xp.arange(0, target_vocab_size, dtype=xp.int32)
-
-	model.reset_state()
-	token = ID_GO
-	x = xp.asarray([[token]]).astype(xp.int32)
-	x = xp.broadcast_to(x, (batchsize, 1))
-
-	# get encoder's last hidden states
-	if isinstance(model, AttentiveSeq2SeqModel):
-		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source_batch, skip_mask, test=True)
-	else:
-		encoder_last_hidden_states = model.encode(source_batch, skip_mask, test=True)
-
-	while x.shape[1] < target_seq_length * 2:
-		if isinstance(model, AttentiveSeq2SeqModel):
-			u = model.decode_one_step(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask, test=True)
-		else:
-			u = model.decode_one_step(x, encoder_last_hidden_states, test=True)
-		p = F.softmax(u)	# convert to probability
-
-		# concatenate
-		if xp is np:
-			x = xp.append(x, xp.zeros((batchsize, 1), dtype=xp.int32), axis=1)
-		else:
-			x = xp.concatenate((x, xp.zeros((batchsize, 1), dtype=xp.int32)), axis=1)
-
-		for n in xrange(batchsize):
-			pn = p.data[n]
-
-			# argmax or sampling
-			if argmax:
-				token = xp.argmax(pn)
-			else:
-				token = xp.random.choice(word_ids, size=1, p=pn)[0]
-
-			x[n, -1] = token
-
-	for n in xrange(batchsize):
-		target_tokens = []
-		for token in target_batch[n, :]:
-			token = int(token)	# to cpu
-			if token == ID_PAD:
-				break
-			if token == ID_EOS:
-				break
-			if token == ID_GO:
-				continue
-			target_tokens.append(token)
-
-		predict_tokens = []
-		for token in x[n]:
-			token = int(token)	# to cpu
-			if token == ID_EOS:
-				break
-			if token == ID_PAD:
-				break
-			if token == ID_GO:
-				continue
-			predict_tokens.append(token)
-
-		wer = compute_word_error_rate_of_sequence(target_tokens, predict_tokens)
-		sum_wer += wer
-		num_calculation += 1
-
-	return sum_wer / num_calculation
+	target_tokens, target_lengths = _extract_words(cuda.to_cpu(target_batch))
+	predict_tokens, predict_lengths = _extract_words(x[:, :int(lengths.max())])
+	wer = compute_word_error_rate_batch(target_tokens, target_lengths, predict_tokens, predict_lengths)
+	return float(np.mean(wer))
 
 def compute_mean_wer(model, source_buckets, target_buckets, target_vocab_size, batchsize=100, argmax=True):
 	result = []
@@ -223,23 +124,22 @@ def compute_random_mean_wer(model, source_buckets, target_buckets, target_vocab_
 	return result
 
 def main(args):
-	# load textfile
-	source_dataset, target_dataset, vocab, vocab_inv = read_data(args.source_filename, args.target_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed)
+	# load textfile and split into buckets
+	source_buckets, target_buckets, (num_train, num_dev, num_test), vocab, vocab_inv, data_hash = load_buckets(args.source_filename, args.target_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed, cache_dir=args.cache_dir)
 
-	source_dataset_train, source_dataset_dev, source_dataset_test = source_dataset
-	target_dataset_train, target_dataset_dev, target_dataset_test = target_dataset
+	source_buckets_train, source_buckets_dev, source_buckets_test = source_buckets
+	target_buckets_train, target_buckets_dev, target_buckets_test = target_buckets
 	print_bold("data	#")
-	print("train	{}".format(len(source_dataset_train)))
-	print("dev	{}".format(len(source_dataset_dev)))
-	print("test	{}".format(len(source_dataset_test)))
+	print("train	{}".format(num_train))
+	print("dev	{}".format(num_dev))
+	print("test	{}".format(num_test))
+	print("hash	{}".format(data_hash))
 
 	vocab_source, vocab_target = vocab
 	vocab_inv_source, vocab_inv_target = vocab_inv
 	print("vocab	{}	(source)".format(len(vocab_source)))
 	print("vocab	{}	(target)".format(len(vocab_target)))
 
-	# split into buckets
-	source_buckets_train, target_buckets_train = make_buckets(source_dataset_train, target_dataset_train)
 	if args.buckets_limit is not None:
 		source_buckets_train = source_buckets_train[:args.buckets_limit+1]
 		target_buckets_train = target_buckets_train[:args.buckets_limit+1]
@@ -248,7 +148,6 @@ def main(args):
 		print("{} 	{}".format(size, len(data)))
 	print_bold("buckets 	#data	(dev)")
 
-	source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev)
 	if args.buckets_limit is not None:
 		source_buckets_dev = source_buckets_dev[:args.buckets_limit+1]
 		target_buckets_dev = target_buckets_dev[:args.buckets_limit+1]
@@ -256,7 +155,6 @@ def main(args):
 		print("{} 	{}".format(size, len(data)))
 	print_bold("buckets		#data	(test)")
 
-	source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test)
 	if args.buckets_limit is not None:
 		source_buckets_test = source_buckets_test[:args.buckets_limit+1]
 		target_buckets_test = target_buckets_test[:args.buckets_limit+1]
@@ -288,6 +186,7 @@ if __name__ == "__main__":
 	parser.add_argument("--source-filename", "-source", default=None)
 	parser.add_argument("--target-filename", "-target", default=None)
 	parser.add_argument("--buckets-limit", type=int, default=None)
+	parser.add_argument("--cache-dir", type=str, default="cache")
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	parser.add_argument("--seed", type=int, default=0)
 	args = parser.parse_args()
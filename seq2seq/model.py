@@ -1,38 +1,44 @@
 import sys, os, json, pickle
+import numpy as np
 import chainer.functions as F
-from chainer import Chain, serializers
+from chainer import Chain, Variable, serializers
 sys.path.append(os.path.split(os.getcwd())[0])
 import qrnn as L
+from vocab import Vocabulary
 
 def save_vocab(dirname, vocab, vocab_inv):
-	vocab_filename = dirname + "/vocab.pickle"
-	
 	try:
 		os.mkdir(dirname)
 	except:
 		pass
 
-	with open(vocab_filename, mode="wb") as f:
-		source, target = vocab
-		pickle.dump(source, f)
-		pickle.dump(target, f)
-		source, target = vocab_inv
-		pickle.dump(source, f)
-		pickle.dump(target, f)
+	# vocab_inv is derived from vocab
+	source, target = vocab
+	Vocabulary.from_dict(source).save(dirname + "/vocab_source")
+	Vocabulary.from_dict(target).save(dirname + "/vocab_target")
 
 def load_vocab(dirname):
-	vocab_source, vocab_target = None, None
-	vocab_source_inv, vocab_target_inv = None, None
+	source_prefix = dirname + "/vocab_source"
+	target_prefix = dirname + "/vocab_target"
+	if not Vocabulary.exists(source_prefix) or not Vocabulary.exists(target_prefix):
+		convert_vocab(dirname)
+	if not Vocabulary.exists(source_prefix) or not Vocabulary.exists(target_prefix):
+		return (None, None), (None, None)
+	vocab_source = Vocabulary.load(source_prefix)
+	vocab_target = Vocabulary.load(target_prefix)
+	return (vocab_source, vocab_target), (vocab_source.inv, vocab_target.inv)
+
+# converts vocab.pickle written by older versions into the array-backed format
+def convert_vocab(dirname):
 	vocab_filename = dirname + "/vocab.pickle"
-	
-	if os.path.isfile(vocab_filename):
-		with open(vocab_filename, mode="rb") as f:
-			vocab_source = pickle.load(f)
-			vocab_target = pickle.load(f)
-			vocab_source_inv = pickle.load(f)
-			vocab_target_inv = pickle.load(f)
-
-	return (vocab_source, vocab_target), (vocab_source_inv, vocab_target_inv)
+	if not os.path.isfile(vocab_filename):
+		return False
+	print("converting {} ...".format(vocab_filename))
+	with open(vocab_filename, mode="rb") as f:
+		vocab_source = pickle.load(f)
+		vocab_target = pickle.load(f)
+	save_vocab(dirname, (vocab_source, vocab_target), None)
+	return True
 
 def save_model(dirname, model):
 	model_filename = dirname + "/model.hdf5"
@@ -62,7 +68,8 @@ def save_model(dirname, model):
 	with open(param_filename, "w") as f:
 		json.dump(params, f, indent=4, sort_keys=True, separators=(',', ': '))
 
-def load_model(dirname):
+# weights are not read if load_weights is False, e.g. when they are memory-mapped afterwards
+def load_model(dirname, load_weights=True):
 	model_filename = dirname + "/model.hdf5"
 	param_filename = dirname + "/params.json"
 
@@ -76,7 +83,7 @@ def load_model(dirname):
 
 		model = seq2seq(vocab_size_enc=params["vocab_size_enc"], vocab_size_dec=params["vocab_size_dec"], ndim_embedding=params["ndim_embedding"], num_layers=params["num_layers"], ndim_h=params["ndim_h"], pooling=params["pooling"], dropout=params["dropout"], zoneout=params["zoneout"], wgain=params["wgain"], densely_connected=params["densely_connected"], attention=params["attention"])
 
-		if os.path.isfile(model_filename):
+		if load_weights and os.path.isfile(model_filename):
 			print("loading {} ...".format(model_filename))
 			serializers.load_hdf5(model_filename, model)
 
@@ -138,6 +145,13 @@ class Seq2SeqModel(Chain):
 		for i in xrange(self.num_layers):
 			self.get_decoder(i).reset_state()
 
+	# indices: rows of the current decoding batch to keep, rows may be repeated
+	# with zero_fill, -1 inserts a row that has not been decoded yet
+	def reorder_decoder_state(self, indices, zero_fill=False):
+		indices = self.xp.asarray(indices, dtype=np.int32)
+		for i in xrange(self.num_layers):
+			self.get_decoder(i).reorder_state(indices, zero_fill)
+
 	def _forward_encoder_layer(self, layer_index, in_data, skip_mask=None, test=False):
 		if test:
 			in_data.unchain_backward()
@@ -188,7 +202,8 @@ class Seq2SeqModel(Chain):
 
 		return last_hidden_states
 
-	def decode(self, X, encoder_last_hidden_states, test=False, return_last=False):
+	# return_hidden: return the (batchsize * seq_length, ndim_h) inputs of the output layer instead of the logits
+	def decode(self, X, encoder_last_hidden_states, test=False, return_last=False, return_hidden=False):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
@@ -212,6 +227,9 @@ class Seq2SeqModel(Chain):
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.ndim_h))
+		if return_hidden:
+			return out_data
+
 		Y = self.dense(out_data)
 
 		if test:
@@ -230,13 +248,14 @@ class Seq2SeqModel(Chain):
 			out_data.unchain_backward()
 		return out_data
 
-	def decode_one_step(self, X, encoder_last_hidden_states, test=False):
+	# X is the newest token (batchsize, 1)
+	# output_weights: (W, b) from select_output_weights, Y then has one column per candidate
+	def decode_one_step(self, X, encoder_last_hidden_states, test=False, output_weights=None):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
 
-		xt = X[:, -1, None]
-		enmbedding = self.decoder_embed(xt)
+		enmbedding = self.decoder_embed(X)
 		enmbedding = F.swapaxes(enmbedding, 1, 2)
 
 		out_data = self._forward_decoder_layer_one_step(0, enmbedding, encoder_last_hidden_states[0], test=test)
@@ -253,13 +272,22 @@ class Seq2SeqModel(Chain):
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.ndim_h))
-		Y = self.dense(out_data)
+		Y = self._project(out_data, output_weights)
 
 		if test:
 			Y.unchain_backward()
 
 		return Y
 
+	# rows of dense.W and dense.b for the candidate target ids, gathered once per batch
+	def select_output_weights(self, ids):
+		return Variable(self.dense.W.data[ids]), Variable(self.dense.b.data[ids])
+
+	def _project(self, out_data, output_weights=None):
+		if output_weights is None:
+			return self.dense(out_data)
+		return F.linear(out_data, *output_weights)
+
 class AttentiveSeq2SeqModel(Chain):
 	def __init__(self, vocab_size_enc, vocab_size_dec, ndim_embedding, num_layers, ndim_h, pooling="fo", dropout=False, zoneout=False, wgain=1, densely_connected=False):
 		super(AttentiveSeq2SeqModel, self).__init__(
@@ -313,6 +341,13 @@ class AttentiveSeq2SeqModel(Chain):
 		for i in xrange(self.num_layers):
 			self.get_decoder(i).reset_state()
 
+	# indices: rows of the current decoding batch to keep, rows may be repeated
+	# with zero_fill, -1 inserts a row that has not been decoded yet
+	def reorder_decoder_state(self, indices, zero_fill=False):
+		indices = self.xp.asarray(indices, dtype=np.int32)
+		for i in xrange(self.num_layers):
+			self.get_decoder(i).reorder_state(indices, zero_fill)
+
 	def _forward_encoder_layer(self, layer_index, in_data, skip_mask=None, test=False):
 		if test:
 			in_data.unchain_backward()
@@ -367,7 +402,8 @@ class AttentiveSeq2SeqModel(Chain):
 
 		return out_data
 
-	def decode(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None, test=False, return_last=False):
+	# return_hidden: return the (batchsize * seq_length, ndim_h) inputs of the output layer instead of the logits
+	def decode(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None, test=False, return_last=False, return_hidden=False):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
@@ -390,6 +426,9 @@ class AttentiveSeq2SeqModel(Chain):
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.ndim_h))
+		if return_hidden:
+			return out_data
+
 		Y = self.dense(out_data)
 
 		if test:
@@ -416,13 +455,14 @@ class AttentiveSeq2SeqModel(Chain):
 
 		return out_data
 
-	def decode_one_step(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None, test=False):
+	# X is the newest token (batchsize, 1)
+	# output_weights: (W, b) from select_output_weights, Y then has one column per candidate
+	def decode_one_step(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None, test=False, output_weights=None):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
 
-		xt = X[:, -1, None]
-		enmbedding = self.decoder_embed(xt)
+		enmbedding = self.decoder_embed(X)
 		enmbedding = F.swapaxes(enmbedding, 1, 2)
 
 		out_data = self._forward_decoder_layer_one_step(0, enmbedding, encoder_last_hidden_states[0], encoder_last_layer_outputs, encoder_skip_mask, test=test)
@@ -439,9 +479,18 @@ class AttentiveSeq2SeqModel(Chain):
 			out_data = F.dropout(out_data, ratio=self.dropout_ratio, train=not test)
 
 		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (batchsize, self.ndim_h))
-		Y = self.dense(out_data)
+		Y = self._project(out_data, output_weights)
 
 		if test:
 			Y.unchain_backward()
 
 		return Y
+
+	# rows of dense.W and dense.b for the candidate target ids, gathered once per batch
+	def select_output_weights(self, ids):
+		return Variable(self.dense.W.data[ids]), Variable(self.dense.b.data[ids])
+
+	def _project(self, out_data, output_weights=None):
+		if output_weights is None:
+			return self.dense(out_data)
+		return F.linear(out_data, *output_weights)
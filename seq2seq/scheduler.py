@@ -0,0 +1,268 @@
+# coding: utf-8
+from __future__ import division
+from __future__ import print_function
+from six.moves import xrange
+import argparse, sys, os, time, collections
+import numpy as np
+import chainer.functions as F
+from chainer import Variable, cuda
+sys.path.append(os.path.split(os.getcwd())[0])
+from model import load_model, load_vocab, AttentiveSeq2SeqModel
+from common import ID_PAD, ID_GO, ID_EOS, print_bold
+from translate import read_data, select_tokens, translate_batch
+
+class DecodeRequest(object):
+	def __init__(self, word_ids, max_predict_length):
+		self.word_ids = word_ids
+		self.max_predict_length = max_predict_length
+		self.tokens = np.full((max_predict_length,), ID_PAD, dtype=np.int32)
+		self.tokens[0] = ID_GO
+		self.length = 1		# number of tokens written including <go>
+		self.arrival_time = time.time()
+		self.finish_time = None
+
+	@property
+	def finished(self):
+		return self.finish_time is not None
+
+	# translation without <go> and <eos>
+	def get_translation(self):
+		tokens = self.tokens[1:self.length]
+		if len(tokens) > 0 and tokens[-1] == ID_EOS:
+			tokens = tokens[:-1]
+		return tokens
+
+# left-pads or trims the last axis to width (columns on the left are PAD)
+def _fit_width(data, width):
+	xp = cuda.get_array_module(data)
+	if data.shape[-1] >= width:
+		return data[..., data.shape[-1] - width:]
+	padding = xp.zeros(data.shape[:-1] + (width - data.shape[-1],), dtype=data.dtype)
+	return xp.concatenate((padding, data), axis=-1)
+
+def _splice_rows(old, keep, new):
+	xp = cuda.get_array_module(new)
+	if old is None:
+		return new
+	return xp.concatenate((xp.take(old, keep, axis=0), new), axis=0)
+
+# continuous batching
+# finished rows are evicted from the decoding batch and queued requests are encoded and inserted
+# into the free rows between two decoding steps, so short sentences do not wait for long ones
+# inserted rows start from zero decoder state, which equals a fresh decoder for f and fo pooling
+class ContinuousBatchScheduler(object):
+	def __init__(self, model, max_batchsize=64, argmax=True, max_length_ratio=2, trim_interval=32):
+		assert len(model.pooling) < 3, "ifo pooling does not start from zero state"
+		self.model = model
+		self.max_batchsize = max_batchsize
+		self.argmax = argmax
+		self.max_length_ratio = max_length_ratio
+		self.trim_interval = trim_interval	# the decoder keeps appending to H, trim it at least this often
+		self.attention = isinstance(model, AttentiveSeq2SeqModel)
+		self.pending = collections.deque()
+		self.active = []	# request decoded by each row of the batch
+		self.keep = None	# rows that survived the last step if some row finished
+		self.tokens = None	# last token of each row
+		self.encoder_last_hidden_states = None
+		self.encoder_last_layer_outputs = None
+		self.skip_mask = None
+		self.memory_lengths = np.zeros((0,), dtype=np.int32)	# source length of each row
+		self.steps_since_reorder = 0
+		model.reset_state()
+
+	def submit(self, word_ids):
+		request = DecodeRequest(word_ids, max(len(word_ids), 1) * self.max_length_ratio + 1)
+		self.pending.append(request)
+		return request
+
+	@property
+	def num_active(self):
+		return len(self.active)
+
+	@property
+	def idle(self):
+		return len(self.active) == 0 and len(self.pending) == 0
+
+	def _encode(self, requests):
+		xp = self.model.xp
+		width = max(max(len(request.word_ids) for request in requests), 1)
+		source_batch = np.full((len(requests), width), ID_PAD, dtype=np.int32)
+		for n, request in enumerate(requests):
+			if len(request.word_ids) > 0:
+				source_batch[n, -len(request.word_ids):] = request.word_ids	# left padding
+		skip_mask = source_batch != ID_PAD
+		if xp is cuda.cupy:
+			source_batch = cuda.to_gpu(source_batch)
+			skip_mask = cuda.to_gpu(skip_mask)
+
+		# the decoder state of the running batch is kept
+		self.model.reset_encoder_state()
+		if self.attention:
+			encoder_last_hidden_states, encoder_last_layer_outputs = self.model.encode(source_batch, skip_mask, test=True)
+			return encoder_last_hidden_states, encoder_last_layer_outputs.data, skip_mask
+		return self.model.encode(source_batch, skip_mask, test=True), None, None
+
+	# evicts finished rows and appends rows for new requests with one gather per state
+	def _splice(self, new_requests):
+		xp = self.model.xp
+		keep = self.keep if self.keep is not None else np.arange(len(self.active), dtype=np.int32)
+		indices = np.concatenate((keep, np.full((len(new_requests),), -1, dtype=np.int32)))
+		self.model.reorder_decoder_state(indices, zero_fill=len(new_requests) > 0)
+		self.steps_since_reorder = 0
+		self.active = [self.active[i] for i in keep]
+		self.memory_lengths = self.memory_lengths[keep]
+		keep = xp.asarray(keep)
+
+		if len(new_requests) == 0:
+			self.tokens = xp.take(self.tokens, keep)
+			self.encoder_last_hidden_states = [Variable(xp.take(h.data, keep, axis=0)) for h in self.encoder_last_hidden_states]
+			if self.attention:
+				width = max(int(self.memory_lengths.max()) if len(self.memory_lengths) > 0 else 1, 1)
+				self.encoder_last_layer_outputs = _fit_width(xp.take(self.encoder_last_layer_outputs, keep, axis=0), width)
+				self.skip_mask = _fit_width(xp.take(self.skip_mask, keep, axis=0), width)
+			return
+
+		encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask = self._encode(new_requests)
+		go = xp.full((len(new_requests),), ID_GO, dtype=xp.int32)
+		self.tokens = _splice_rows(self.tokens, keep, go)
+		if self.encoder_last_hidden_states is None:
+			self.encoder_last_hidden_states = encoder_last_hidden_states
+		else:
+			self.encoder_last_hidden_states = [Variable(_splice_rows(old.data, keep, new.data)) for old, new in zip(self.encoder_last_hidden_states, encoder_last_hidden_states)]
+		self.active += new_requests
+		self.memory_lengths = np.concatenate((self.memory_lengths, [len(request.word_ids) for request in new_requests])).astype(np.int32)
+
+		if self.attention:
+			# memories are left-padded, so rows of different lengths line up on the right
+			width = max(int(self.memory_lengths.max()), 1)
+			if self.encoder_last_layer_outputs is None:
+				self.encoder_last_layer_outputs = _fit_width(encoder_last_layer_outputs, width)
+				self.skip_mask = _fit_width(skip_mask, width)
+			else:
+				self.encoder_last_layer_outputs = _splice_rows(_fit_width(self.encoder_last_layer_outputs, width), keep, _fit_width(encoder_last_layer_outputs, width))
+				self.skip_mask = _splice_rows(_fit_width(self.skip_mask, width), keep, _fit_width(skip_mask, width))
+
+	# runs one decoding step and returns the requests that finished
+	def step(self):
+		num_free = self.max_batchsize - (len(self.active) if self.keep is None else len(self.keep))
+		new_requests = [self.pending.popleft() for _ in xrange(min(num_free, len(self.pending)))]
+		if self.keep is not None or len(new_requests) > 0 or self.steps_since_reorder >= self.trim_interval:
+			self._splice(new_requests)
+			self.keep = None
+		if len(self.active) == 0:
+			return []
+
+		x = self.tokens[:, None]
+		if self.attention:
+			u = self.model.decode_one_step(x, self.encoder_last_hidden_states, Variable(self.encoder_last_layer_outputs), self.skip_mask, test=True)
+		else:
+			u = self.model.decode_one_step(x, self.encoder_last_hidden_states, test=True)
+		self.tokens = select_tokens(F.softmax(u).data, argmax=self.argmax)
+		self.steps_since_reorder += 1
+
+		tokens = cuda.to_cpu(self.tokens)
+		now = time.time()
+		finished = []
+		for n, request in enumerate(self.active):
+			request.tokens[request.length] = tokens[n]
+			request.length += 1
+			if tokens[n] == ID_EOS or request.length == request.max_predict_length:
+				request.finish_time = now
+				finished.append(request)
+		if len(finished) > 0:
+			self.keep = np.asarray([n for n, request in enumerate(self.active) if not request.finished], dtype=np.int32)
+		return finished
+
+	def translate(self, sources):
+		requests = [self.submit(word_ids) for word_ids in sources]
+		while not self.idle:
+			self.step()
+		return [request.get_translation() for request in requests]
+
+def _percentiles(latencies):
+	latencies = np.asarray(latencies) * 1000
+	return "p50 {:.1f}ms	p90 {:.1f}ms	p99 {:.1f}ms".format(*np.percentile(latencies, [50, 90, 99]))
+
+# requests arrive at arrival_times (seconds from the start)
+# static batching takes up to batchsize arrived requests and decodes them until the longest finishes
+def benchmark_static(model, sources, arrival_times, batchsize):
+	latencies = []
+	start = time.time()
+	next_request = 0
+	num_tokens = 0
+	while next_request < len(sources):
+		now = time.time() - start
+		if arrival_times[next_request] > now:
+			time.sleep(arrival_times[next_request] - now)
+			now = arrival_times[next_request]
+		end = next_request
+		while end < len(sources) and end - next_request < batchsize and arrival_times[end] <= now:
+			end += 1
+		batch = sources[next_request:end]
+		width = max(max(len(word_ids) for word_ids in batch), 1)
+		source_batch = np.full((len(batch), width), ID_PAD, dtype=np.int32)
+		for n, word_ids in enumerate(batch):
+			if len(word_ids) > 0:
+				source_batch[n, -len(word_ids):] = word_ids
+		_, lengths = translate_batch(model, source_batch, width * 2 + 1, return_lengths=True)
+		num_tokens += int(cuda.to_cpu(lengths).sum()) - len(batch)
+		finish_time = time.time() - start
+		latencies += [finish_time - arrival_times[n] for n in xrange(next_request, end)]
+		next_request = end
+	return time.time() - start, num_tokens, latencies
+
+def benchmark_continuous(model, sources, arrival_times, batchsize):
+	scheduler = ContinuousBatchScheduler(model, max_batchsize=batchsize)
+	latencies = []
+	start = time.time()
+	next_request = 0
+	num_tokens = 0
+	while next_request < len(sources) or not scheduler.idle:
+		now = time.time() - start
+		if scheduler.idle and arrival_times[next_request] > now:
+			time.sleep(arrival_times[next_request] - now)
+			now = arrival_times[next_request]
+		while next_request < len(sources) and arrival_times[next_request] <= now:
+			request = scheduler.submit(sources[next_request])
+			request.arrival_time = start + arrival_times[next_request]
+			next_request += 1
+		for request in scheduler.step():
+			latencies.append(request.finish_time - request.arrival_time)
+			num_tokens += request.length - 1
+	return time.time() - start, num_tokens, latencies
+
+def main(args):
+	vocab, vocab_inv = load_vocab(args.model_dir)
+	vocab_source, vocab_target = vocab
+	sources = read_data(args.source_filename, vocab_source)
+	if args.num_requests is not None:
+		sources = sources[:args.num_requests]
+
+	model = load_model(args.model_dir)
+	assert model is not None
+	if args.gpu_device >= 0:
+		cuda.get_device(args.gpu_device).use()
+		model.to_gpu()
+
+	# poisson arrivals, everything arrives at once if rate is 0
+	rng = np.random.RandomState(0)
+	if args.rate > 0:
+		arrival_times = np.cumsum(rng.exponential(1. / args.rate, size=len(sources)))
+	else:
+		arrival_times = np.zeros((len(sources),))
+
+	for name, benchmark in [("static", benchmark_static), ("continuous", benchmark_continuous)]:
+		elapsed, num_tokens, latencies = benchmark(model, sources, arrival_times, args.batchsize)
+		print_bold(name)
+		print("{:.1f} sentences/sec	{:.1f} tokens/sec	{}".format(len(sources) / elapsed, num_tokens / elapsed, _percentiles(latencies)))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--gpu-device", "-g", type=int, default=0)
+	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--source-filename", "-source", default=None)
+	parser.add_argument("--batchsize", "-b", type=int, default=64)
+	parser.add_argument("--num-requests", "-n", type=int, default=None)
+	parser.add_argument("--rate", type=float, default=0, help="requests per second")
+	args = parser.parse_args()
+	main(args)
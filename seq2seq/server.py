@@ -0,0 +1,253 @@
+# coding: utf-8
+from __future__ import division
+from __future__ import print_function
+import six
+from six.moves import xrange, BaseHTTPServer, socketserver
+import argparse, sys, os, json, time, threading, collections
+import numpy as np
+from chainer import cuda
+sys.path.append(os.path.split(os.getcwd())[0])
+from model import load_model, load_vocab
+from common import ID_UNK, ID_PAD, ID_EOS, bucket_sizes, print_bold
+from translate import translate_batch
+from bucket import assign_buckets
+from encoder_cache import EncoderCache
+
+class Request(object):
+	def __init__(self, word_ids, bucket_index):
+		self.word_ids = word_ids
+		self.bucket_index = bucket_index
+		self.arrival_time = time.time()
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	def wait(self):
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.result
+
+# collects requests into batches of the same source length bucket
+# a bucket is dispatched when it has max_batchsize requests or its oldest request waited max_wait seconds
+# run_batch(bucket_index, list of word_ids) -> list of results, always called from the batching thread
+# the current cuda device is per thread, gpu_device is made current in the batching thread
+class DynamicBatcher(object):
+	def __init__(self, run_batch, num_buckets, max_batchsize=64, max_wait=0.01, num_latencies=10000, gpu_device=-1):
+		self.run_batch = run_batch
+		self.gpu_device = gpu_device
+		self.max_batchsize = max_batchsize
+		self.max_wait = max_wait
+		self.queues = [collections.deque() for _ in xrange(num_buckets)]
+		self.latencies = collections.deque(maxlen=num_latencies)
+		self.batchsizes = collections.deque(maxlen=num_latencies)
+		self._condition = threading.Condition()
+		self._stopped = False
+		self._thread = threading.Thread(target=self._loop)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def submit(self, word_ids, bucket_index):
+		request = Request(word_ids, bucket_index)
+		with self._condition:
+			self.queues[bucket_index].append(request)
+			if len(self.queues[bucket_index]) >= self.max_batchsize:
+				self._condition.notify()
+			elif len(self.queues[bucket_index]) == 1:
+				self._condition.notify()	# new deadline
+		return request
+
+	def translate(self, word_ids, bucket_index):
+		return self.submit(word_ids, bucket_index).wait()
+
+	# returns the bucket to dispatch and the time to sleep if there is none
+	def _next_bucket(self):
+		now = time.time()
+		oldest_bucket, oldest_time = None, None
+		for bucket_index, queue in enumerate(self.queues):
+			if len(queue) == 0:
+				continue
+			if len(queue) >= self.max_batchsize:
+				return bucket_index, None
+			if oldest_time is None or queue[0].arrival_time < oldest_time:
+				oldest_bucket, oldest_time = bucket_index, queue[0].arrival_time
+		if oldest_bucket is None:
+			return None, None
+		timeout = oldest_time + self.max_wait - now
+		if timeout <= 0:
+			return oldest_bucket, None
+		return None, timeout
+
+	def _loop(self):
+		if self.gpu_device >= 0:
+			cuda.get_device(self.gpu_device).use()
+		while True:
+			with self._condition:
+				while True:
+					if self._stopped:
+						return
+					bucket_index, timeout = self._next_bucket()
+					if bucket_index is not None:
+						break
+					self._condition.wait(timeout)
+				queue = self.queues[bucket_index]
+				batch = [queue.popleft() for _ in xrange(min(len(queue), self.max_batchsize))]
+
+			try:
+				results = self.run_batch(bucket_index, [request.word_ids for request in batch])
+				for request, result in zip(batch, results):
+					request.result = result
+			except Exception as e:
+				for request in batch:
+					request.error = e
+
+			now = time.time()
+			for request in batch:
+				self.latencies.append(now - request.arrival_time)
+				request.done.set()
+			self.batchsizes.append(len(batch))
+
+	# latencies in milliseconds
+	def get_stats(self, percentiles=(50, 90, 95, 99)):
+		latencies = np.asarray(list(self.latencies)) * 1000
+		batchsizes = np.asarray(list(self.batchsizes))
+		stats = {
+			"num_requests": len(latencies),
+			"num_batches": len(batchsizes),
+			"mean_batchsize": float(batchsizes.mean()) if len(batchsizes) > 0 else 0,
+		}
+		for q in percentiles:
+			stats["p{}".format(q)] = float(np.percentile(latencies, q)) if len(latencies) > 0 else 0
+		return stats
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+		self._thread.join()
+
+class Translator(object):
+	def __init__(self, model, vocab_source, vocab_inv_target, reverse=True, encoder_cache=None):
+		self.model = model
+		self.encoder_cache = encoder_cache
+		self.vocab_source = vocab_source
+		self.vocab_inv_target = vocab_inv_target
+		self.reverse = reverse
+		self.source_lengths = [size[0] for size in bucket_sizes]
+
+	# returns (word_ids, bucket_index), bucket_index is len(bucket_sizes) if the sentence is too long
+	def encode_sentence(self, sentence):
+		word_ids = [self.vocab_source.get(word, ID_UNK) for word in sentence.strip().split(" ") if len(word) > 0]
+		if self.reverse:
+			word_ids.reverse()
+		bucket_index = int(assign_buckets(np.asarray([len(word_ids)]), self.source_lengths)[0])
+		return word_ids, bucket_index
+
+	def __call__(self, bucket_index, batch):
+		width = self.source_lengths[bucket_index]
+		source_batch = np.full((len(batch), width), ID_PAD, dtype=np.int32)
+		for n, word_ids in enumerate(batch):
+			if len(word_ids) > 0:
+				source_batch[n, -len(word_ids):] = word_ids		# left padding
+		translation_batch, lengths = translate_batch(self.model, source_batch, width * 2, return_lengths=True, encoder_cache=self.encoder_cache)
+		translation_batch = cuda.to_cpu(translation_batch)
+		lengths = cuda.to_cpu(lengths)
+
+		results = []
+		for n in xrange(len(batch)):
+			sentence = []
+			for token in translation_batch[n, 1:lengths[n]]:
+				token = int(token)
+				if token == ID_EOS:
+					break
+				sentence.append(self.vocab_inv_target[token])
+			results.append(" ".join(sentence))
+		return results
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def _send_json(self, code, data):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# GET /stats
+	def do_GET(self):
+		if self.path != "/stats":
+			return self._send_json(404, {"error": "not found"})
+		stats = self.server.batcher.get_stats()
+		if self.server.translator.encoder_cache is not None:
+			stats["encoder_cache"] = self.server.translator.encoder_cache.get_stats()
+		self._send_json(200, stats)
+
+	# POST /translate {"source": "..."} -> {"translation": "..."}
+	def do_POST(self):
+		if self.path != "/translate":
+			return self._send_json(404, {"error": "not found"})
+		try:
+			length = int(self.headers.get("Content-Length", 0))
+			source = json.loads(self.rfile.read(length).decode("utf-8"))["source"]
+			if not isinstance(source, six.string_types):
+				raise ValueError("source must be a string")
+		except Exception as e:
+			return self._send_json(400, {"error": "invalid request"})
+		word_ids, bucket_index = self.server.translator.encode_sentence(source)
+		if bucket_index >= len(bucket_sizes):
+			return self._send_json(400, {"error": "source is too long"})
+		try:
+			translation = self.server.batcher.translate(word_ids, bucket_index)
+		except Exception as e:
+			return self._send_json(500, {"error": str(e)})
+		self._send_json(200, {"translation": translation})
+
+	def log_message(self, format, *args):
+		pass
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, translator, batcher):
+		BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+		self.translator = translator
+		self.batcher = batcher
+
+def main(args):
+	# load vocab
+	vocab, vocab_inv = load_vocab(args.model_dir)
+	vocab_source, vocab_target = vocab
+	vocab_inv_source, vocab_inv_target = vocab_inv
+
+	# the model is loaded once and only used by the batching thread
+	model = load_model(args.model_dir)
+	assert model is not None
+	if args.gpu_device >= 0:
+		cuda.get_device(args.gpu_device).use()
+		model.to_gpu()
+
+	encoder_cache = EncoderCache(int(args.encoder_cache_mb * 1024 * 1024)) if args.encoder_cache_mb > 0 else None
+	translator = Translator(model, vocab_source, vocab_inv_target, encoder_cache=encoder_cache)
+	batcher = DynamicBatcher(translator, len(bucket_sizes), max_batchsize=args.max_batchsize, max_wait=args.max_wait / 1000, gpu_device=args.gpu_device)
+	server = Server((args.host, args.port), translator, batcher)
+	print_bold("listening on {}:{}".format(args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	batcher.stop()
+	print(batcher.get_stats())
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--gpu-device", "-g", type=int, default=0)
+	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--host", type=str, default="127.0.0.1")
+	parser.add_argument("--port", "-p", type=int, default=8080)
+	parser.add_argument("--max-batchsize", "-b", type=int, default=64)
+	parser.add_argument("--max-wait", type=float, default=10, help="milliseconds")
+	parser.add_argument("--encoder-cache-mb", type=float, default=0, help="0 disables the encoder cache")
+	args = parser.parse_args()
+	main(args)
@@ -0,0 +1,117 @@
+# coding: utf-8
+from __future__ import division
+from __future__ import print_function
+from six.moves import xrange
+import argparse, sys, os, codecs
+import numpy as np
+from chainer import cuda
+sys.path.append(os.path.split(os.getcwd())[0])
+from model import load_vocab
+from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, print_bold
+
+# candidate target vocabulary for decoding
+# frequent:	target ids that are always candidates
+# table:	(vocab_size_source, num_translations) likely translations of each source id, -1 for none
+class Shortlist(object):
+	def __init__(self, frequent, table):
+		self.frequent = np.asarray(frequent, dtype=np.int32)
+		self.table = np.asarray(table, dtype=np.int32)
+
+	# source_dataset and target_dataset are lists of word id lists
+	# translations are ranked by the dice coefficient of sentence-level co-occurrence
+	@classmethod
+	def build(cls, source_dataset, target_dataset, vocab_size_source, vocab_size_target, num_frequent=1000, num_translations=20, chunk_size=10000):
+		source_counts = np.zeros((vocab_size_source,), dtype=np.int64)
+		target_counts = np.zeros((vocab_size_target,), dtype=np.int64)
+		pair_keys = []
+		pair_counts = []
+		for start in xrange(0, len(source_dataset), chunk_size):
+			keys = []
+			for source, target in zip(source_dataset[start:start + chunk_size], target_dataset[start:start + chunk_size]):
+				source = np.unique(np.asarray(source, dtype=np.int64))
+				target = np.unique(np.asarray(target, dtype=np.int64))
+				source_counts[source] += 1
+				target_counts[target] += 1
+				keys.append((source[:, None] * vocab_size_target + target[None, :]).ravel())
+			if len(keys) > 0:
+				keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+				pair_keys.append(keys)
+				pair_counts.append(counts)
+
+		# special tokens occur in every sentence, <unk> and <eos> are always candidates
+		target_counts[:ID_GO + 1] = 0
+		frequent = np.argsort(-target_counts, kind="mergesort")[:num_frequent]
+		frequent = np.union1d(frequent[target_counts[frequent] > 0], [ID_UNK, ID_EOS])
+		table = np.full((vocab_size_source, num_translations), -1, dtype=np.int32)
+		if len(pair_keys) == 0:
+			return cls(frequent, table)
+
+		# merge the counts of all chunks
+		keys = np.concatenate(pair_keys)
+		counts = np.concatenate(pair_counts)
+		order = np.argsort(keys, kind="mergesort")
+		keys, counts = keys[order], counts[order]
+		starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+		keys, counts = keys[starts], np.add.reduceat(counts, starts)
+
+		source_ids = keys // vocab_size_target
+		target_ids = keys % vocab_size_target
+		words = (target_ids > ID_GO) & (source_ids > ID_UNK)
+		source_ids, target_ids, counts = source_ids[words], target_ids[words], counts[words]
+		scores = 2 * counts / (source_counts[source_ids] + target_counts[target_ids])
+
+		# best num_translations targets of each source id
+		order = np.lexsort((-scores, source_ids))
+		source_ids, target_ids = source_ids[order], target_ids[order]
+		first = np.searchsorted(source_ids, source_ids, side="left")
+		rank = np.arange(len(source_ids)) - first
+		selected = rank < num_translations
+		table[source_ids[selected], rank[selected]] = target_ids[selected]
+		return cls(frequent, table)
+
+	@classmethod
+	def load(cls, filename):
+		data = np.load(filename)
+		return cls(data["frequent"], data["table"])
+
+	def save(self, filename):
+		np.savez(filename, frequent=self.frequent, table=self.table)
+
+	# sorted unique candidate target ids for a batch of source ids
+	def candidates(self, source_batch, xp=np):
+		source_batch = cuda.to_cpu(source_batch)
+		translations = self.table[source_batch[source_batch != ID_PAD]].ravel()
+		ids = np.union1d(self.frequent, translations[translations >= 0]).astype(np.int32)
+		return xp.asarray(ids)
+
+def read_lines(filename, vocab):
+	dataset = []
+	with codecs.open(filename, "r", "utf-8") as f:
+		for sentence in f:
+			dataset.append([vocab.get(word, ID_UNK) for word in sentence.strip().split(" ") if len(word) > 0])
+	return dataset
+
+def main(args):
+	vocab, vocab_inv = load_vocab(args.model_dir)
+	vocab_source, vocab_target = vocab
+	source_dataset = read_lines(args.source_filename, vocab_source)
+	target_dataset = read_lines(args.target_filename, vocab_target)
+	assert len(source_dataset) == len(target_dataset)
+
+	shortlist = Shortlist.build(source_dataset, target_dataset, len(vocab_source), len(vocab_target), num_frequent=args.num_frequent, num_translations=args.num_translations)
+	filename = args.model_dir + "/shortlist.npz"
+	shortlist.save(filename)
+	print_bold("shortlist")
+	print("frequent	{}".format(len(shortlist.frequent)))
+	print("table	{}".format(shortlist.table.shape))
+	print("saved to {}".format(filename))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--source-filename", "-source", default=None)
+	parser.add_argument("--target-filename", "-target", default=None)
+	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--num-frequent", type=int, default=1000)
+	parser.add_argument("--num-translations", type=int, default=20)
+	args = parser.parse_args()
+	main(args)
@@ -1,12 +1,22 @@
 # encoding: utf-8
 from __future__ import division
 from __future__ import print_function
+import os, shutil, tempfile
 import numpy as np
 import chainer
 import chainer.links as L
 import chainer.functions as F
 from chainer import Variable, Chain
 from model import AttentiveSeq2SeqModel, Seq2SeqModel
+import dataset
+from dataset import make_buckets, load_buckets
+from common import ID_PAD, ID_EOS
+from server import DynamicBatcher
+from scheduler import ContinuousBatchScheduler
+from translate import translate_batch, _beam_search_batch, _length_penalty
+from encoder_cache import EncoderCache, encode_with_cache
+from shortlist import Shortlist
+from error import compute_edit_distance_batch, compute_word_error_rate_batch, compute_word_error_rate_of_sequence
 
 def test_seq2seq():
 	num_layers = 13
@@ -30,7 +40,7 @@ def test_seq2seq():
 
 	model.reset_decoder_state()
 	for t in xrange(dec_seq_length):
-		y = model.decode_one_step(dec_data[:, :t+1], ht).data
+		y = model.decode_one_step(dec_data[:, t, None], ht).data
 		target = np.swapaxes(np.reshape(Y.data, (batchsize, -1, dec_vocab_size)), 1, 2)
 		target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
 		assert np.sum((y - target) ** 2) == 0
@@ -58,12 +68,184 @@ def test_attentive_seq2seq():
 
 	model.reset_decoder_state()
 	for t in xrange(dec_seq_length):
-		y = model.decode_one_step(dec_data[:, :t+1], ht, H, skip_mask).data
+		y = model.decode_one_step(dec_data[:, t, None], ht, H, skip_mask).data
 		target = np.swapaxes(np.reshape(Y.data, (batchsize, -1, dec_vocab_size)), 1, 2)
 		target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
 		assert np.sum((y - target) ** 2) == 0
 		print("t = {} OK".format(t))
 
+def test_make_buckets():
+	source = [[4, 5], [6, 7, 8, 9, 10, 11], [12]]
+	target = [[3, 4, 2], [3, 5, 6, 2], [3] + [7] * 20 + [2]]
+	buckets_source, buckets_target, masks_source, masks_target = make_buckets(source, target, return_masks=True)
+	assert source == [[4, 5], [6, 7, 8, 9, 10, 11], [12]]	# untouched
+	assert buckets_source[0].tolist() == [[ID_PAD, ID_PAD, ID_PAD, 4, 5]]
+	assert buckets_target[0].tolist() == [[3, 4, 2] + [ID_PAD] * 7]
+	assert buckets_source[1].tolist() == [[ID_PAD] * 4 + [6, 7, 8, 9, 10, 11]]
+	assert buckets_source[2].shape == (1, 20) and buckets_source[2][0, -1] == 12
+	for bucket, mask in zip(buckets_source + buckets_target, masks_source + masks_target):
+		assert np.all((bucket != ID_PAD) == mask)
+	print("make_buckets OK")
+
+def test_dynamic_batcher():
+	batches = []
+	def run_batch(bucket_index, batch):
+		batches.append((bucket_index, len(batch)))
+		return [sum(word_ids) for word_ids in batch]
+	batcher = DynamicBatcher(run_batch, 2, max_batchsize=3, max_wait=0.01)
+	requests = [batcher.submit([n, 1], n % 2) for n in range(7)]
+	assert [request.wait() for request in requests] == [n + 1 for n in range(7)]
+	assert all(size <= 3 for bucket_index, size in batches)
+	assert sum(size for bucket_index, size in batches) == 7
+	assert batcher.get_stats()["num_requests"] == 7
+	batcher.stop()
+	print("dynamic batcher OK")
+
+def test_continuous_batching():
+	np.random.seed(0)
+	sources = [np.random.randint(4, 10, size=np.random.randint(1, 8)).tolist() for _ in range(20)]
+	for model_class in [Seq2SeqModel, AttentiveSeq2SeqModel]:
+		model = model_class(10, 10, ndim_embedding=8, num_layers=2, ndim_h=8, pooling="fo")
+		expected = []
+		for word_ids in sources:
+			translation, lengths = translate_batch(model, np.asarray([word_ids], dtype=np.int32), len(word_ids) * 2 + 1, return_lengths=True)
+			translation = translation[0, 1:lengths[0]]
+			if len(translation) > 0 and translation[-1] == ID_EOS:
+				translation = translation[:-1]
+			expected.append(translation.tolist())
+		scheduler = ContinuousBatchScheduler(model, max_batchsize=4)
+		assert [output.tolist() for output in scheduler.translate(sources)] == expected
+	print("continuous batching OK")
+
+def test_beam_search():
+	np.random.seed(0)
+	source = np.asarray([[ID_PAD, 5, 6, 7], [4, 8, 9, 5], [ID_PAD, ID_PAD, 6, 4]], dtype=np.int32)
+	max_predict_length = 10
+
+	# length-normalized log probability of each hypothesis
+	def score(model, translation):
+		model.reset_state()
+		ht = model.encode(source, source != ID_PAD, test=True)
+		log_p = 0
+		for t in xrange(1, max_predict_length):
+			y = F.log_softmax(model.decode_one_step(translation[:, t - 1, None], ht, test=True)).data
+			log_p += y[np.arange(len(y)), translation[:, t]] * (translation[:, t] != ID_PAD)
+		lengths = (translation != ID_PAD).sum(axis=1) - 1
+		return log_p / _length_penalty(lengths, 0.6)
+
+	for seed in xrange(3):
+		np.random.seed(seed)
+		model = Seq2SeqModel(10, 10, ndim_embedding=8, num_layers=2, ndim_h=8, pooling="fo", wgain=1)
+		greedy = translate_batch(model, source, max_predict_length)
+		assert np.all(_beam_search_batch(model, source, max_predict_length, beam_width=1) == greedy)
+		translation = _beam_search_batch(model, source, max_predict_length, beam_width=4)
+		assert np.all(score(model, translation) >= score(model, greedy) - 1e-5)
+	print("beam search OK")
+
+def test_encoder_cache():
+	source = np.asarray([[ID_PAD, ID_PAD, 5, 6], [ID_PAD, 7, 8, 9], [ID_PAD, ID_PAD, 5, 6]], dtype=np.int32)
+	model = AttentiveSeq2SeqModel(10, 10, ndim_embedding=8, num_layers=2, ndim_h=8, pooling="fo")
+	model.reset_state()
+	expected_hidden_states, expected_outputs = model.encode(source, source != ID_PAD, test=True)
+	cache = EncoderCache(1 << 20, dtype=np.float32)
+	for _ in range(2):
+		hidden_states, outputs = encode_with_cache(model, source, cache)
+		for h, expected in zip(hidden_states, expected_hidden_states):
+			assert np.allclose(h.data, expected.data, atol=1e-6)
+		assert np.allclose(outputs.data, expected_outputs.data, atol=1e-6)
+	assert cache.hits == 3 and len(cache) == 2
+	print("encoder cache OK")
+
+def test_shortlist():
+	source = [[4, 5], [4, 6], [5, 6, 7]]
+	target = [[3, 8, 9, 2], [3, 8, 2], [3, 9, 2]]
+	shortlist = Shortlist.build(source, target, 10, 10, num_frequent=1, num_translations=2)
+	source_batch = np.asarray([[ID_PAD, 6]], dtype=np.int32)
+	ids = shortlist.candidates(source_batch)
+	assert 8 in ids and ID_EOS in ids and len(ids) < 10
+
+	model = Seq2SeqModel(10, 10, ndim_embedding=8, num_layers=2, ndim_h=8, pooling="fo")
+	model.reset_state()
+	ht = model.encode(source_batch, source_batch != ID_PAD, test=True)
+	x = np.asarray([[3]], dtype=np.int32)
+	y = model.decode_one_step(x, ht, test=True).data
+	model.reset_decoder_state()
+	y_shortlist = model.decode_one_step(x, ht, test=True, output_weights=model.select_output_weights(ids)).data
+	assert np.allclose(y[:, ids], y_shortlist)
+
+	# beam search only emits candidates
+	translation = _beam_search_batch(model, source_batch, 6, beam_width=2, shortlist=shortlist)
+	assert np.all(np.in1d(translation[:, 1:], np.append(ids, ID_PAD)))
+	print("shortlist OK")
+
+def test_edit_distance():
+	references = np.asarray([[4, 5, 6, 7], [4, 5, 6, 0], [4, 0, 0, 0]], dtype=np.int32)
+	hypotheses = np.asarray([[4, 6, 7, 8, 9], [6, 5, 4, 0, 0], [0, 0, 0, 0, 0]], dtype=np.int32)
+	distance = compute_edit_distance_batch(references, [4, 3, 1], hypotheses, [5, 3, 0])
+	assert distance.tolist() == [3, 2, 1]
+
+	# does not overflow on long sentences
+	distance = compute_edit_distance_batch(np.full((1, 300), 4, dtype=np.int32), [300], np.zeros((1, 0), dtype=np.int32), [0])
+	assert distance.tolist() == [300]
+
+	# random padded rows against the plain DP, including empty references and hypotheses
+	np.random.seed(0)
+	for _ in xrange(20):
+		batchsize = np.random.randint(1, 8)
+		references = np.random.randint(4, 8, size=(batchsize, np.random.randint(1, 12))).astype(np.int32)
+		hypotheses = np.random.randint(4, 8, size=(batchsize, np.random.randint(1, 12))).astype(np.int32)
+		reference_lengths = np.random.randint(0, references.shape[1] + 1, size=batchsize)
+		hypothesis_lengths = np.random.randint(0, hypotheses.shape[1] + 1, size=batchsize)
+		wer = compute_word_error_rate_batch(references, reference_lengths, hypotheses, hypothesis_lengths)
+		for n in xrange(batchsize):
+			expected = compute_word_error_rate_of_sequence(references[n, :reference_lengths[n]], hypotheses[n, :hypothesis_lengths[n]])
+			assert abs(wer[n] - expected) < 1e-9
+	print("edit distance OK")
+
+def test_load_buckets_cache():
+	directory = tempfile.mkdtemp()
+	source_filename = os.path.join(directory, "source.txt")
+	target_filename = os.path.join(directory, "target.txt")
+	with open(source_filename, "w") as source, open(target_filename, "w") as target:
+		for i in xrange(60):
+			source.write(" ".join("s{}".format((i * 7 + j) % 13) for j in xrange(i % 12 + 1)) + "\n")
+			target.write(" ".join("t{}".format((i * 5 + j) % 11) for j in xrange(i % 9 + 1)) + "\n")
+	cache_dir = os.path.join(directory, "cache")
+	read_data = dataset.read_data
+	def fail(*args, **kwargs):
+		raise AssertionError("cache miss")
+	try:
+		source_buckets, target_buckets, num_data, vocab, vocab_inv, key = load_buckets(source_filename, target_filename, cache_dir=cache_dir)
+
+		# the second load must not read the text again
+		dataset.read_data = fail
+		cached = load_buckets(source_filename, target_filename, cache_dir=cache_dir)
+		dataset.read_data = read_data
+		assert cached[5] == key and cached[2] == num_data
+		assert cached[3] == vocab and cached[4] == vocab_inv
+		for buckets, cached_buckets in ((source_buckets, cached[0]), (target_buckets, cached[1])):
+			for split, cached_split in zip(buckets, cached_buckets):
+				assert len(split) == len(cached_split)
+				for bucket, cached_bucket in zip(split, cached_split):
+					assert np.array_equal(bucket, cached_bucket)
+
+		# the seed and the split ratios are part of the key
+		assert load_buckets(source_filename, target_filename, seed=1, cache_dir=cache_dir)[5] != key
+		assert load_buckets(source_filename, target_filename, train_split_ratio=0.8, cache_dir=cache_dir)[5] != key
+		assert load_buckets(source_filename, target_filename, dev_split_ratio=0.1, cache_dir=cache_dir)[5] != key
+	finally:
+		dataset.read_data = read_data
+		shutil.rmtree(directory)
+	print("load buckets cache OK")
+
 if __name__ == "__main__":
 	test_seq2seq()
 	test_attentive_seq2seq()
+	test_make_buckets()
+	test_dynamic_batcher()
+	test_continuous_batching()
+	test_beam_search()
+	test_encoder_cache()
+	test_shortlist()
+	test_edit_distance()
+	test_load_buckets_cache()
@@ -10,34 +10,57 @@ from chainer import training, Variable, optimizers, cuda
 from chainer.training import extensions
 sys.path.append(os.path.split(os.getcwd())[0])
 from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, stdout, print_bold
-from dataset import read_data, make_buckets, make_source_target_pair, sample_batch_from_bucket
+from dataset import load_buckets, fill_batch
 from eve import Eve
+from flat import FlatAdam, FlatEve, update_accumulated
+from parallel import DataParallel, shard
+from distributed import RingAllReduce, DistributedDataParallel
+from async_eval import AsyncEvaluator
+from iterator import BatchPrefetcher, BucketIterator
 from model import seq2seq, load_model, save_model, save_vocab
-from error import compute_mean_wer, compute_random_mean_wer, softmax_cross_entropy
+from error import compute_mean_wer, compute_random_mean_wer
+from loss import softmax_cross_entropy, linear_softmax_cross_entropy
 from translate import show_random_source_target_translation
 
 # reference
 # https://www.tensorflow.org/tutorials/seq2seq
 
+def mean(l):
+	return sum(l) / len(l)
+
+# returns the mean WER on dev
+def print_wer(epoch, wer_train, wer_dev):
+	if epoch is not None:
+		print_bold("evaluation of epoch {}".format(epoch))
+	print_bold("WER (sampled train)")
+	print(mean(wer_train), wer_train)
+	print_bold("WER (dev)")
+	mean_wer_dev = mean(wer_dev)
+	print(mean_wer_dev, wer_dev)
+	return mean_wer_dev
+
 def main(args):
-	# load textfile
-	source_dataset, target_dataset, vocab, vocab_inv = read_data(args.source_filename, args.target_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed)
-	save_vocab(args.model_dir, vocab, vocab_inv)
+	assert args.accumulate >= 1
+	# load textfile and split into buckets
+	source_buckets, target_buckets, (num_train, num_dev, num_test), vocab, vocab_inv, data_hash = load_buckets(args.source_filename, args.target_filename, train_split_ratio=args.train_split, dev_split_ratio=args.dev_split, seed=args.seed, cache_dir=args.cache_dir)
+	# with several ranks only rank 0 writes to model_dir
+	is_master = args.rank == 0
+	if is_master:
+		save_vocab(args.model_dir, vocab, vocab_inv)
 
-	source_dataset_train, source_dataset_dev, source_dataset_test = source_dataset
-	target_dataset_train, target_dataset_dev, target_dataset_test = target_dataset
+	source_buckets_train, source_buckets_dev, source_buckets_test = source_buckets
+	target_buckets_train, target_buckets_dev, target_buckets_test = target_buckets
 	print_bold("data	#")
-	print("train	{}".format(len(source_dataset_train)))
-	print("dev	{}".format(len(source_dataset_dev)))
-	print("test	{}".format(len(source_dataset_test)))
+	print("train	{}".format(num_train))
+	print("dev	{}".format(num_dev))
+	print("test	{}".format(num_test))
+	print("hash	{}".format(data_hash))
 
 	vocab_source, vocab_target = vocab
 	vocab_inv_source, vocab_inv_target = vocab_inv
 	print("vocab	{}	(source)".format(len(vocab_source)))
 	print("vocab	{}	(target)".format(len(vocab_target)))
 
-	# split into buckets
-	source_buckets_train, target_buckets_train = make_buckets(source_dataset_train, target_dataset_train)
 	if args.buckets_limit is not None:
 		source_buckets_train = source_buckets_train[:args.buckets_limit+1]
 		target_buckets_train = target_buckets_train[:args.buckets_limit+1]
@@ -47,7 +70,6 @@ def main(args):
 		print("{} 	{}".format(size, len(data)))
 
 	print_bold("buckets 	#data	(dev)")
-	source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev)
 	if args.buckets_limit is not None:
 		source_buckets_dev = source_buckets_dev[:args.buckets_limit+1]
 		target_buckets_dev = target_buckets_dev[:args.buckets_limit+1]
@@ -55,26 +77,29 @@ def main(args):
 		print("{} 	{}".format(size, len(data)))
 
 	print_bold("buckets		#data	(test)")
-	source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test)
 	if args.buckets_limit is not None:
 		source_buckets_test = source_buckets_test[:args.buckets_limit+1]
 		target_buckets_test = target_buckets_test[:args.buckets_limit+1]
 	for size, data in zip(bucket_sizes, source_buckets_test):
 		print("{} 	{}".format(size, len(data)))
 
-	# to maintain equilibrium
-	min_num_data = 0
-	for data in source_buckets_train:
-		if min_num_data == 0 or len(data) < min_num_data:
-			min_num_data = len(data)
-	repeats = []
-	for data in source_buckets_train:
-		repeats.append(len(data) // min_num_data + 1)
+	# every training pair is used exactly once per epoch
+	train_iterator = BucketIterator([len(data) for data in source_buckets_train], args.batchsize, seed=args.seed)
+	num_iteration = train_iterator.num_batches_per_epoch
+
+	def fill_train_batch(buffers, request):
+		bucket_index, indices = request
+		return fill_batch(buffers, source_buckets_train[bucket_index], target_buckets_train[bucket_index], indices)
 
-	num_updates_per_iteration = 0
-	for repeat, data in zip(repeats, source_buckets_train):
-		num_updates_per_iteration += repeat * args.batchsize
-	num_iteration = len(source_dataset_train) // num_updates_per_iteration + 1
+	def evaluate_model(model):
+		wer_train = compute_random_mean_wer(model, source_buckets_train, target_buckets_train, len(vocab_inv_target), sample_size=args.batchsize, argmax=True)
+		wer_dev = compute_mean_wer(model, source_buckets_dev, target_buckets_dev, len(vocab_inv_target), batchsize=args.batchsize, argmax=True)
+		return wer_train, wer_dev
+
+	# the evaluation process has to be forked before cuda is initialized
+	evaluator = None
+	if args.async_eval and is_master:
+		evaluator = AsyncEvaluator(evaluate_model, load_model, save_model, gpu_device=args.gpu_device)
 
 	# init
 	model = load_model(args.model_dir)
@@ -85,55 +110,107 @@ def main(args):
 		model.to_gpu()
 
 	# setup an optimizer
-	if args.eve:
-		optimizer = Eve(alpha=args.learning_rate, beta1=0.9)
+	if args.flat:
+		# parameters, gradients and moments in contiguous buffers, clipping and decay fused into the update
+		if args.eve:
+			optimizer = FlatEve(alpha=args.learning_rate, beta1=0.9, grad_clip=args.grad_clip, weight_decay=args.weight_decay)
+		else:
+			optimizer = FlatAdam(alpha=args.learning_rate, beta1=0.9, grad_clip=args.grad_clip, weight_decay=args.weight_decay)
+		optimizer.setup(model)
 	else:
-		optimizer = optimizers.Adam(alpha=args.learning_rate, beta1=0.9)
-	optimizer.setup(model)
-	optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
-	optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
+		if args.eve:
+			optimizer = Eve(alpha=args.learning_rate, beta1=0.9)
+		else:
+			optimizer = optimizers.Adam(alpha=args.learning_rate, beta1=0.9)
+		optimizer.setup(model)
+		optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
+		optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
 	min_learning_rate = 1e-7
 	prev_wer = None
 	total_time = 0
 
-	def mean(l):
-		return sum(l) / len(l)
+	# mean over the non-PAD tokens of the batch
+	def compute_loss(source_batch, skip_mask, target_batch_input, target_batch_output):
+		model.reset_state()
+		return_hidden = args.loss_chunk_size > 0
+		if args.attention:
+			last_hidden_states, last_layer_outputs = model.encode(source_batch, skip_mask)
+			Y = model.decode(target_batch_input, last_hidden_states, last_layer_outputs, skip_mask, return_hidden=return_hidden)
+		else:
+			last_hidden_states = model.encode(source_batch, skip_mask)
+			Y = model.decode(target_batch_input, last_hidden_states, return_hidden=return_hidden)
+		if return_hidden:
+			# Y is the input of the output layer, the full logits matrix is never materialised
+			return linear_softmax_cross_entropy(Y, model.dense.W, model.dense.b, target_batch_output, chunk_size=args.loss_chunk_size, ignore_label=ID_PAD)
+		return softmax_cross_entropy(Y, target_batch_output, ignore_label=ID_PAD)
+
+	# synchronous data parallel training on cpu, this process is worker 0
+	# every worker takes num_iteration batches per epoch from the same schedule
+	trainer = None
+	if args.workers > 1:
+		assert args.flat and args.gpu_device < 0 and args.accumulate == 1
+		num_iteration = train_iterator.num_batches_per_epoch // args.workers
+		trainer = DataParallel(model, optimizer, args.workers)
+
+		def train_worker(worker_index):
+			for epoch in xrange(1, args.epoch + 1):
+				loader = BatchPrefetcher(shard(train_iterator.epoch(), worker_index, args.workers, num_iteration), fill_train_batch, num_prefetch=args.prefetch)
+				for source_batch, skip_mask, target_batch_input, target_batch_output in loader:
+					trainer.step(lambda: (compute_loss(source_batch, skip_mask, target_batch_input, target_batch_output), int((target_batch_output != ID_PAD).sum())))
+				loader.close()
+
+		trainer.start(train_worker)
+
+	# synchronous data parallel training over tcp, one process per rank
+	# every rank takes its own shard of the same schedule, only rank 0 saves and evaluates
+	if args.world_size > 1:
+		assert args.flat and args.gpu_device < 0 and args.workers == 1 and args.accumulate == 1
+		num_iteration = train_iterator.num_batches_per_epoch // args.world_size
+		all_reduce = RingAllReduce(args.rank, args.world_size, args.master_addr, args.master_port, dtype=np.float16 if args.dist_fp16 else np.float32, bucket_size=args.bucket_size)
+		trainer = DistributedDataParallel(model, optimizer, all_reduce)
 
 	# training
 	for epoch in xrange(1, args.epoch + 1):
 		print("Epoch", epoch)
 		start_time = time.time()
-		for itr in xrange(1, num_iteration + 1):
-			for repeat, source_bucket, target_bucket in zip(repeats, source_buckets_train, target_buckets_train):
-				for r in xrange(repeat):
-					# sample minibatch
-					source_batch, target_batch = sample_batch_from_bucket(source_bucket, target_bucket, args.batchsize)
-					skip_mask = source_batch != ID_PAD
-					target_batch_input, target_batch_output = make_source_target_pair(target_batch)
-
-					# to gpu
-					if model.xp is cuda.cupy:
-						skip_mask = cuda.to_gpu(skip_mask)
-						source_batch = cuda.to_gpu(source_batch)
-						target_batch_input = cuda.to_gpu(target_batch_input)
-						target_batch_output = cuda.to_gpu(target_batch_output)
-
-					# compute loss
-					model.reset_state()
-					if args.attention:
-						last_hidden_states, last_layer_outputs = model.encode(source_batch, skip_mask)
-						Y = model.decode(target_batch_input, last_hidden_states, last_layer_outputs, skip_mask)
-					else:
-						last_hidden_states = model.encode(source_batch, skip_mask)
-						Y = model.decode(target_batch_input, last_hidden_states)
-					loss = softmax_cross_entropy(Y, target_batch_output, ignore_label=ID_PAD)
-					optimizer.update(lossfun=lambda: loss)
-
-				sys.stdout.write("\r{} / {}".format(itr, num_iteration))
-				sys.stdout.flush()
-
-			if itr % args.interval == 0 or itr == num_iteration:
+		requests = train_iterator.epoch()
+		if trainer is not None:
+			requests = shard(requests, trainer.worker_index, trainer.num_workers, num_iteration)
+		loader = BatchPrefetcher(requests, fill_train_batch, num_prefetch=args.prefetch, device=args.gpu_device if model.xp is cuda.cupy else -1)
+		# sampled, masked and transferred by the prefetcher
+		num_accumulated = 0
+		for itr, (source_batch, skip_mask, target_batch_input, target_batch_output) in enumerate(loader, 1):
+			if trainer is not None:
+				trainer.step(lambda: (compute_loss(source_batch, skip_mask, target_batch_input, target_batch_output), int((target_batch_output != ID_PAD).sum())))
+			elif args.accumulate == 1:
+				loss = compute_loss(source_batch, skip_mask, target_batch_input, target_batch_output)
+				optimizer.update(lossfun=lambda: loss)
+			else:
+				# token-weighted losses are backpropagated right away, the batch buffers are reused by the loader
+				if num_accumulated == 0:
+					model.zerograds()
+					loss_sum, num_tokens = 0, 0
+				n = int((target_batch_output != ID_PAD).sum())
+				weighted_loss = compute_loss(source_batch, skip_mask, target_batch_input, target_batch_output) * n
+				weighted_loss.backward()
+				loss_sum += weighted_loss.data
+				num_tokens += n
+				num_accumulated += 1
+				del weighted_loss
+				if num_accumulated == args.accumulate or itr == num_iteration:
+					update_accumulated(model, optimizer, float(loss_sum), num_tokens)
+					num_accumulated = 0
+
+			sys.stdout.write("\r{} / {}".format(itr, num_iteration))
+			sys.stdout.flush()
+
+			if is_master and (itr % args.interval == 0 or itr == num_iteration):
 				save_model(args.model_dir, model)
+		loader.close()
+
+		# the learning rate of rank 0 is sent along with the gradients
+		if not is_master:
+			continue
 
 		# show log
 		sys.stdout.write("\r" + stdout.CLEAR)
@@ -142,21 +219,31 @@ def main(args):
 		show_random_source_target_translation(model, source_buckets_train, target_buckets_train, vocab_inv_source, vocab_inv_target, num_translate=5, argmax=True)
 		print_bold("translate (dev)")
 		show_random_source_target_translation(model, source_buckets_dev, target_buckets_dev, vocab_inv_source, vocab_inv_target, num_translate=5, argmax=True)
-		print_bold("WER (sampled train)")
-		wer_train = compute_random_mean_wer(model, source_buckets_train, target_buckets_train, len(vocab_inv_target), sample_size=args.batchsize, argmax=True)
-		print(mean(wer_train), wer_train)
-		print_bold("WER (dev)")
-		wer_dev = compute_mean_wer(model, source_buckets_dev, target_buckets_dev, len(vocab_inv_target), batchsize=args.batchsize, argmax=True)
-		mean_wer_dev = mean(wer_dev)
-		print(mean_wer_dev, wer_dev)
+		if evaluator is None:
+			results = [(epoch, evaluate_model(model))]
+		else:
+			# the dev set is decoded in the evaluation process while training continues
+			evaluator.submit(epoch, model)
+			results = evaluator.poll()
+		for result_epoch, (wer_train, wer_dev) in results:
+			mean_wer_dev = print_wer(result_epoch if evaluator is not None else None, wer_train, wer_dev)
+
+			# decay learning rate on the latest available result
+			if prev_wer is not None and mean_wer_dev >= prev_wer and optimizer.alpha > min_learning_rate:
+				optimizer.alpha *= 0.5
+			prev_wer = mean_wer_dev
 		elapsed_time = (time.time() - start_time) / 60.
 		total_time += elapsed_time
 		print("done in {} min, lr = {}, total {} min".format(int(elapsed_time), optimizer.alpha, int(total_time)))
 
-		# decay learning rate
-		if prev_wer is not None and mean_wer_dev >= prev_wer and optimizer.alpha > min_learning_rate:
-			optimizer.alpha *= 0.5
-		prev_wer = mean_wer_dev
+	if args.world_size > 1:
+		all_reduce.close()
+	elif trainer is not None:
+		trainer.join()
+
+	if evaluator is not None:
+		for result_epoch, (wer_train, wer_dev) in evaluator.close():
+			print_wer(result_epoch, wer_train, wer_dev)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -169,6 +256,7 @@ if __name__ == "__main__":
 	parser.add_argument("--ndim-embedding", "-ne", type=int, default=320)
 	parser.add_argument("--num-layers", "-layers", type=int, default=4)
 	parser.add_argument("--interval", type=int, default=100)
+	parser.add_argument("--prefetch", type=int, default=4)
 	parser.add_argument("--seed", type=int, default=0)
 	parser.add_argument("--pooling", "-p", type=str, default="fo")
 	parser.add_argument("--wgain", "-w", type=float, default=0.01)
@@ -177,12 +265,24 @@ if __name__ == "__main__":
 	parser.add_argument("--source-filename", "-source", default=None)
 	parser.add_argument("--target-filename", "-target", default=None)
 	parser.add_argument("--buckets-limit", type=int, default=None)
+	parser.add_argument("--cache-dir", type=str, default="cache")
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	parser.add_argument("--learning-rate", "-lr", type=float, default=0.01)
 	parser.add_argument("--densely-connected", "-dense", default=False, action="store_true")
 	parser.add_argument("--zoneout", "-zoneout", default=False, action="store_true")
 	parser.add_argument("--dropout", "-dropout", default=False, action="store_true")
 	parser.add_argument("--eve", default=False, action="store_true")
+	parser.add_argument("--flat", default=False, action="store_true", help="fused optimizer step over flat parameter buffers")
 	parser.add_argument("--attention", default=False, action="store_true")
+	parser.add_argument("--loss-chunk-size", type=int, default=0, help="compute the output layer and loss this many rows at a time, 0 disables")
+	parser.add_argument("--accumulate", type=int, default=1, help="sum gradients over this many batches per update")
+	parser.add_argument("--workers", type=int, default=1, help="data parallel cpu training with this many processes, requires --flat and -g -1")
+	parser.add_argument("--rank", type=int, default=0, help="rank of this process in multi-node training")
+	parser.add_argument("--world-size", type=int, default=1, help="number of processes in multi-node training, requires --flat and -g -1")
+	parser.add_argument("--master-addr", type=str, default="127.0.0.1", help="address of rank 0")
+	parser.add_argument("--master-port", type=int, default=29500, help="port rank 0 listens on for the rendezvous")
+	parser.add_argument("--bucket-size", type=int, default=1 << 20, help="number of gradients per all-reduce bucket")
+	parser.add_argument("--dist-fp16", default=False, action="store_true", help="send gradients as float16")
+	parser.add_argument("--async-eval", default=False, action="store_true", help="evaluate weight snapshots in a separate process")
 	args = parser.parse_args()
 	main(args)
\ No newline at end of file
@@ -2,7 +2,7 @@
 from __future__ import division
 from __future__ import print_function
 from six.moves import xrange
-import argparse, sys, os, codecs, random, math
+import argparse, sys, os, codecs, random, math, time, shutil, tempfile, multiprocessing
 import numpy as np
 import chainer
 import chainer.functions as F
@@ -12,6 +12,11 @@ sys.path.append(os.path.split(os.getcwd())[0])
 from model import load_model, load_vocab, Seq2SeqModel, AttentiveSeq2SeqModel
 from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, stdout, print_bold
 from dataset import sample_batch_from_bucket
+from qrnn import take_rows
+from bucket import flatten, assign_buckets, pack
+from encoder_cache import encode_with_cache
+from flat import save_params, map_params
+from shortlist import Shortlist
 
 def read_data(source_filename, vocab_source, reverse=True):
 	source_dataset = []
@@ -33,81 +38,228 @@ def read_data(source_filename, vocab_source, reverse=True):
 
 	return source_dataset
 
-def make_buckets(dataset):
-	buckets_list = [[] for _ in xrange(len(bucket_sizes))]
-	for word_ids in dataset:
-		length = len(word_ids)
-		bucket_index = 0
-		for size in bucket_sizes:
-			if length <= size[0]:
-				break
-			bucket_index += 1
-		if bucket_index >= len(bucket_sizes):
-			continue	# ignore long sequence
-
-		required_length, _ = bucket_sizes[bucket_index]
-		
-		for _ in xrange(max(required_length - length, 0)):
-			word_ids.insert(0, ID_PAD)	# prepend
-		assert len(word_ids) == required_length
-
-		buckets_list[bucket_index].append(word_ids)
+# one entry per line including empty lines, unknown words become <unk>
+def read_lines(source_filename, vocab_source, reverse=True):
+	source_dataset = []
+	with codecs.open(source_filename, "r", "utf-8") as f:
+		for sentence in f:
+			word_ids = [vocab_source.get(word, ID_UNK) for word in sentence.strip().split(" ") if len(word) > 0]
+			if reverse:
+				word_ids.reverse()
+			source_dataset.append(word_ids)
+	return source_dataset
 
+def make_buckets(dataset, return_masks=False):
+	tokens, lengths, offsets = flatten(dataset)
+	bucket_indices = assign_buckets(lengths, [size[0] for size in bucket_sizes])	# long sequences get len(bucket_sizes) and are ignored
 	buckets = []
-	for bucket_source in buckets_list:
-		if len(bucket_source) == 0:
+	masks = []
+	for bucket_index, (required_length, _) in enumerate(bucket_sizes):
+		indices = np.flatnonzero(bucket_indices == bucket_index)
+		if len(indices) == 0:
 			continue
-		buckets.append(np.asarray(bucket_source).astype(np.int32))
+		bucket, mask = pack(tokens, lengths, offsets, indices, required_length, ID_PAD, left_pad=True)
+		buckets.append(bucket)
+		masks.append(mask)
+	if return_masks:
+		return buckets, masks
 	return buckets
 
-def _translate_batch(model, source_batch, max_predict_length, vocab_inv_source, vocab_inv_target, argmax=True, source_reversed=True):
+# argmax or sampling over the whole batch at once
+# p: (batchsize, vocab_size) probabilities
+def select_tokens(p, argmax=True):
+	xp = cuda.get_array_module(p)
+	if argmax:
+		return xp.argmax(p, axis=1).astype(xp.int32)
+	# inverse CDF sampling
+	cdf = xp.cumsum(p, axis=1)
+	u = xp.random.rand(p.shape[0], 1) * cdf[:, -1, None]
+	return xp.minimum((cdf < u).sum(axis=1), p.shape[1] - 1).astype(xp.int32)
+
+# greedy / sampled decoding shared by translation and WER computation
+# rows that emitted <eos> are dropped from the decoding batch every compact_interval steps
+# and decoding stops once every row has finished
+# returns (batchsize, max_predict_length) token ids starting with <go>, padded after <eos>
+# tokens are written into a (batchsize, max_predict_length) buffer allocated once
+# lengths[n] is the number of tokens written to row n including GO and EOS
+# with a shortlist only the candidate target words of the batch are scored
+def translate_batch(model, source_batch, max_predict_length, argmax=True, compact_interval=8, return_lengths=False, encoder_cache=None, shortlist=None):
 	xp = model.xp
 	skip_mask = source_batch != ID_PAD
 	batchsize = source_batch.shape[0]
+	attention = isinstance(model, AttentiveSeq2SeqModel)
+	candidates = None if shortlist is None else shortlist.candidates(source_batch, xp)
+	output_weights = None if candidates is None else model.select_output_weights(candidates)
 
 	# to gpu
 	if xp is cuda.cupy:
 		source_batch = cuda.to_gpu(source_batch)
 		skip_mask = cuda.to_gpu(skip_mask)
 
-	word_ids = xp.arange(0, len(vocab_inv_target), dtype=xp.int32)
-
 	model.reset_state()
-	token = ID_GO
-	x = xp.asarray([[token]]).astype(xp.int32)
-	x = xp.broadcast_to(x, (batchsize, 1))
 
 	# get encoder's last hidden states
-	if isinstance(model, AttentiveSeq2SeqModel):
+	if encoder_cache is not None:
+		encoded = encode_with_cache(model, source_batch, encoder_cache)
+		if attention:
+			encoder_last_hidden_states, encoder_last_layer_outputs = encoded
+		else:
+			encoder_last_hidden_states = encoded
+	elif attention:
 		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source_batch, skip_mask, test=True)
 	else:
 		encoder_last_hidden_states = model.encode(source_batch, skip_mask, test=True)
 
-	while x.shape[1] < max_predict_length:
-		if isinstance(model, AttentiveSeq2SeqModel):
-			u = model.decode_one_step(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask, test=True)
-		else:
-			u = model.decode_one_step(x, encoder_last_hidden_states, test=True)
-		p = F.softmax(u)	# convert to probability
+	result = xp.full((batchsize, max_predict_length), ID_PAD, dtype=xp.int32)
+	result[:, 0] = ID_GO
+	lengths = xp.ones((batchsize,), dtype=xp.int32)
+	rows = xp.arange(batchsize, dtype=xp.int32)	# row of result for each row of the decoding batch
+	finished = xp.zeros((batchsize,), dtype=bool)
+	x = result[:, 0, None]
 
-		# concatenate
-		if xp is np:
-			x = xp.append(x, xp.zeros((batchsize, 1), dtype=xp.int32), axis=1)
+	for t in xrange(1, max_predict_length):
+		if attention:
+			u = model.decode_one_step(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask, test=True, output_weights=output_weights)
 		else:
-			x = xp.concatenate((x, xp.zeros((batchsize, 1), dtype=xp.int32)), axis=1)
+			u = model.decode_one_step(x, encoder_last_hidden_states, test=True, output_weights=output_weights)
+		p = F.softmax(u)	# convert to probability
+		tokens = select_tokens(p.data, argmax=argmax)
+		if candidates is not None:
+			tokens = xp.take(candidates, tokens)	# back to target ids
+		tokens = xp.where(finished, ID_PAD, tokens).astype(xp.int32)
+		result[rows, t] = tokens
+		lengths[rows] += ~finished
+		finished = finished | (tokens == ID_EOS)
+
+		# synchronize only every compact_interval steps
+		if t % compact_interval == 0:
+			alive = cuda.to_cpu(~finished)
+			if not np.any(alive):
+				break
+			if not np.all(alive):
+				keep = xp.asarray(np.flatnonzero(alive).astype(np.int32))
+				model.reorder_decoder_state(keep)
+				encoder_last_hidden_states = [take_rows(h, keep) for h in encoder_last_hidden_states]
+				if attention:
+					encoder_last_layer_outputs = take_rows(encoder_last_layer_outputs, keep)
+					skip_mask = xp.take(skip_mask, keep, axis=0)
+				rows = xp.take(rows, keep)
+				finished = xp.take(finished, keep)
+				tokens = xp.take(tokens, keep)
+
+		x = tokens[:, None]
+
+	if return_lengths:
+		return result, lengths
+	return result
+
+# GNMT length penalty
+def _length_penalty(length, alpha):
+	return ((5. + length) / 6.) ** alpha
+
+# batch x beam hypotheses are decoded as one batch of batchsize * beam_width rows
+# finished sentences are removed from the decoding batch
+def _beam_search_batch(model, source_batch, max_predict_length, beam_width=4, length_normalization=0.6, shortlist=None):
+	xp = model.xp
+	skip_mask = source_batch != ID_PAD
+	batchsize = source_batch.shape[0]
+	attention = isinstance(model, AttentiveSeq2SeqModel)
+	candidate_ids = None if shortlist is None else shortlist.candidates(source_batch)
+	output_weights = None if candidate_ids is None else model.select_output_weights(xp.asarray(candidate_ids))
 
-		for n in xrange(batchsize):
-			pn = p.data[n]
+	# to gpu
+	if xp is cuda.cupy:
+		source_batch = cuda.to_gpu(source_batch)
+		skip_mask = cuda.to_gpu(skip_mask)
 
-			# argmax or sampling
-			if argmax:
-				token = xp.argmax(pn)
-			else:
-				token = xp.random.choice(word_ids, size=1, p=pn)[0]
+	model.reset_state()
 
-			x[n, -1] = token
+	# get encoder's last hidden states
+	if attention:
+		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source_batch, skip_mask, test=True)
+	else:
+		encoder_last_hidden_states = model.encode(source_batch, skip_mask, test=True)
 
-	return x
+	# copy encoder outputs for each beam
+	rows = xp.asarray(np.repeat(np.arange(batchsize), beam_width).astype(np.int32))
+	encoder_last_hidden_states = [take_rows(h, rows) for h in encoder_last_hidden_states]
+	if attention:
+		encoder_last_layer_outputs = take_rows(encoder_last_layer_outputs, rows)
+		skip_mask = xp.take(skip_mask, rows, axis=0)
+
+	active = np.arange(batchsize)	# sentence index of each active block of beam_width rows
+	scores = np.full((batchsize, beam_width), -np.inf, dtype=np.float32)
+	scores[:, 0] = 0	# all beams start from the same <go>
+	history = np.full((batchsize * beam_width, max_predict_length), ID_PAD, dtype=np.int32)
+	history[:, 0] = ID_GO
+	finished = [[] for _ in xrange(batchsize)]	# (normalized score, tokens)
+
+	for t in xrange(1, max_predict_length):
+		x = xp.asarray(history[:, t - 1, None])
+		if attention:
+			u = model.decode_one_step(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask, test=True, output_weights=output_weights)
+		else:
+			u = model.decode_one_step(x, encoder_last_hidden_states, test=True, output_weights=output_weights)
+		log_p = cuda.to_cpu(F.log_softmax(u).data)
+		vocab_size = log_p.shape[1]
+
+		# 2 * beam_width candidates per sentence guarantee beam_width candidates without <eos>
+		candidates = (scores.reshape((-1, 1)) + log_p).reshape((len(active), -1))
+		num_candidates = min(2 * beam_width, candidates.shape[1])
+		sentence_rows = np.arange(len(active))[:, None]
+		top = np.argpartition(-candidates, num_candidates - 1, axis=1)[:, :num_candidates]
+		top = top[sentence_rows, np.argsort(-candidates[sentence_rows, top], axis=1)]
+		top_scores = candidates[sentence_rows, top]
+		origins = top // vocab_size
+		tokens = top % vocab_size
+		if candidate_ids is not None:
+			tokens = candidate_ids[tokens]	# back to target ids
+
+		# finalize hypotheses ending with <eos> that rank within the beam
+		is_eos = tokens == ID_EOS
+		for a, k in zip(*np.nonzero(is_eos[:, :beam_width] & np.isfinite(top_scores[:, :beam_width]))):
+			row = a * beam_width + origins[a, k]
+			hypothesis = np.append(history[row, :t], ID_EOS)
+			finished[active[a]].append((top_scores[a, k] / _length_penalty(t, length_normalization), hypothesis))
+
+		# the best beam_width candidates without <eos> continue
+		keep = ~is_eos & (np.cumsum(~is_eos, axis=1) <= beam_width)
+		origins = origins[keep].reshape((len(active), beam_width))
+		tokens = tokens[keep].reshape((len(active), beam_width))
+		scores = top_scores[keep].reshape((len(active), beam_width))
+
+		# remove finished sentences from the batch
+		alive = np.asarray([len(finished[n]) < beam_width for n in active], dtype=bool)
+		if not np.any(alive):
+			active = active[alive]
+			break
+		selected = (sentence_rows * beam_width + origins)[alive].reshape((-1,))
+		if not np.all(alive):
+			blocks = xp.asarray((np.flatnonzero(alive)[:, None] * beam_width + np.arange(beam_width)).reshape((-1,)).astype(np.int32))
+			encoder_last_hidden_states = [take_rows(h, blocks) for h in encoder_last_hidden_states]
+			if attention:
+				encoder_last_layer_outputs = take_rows(encoder_last_layer_outputs, blocks)
+				skip_mask = xp.take(skip_mask, blocks, axis=0)
+			active = active[alive]
+			scores = scores[alive]
+			tokens = tokens[alive]
+
+		# one gather per step for the decoder state
+		model.reorder_decoder_state(selected)
+		history = history[selected]
+		history[:, t] = tokens.reshape((-1,))
+
+	# sentences that reached max_predict_length
+	for a, n in enumerate(active):
+		for k in xrange(beam_width):
+			if np.isfinite(scores[a, k]):
+				finished[n].append((scores[a, k] / _length_penalty(max_predict_length - 1, length_normalization), history[a * beam_width + k]))
+
+	result = np.full((batchsize, max_predict_length), ID_PAD, dtype=np.int32)
+	for n in xrange(batchsize):
+		score, hypothesis = max(finished[n], key=lambda hyp: hyp[0])
+		result[n, :len(hypothesis)] = hypothesis
+	return result
 
 def show_translate_results(vocab_inv_source, vocab_inv_target, source_batch, translation_batch, target_batch=None, source_reversed=True):
 	batchsize = source_batch.shape[0]
@@ -167,10 +319,10 @@ def show_source_target_translation(model, source_buckets, target_buckets, vocab_
 			target_sections = [target_bucket]
 
 		for source_batch, target_batch in zip(source_sections, target_sections):
-			translation_batch = _translate_batch(model, source_batch, target_batch.shape[1] * 2, vocab_inv_source, vocab_inv_target, argmax=argmax)
+			translation_batch = translate_batch(model, source_batch, target_batch.shape[1] * 2, argmax=argmax)
 			show_translate_results(vocab_inv_source, vocab_inv_target, source_batch, translation_batch, target_batch)
 
-def show_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_target, batchsize=100, argmax=True):
+def show_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_target, batchsize=100, argmax=True, beam_width=1, length_normalization=0.6, shortlist=None):
 	for source_bucket in source_buckets:
 		num_calculation = 0
 		sum_wer = 0
@@ -185,7 +337,10 @@ def show_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_t
 			source_sections = [source_bucket]
 
 		for source_batch in source_sections:
-			translation_batch = _translate_batch(model, source_batch, source_batch.shape[1] * 2, vocab_inv_source, vocab_inv_target, argmax=argmax)
+			if beam_width > 1:
+				translation_batch = _beam_search_batch(model, source_batch, source_batch.shape[1] * 2, beam_width=beam_width, length_normalization=length_normalization, shortlist=shortlist)
+			else:
+				translation_batch = translate_batch(model, source_batch, source_batch.shape[1] * 2, argmax=argmax, shortlist=shortlist)
 			show_translate_results(vocab_inv_source, vocab_inv_target, source_batch, translation_batch)
 
 def show_random_source_target_translation(model, source_buckets, target_buckets, vocab_inv_source, vocab_inv_target, num_translate=100, argmax=True):
@@ -193,10 +348,107 @@ def show_random_source_target_translation(model, source_buckets, target_buckets,
 	for source_bucket, target_bucket in zip(source_buckets, target_buckets):
 		# sample minibatch
 		source_batch, target_batch = sample_batch_from_bucket(source_bucket, target_bucket, num_translate)
-		translation_batch = _translate_batch(model, source_batch, target_batch.shape[1] * 2, vocab_inv_source, vocab_inv_target, argmax=argmax)
+		translation_batch = translate_batch(model, source_batch, target_batch.shape[1] * 2, argmax=argmax)
 		show_translate_results(vocab_inv_source, vocab_inv_target, source_batch, translation_batch, target_batch)
 
+def _tokens_to_sentence(tokens, vocab_inv_target):
+	sentence = []
+	for token in tokens:
+		token = int(token)	# to cpu
+		if token == ID_EOS:
+			break
+		if token == ID_PAD:
+			break
+		if token == ID_GO:
+			continue
+		sentence.append(vocab_inv_target[token])
+	return " ".join(sentence)
+
+_worker = None
+
+def _init_worker(model_dir, weights_filename, batchsize, beam_width, length_normalization, shortlist_filename=None):
+	global _worker
+	model = load_model(model_dir, load_weights=False)
+	map_params(model, weights_filename)
+	vocab, vocab_inv = load_vocab(model_dir)
+	shortlist = None if shortlist_filename is None else Shortlist.load(shortlist_filename)
+	_worker = (model, vocab_inv[1], batchsize, beam_width, length_normalization, shortlist)
+
+# chunk: (line indices, sources) sorted by length
+def _translate_chunk(chunk):
+	model, vocab_inv_target, batchsize, beam_width, length_normalization, shortlist = _worker
+	indices, sources = chunk
+	translations = []
+	for start in xrange(0, len(sources), batchsize):
+		batch = sources[start:start + batchsize]
+		width = max(max(len(word_ids) for word_ids in batch), 1)
+		source_batch = np.full((len(batch), width), ID_PAD, dtype=np.int32)
+		for n, word_ids in enumerate(batch):
+			if len(word_ids) > 0:
+				source_batch[n, -len(word_ids):] = word_ids	# left padding
+		if beam_width > 1:
+			translation_batch = _beam_search_batch(model, source_batch, width * 2, beam_width=beam_width, length_normalization=length_normalization, shortlist=shortlist)
+		else:
+			translation_batch = translate_batch(model, source_batch, width * 2, shortlist=shortlist)
+		translations += [_tokens_to_sentence(tokens, vocab_inv_target) for tokens in cuda.to_cpu(translation_batch)]
+	return indices, translations
+
+# sentences are sorted by length within windows of sort_window lines and cut into chunks
+# workers translate chunks in any order, a reorder buffer writes the results in line order
+def _make_chunks(source_dataset, chunk_size, sort_window):
+	lengths = np.asarray([len(word_ids) for word_ids in source_dataset])
+	for window_start in xrange(0, len(source_dataset), sort_window):
+		window = np.arange(window_start, min(window_start + sort_window, len(source_dataset)))
+		window = window[np.argsort(-lengths[window], kind="mergesort")]	# longest first
+		for start in xrange(0, len(window), chunk_size):
+			indices = window[start:start + chunk_size].tolist()
+			yield indices, [source_dataset[i] for i in indices]
+
+def translate_file(args):
+	vocab, vocab_inv = load_vocab(args.model_dir)
+	vocab_source, vocab_target = vocab
+	source_dataset = read_lines(args.source_filename, vocab_source)
+
+	# the weights are written once and memory-mapped by every worker
+	tmp_dir = tempfile.mkdtemp()
+	weights_filename = os.path.join(tmp_dir, "weights.npy")
+	model = load_model(args.model_dir)
+	assert model is not None
+	save_params(model, weights_filename)
+	del model
+
+	output = sys.stdout if args.output_filename is None else codecs.open(args.output_filename, "w", "utf-8")
+	start_time = time.time()
+	pool = multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args.model_dir, weights_filename, args.batchsize, args.beam_width, args.length_normalization, get_shortlist_filename(args)))
+	try:
+		reorder_buffer = {}
+		next_index = 0
+		for indices, translations in pool.imap_unordered(_translate_chunk, _make_chunks(source_dataset, args.chunk_size, args.sort_window)):
+			reorder_buffer.update(zip(indices, translations))
+			while next_index in reorder_buffer:
+				output.write(reorder_buffer.pop(next_index) + "\n")
+				next_index += 1
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		shutil.rmtree(tmp_dir)
+		if output is not sys.stdout:
+			output.close()
+	elapsed = time.time() - start_time
+	sys.stderr.write("{} sentences	{:.1f} sec	{:.1f} sentences/sec\n".format(len(source_dataset), elapsed, len(source_dataset) / elapsed))
+
+def get_shortlist_filename(args):
+	if not args.shortlist:
+		return None
+	return args.model_dir + "/shortlist.npz"
+
 def main(args):
+	if args.workers > 0:
+		return translate_file(args)
+
 	# load vocab
 	vocab, vocab_inv = load_vocab(args.model_dir)
 	vocab_source, vocab_target = vocab
@@ -221,7 +473,11 @@ def main(args):
 	model = load_model(args.model_dir)
 	assert model is not None
 
-	show_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_target)
+	shortlist = None
+	if args.shortlist:
+		shortlist = Shortlist.load(get_shortlist_filename(args))
+
+	show_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_target, beam_width=args.beam_width, length_normalization=args.length_normalization, shortlist=shortlist)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -229,5 +485,13 @@ if __name__ == "__main__":
 	parser.add_argument("--source-filename", "-source", default=None)
 	parser.add_argument("--buckets-limit", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--beam-width", "-beam", type=int, default=1)
+	parser.add_argument("--length-normalization", type=float, default=0.6)
+	parser.add_argument("--workers", "-w", type=int, default=0, help="translate in line order with this many cpu processes (set OMP_NUM_THREADS=1)")
+	parser.add_argument("--batchsize", "-b", type=int, default=100)
+	parser.add_argument("--chunk-size", type=int, default=1000)
+	parser.add_argument("--sort-window", type=int, default=10000)
+	parser.add_argument("--output-filename", "-o", type=str, default=None)
+	parser.add_argument("--shortlist", action="store_true", default=False, help="decode with model_dir/shortlist.npz made by shortlist.py")
 	args = parser.parse_args()
 	main(args)
\ No newline at end of file
@@ -2,8 +2,21 @@
 from __future__ import division
 from __future__ import print_function
 from six.moves import xrange
+import os, shutil, tempfile, copy, itertools, multiprocessing, socket, time
 import numpy as np
+import chainer
+import chainer.links as L
+import chainer.functions as F
+from chainer import optimizers, Variable
 from qrnn import QRNN, QRNNEncoder, QRNNDecoder, QRNNGlobalAttentiveDecoder
+from flat import save_params, map_params, FlatAdam, FlatEve, update_accumulated
+from eve import Eve
+from loss import softmax_cross_entropy, linear_softmax_cross_entropy
+from async_eval import AsyncEvaluator
+from iterator import BatchPrefetcher, get_buffer
+from vocab import Vocabulary, _encode, _hash
+from parallel import SharedAllReduce, DataParallel
+from distributed import RingAllReduce, DistributedDataParallel
 
 def test_decoder():
 	np.random.seed(0)
@@ -28,7 +41,7 @@ def test_decoder():
 	np.random.seed(0)
 	decoder.reset_state()
 	for t in xrange(dec_shape[2]):
-		y = decoder.forward_one_step(dec_data[:, :, :t+1], ht)
+		y = decoder.forward_one_step(dec_data[:, :, t, None], ht)
 		assert np.sum((y.data - Y.data[:, :, :t+1]) ** 2) == 0
 		print("t = {} OK".format(t))
 
@@ -54,12 +67,358 @@ def test_attentive_decoder():
 
 	decoder.reset_state()
 	for t in xrange(dec_shape[2]):
-		y = decoder.forward_one_step(dec_data[:, :, :t+1], ht, H, skip_mask)
+		y = decoder.forward_one_step(dec_data[:, :, t, None], ht, H, skip_mask)
 		assert np.sum((y.data - Y.data[:, :, :t+1]) ** 2) == 0
 		print("t = {} OK".format(t))
 
 
 
+def test_map_params():
+	data = np.random.normal(size=(2, 3, 5)).astype(np.float32)
+	encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	Y = encoder(data)
+	filename = os.path.join(tempfile.mkdtemp(), "weights.npy")
+	save_params(encoder, filename)
+
+	mapped = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	map_params(mapped, filename)
+	assert np.all(mapped(data).data == Y.data)
+	print("map_params OK")
+
+def test_async_evaluator():
+	def save(dirname, weights):
+		np.save(os.path.join(dirname, "weights.npy"), weights)
+
+	def load(dirname):
+		return np.load(os.path.join(dirname, "weights.npy"))
+
+	evaluator = AsyncEvaluator(lambda weights: float(weights.sum()), load, save)
+	for epoch in xrange(1, 4):
+		evaluator.submit(epoch, np.full((3,), epoch, dtype=np.float32))
+	results = evaluator.close()
+	# older snapshots may be skipped but the latest one is always evaluated
+	assert evaluator.num_pending == 0
+	assert results[-1] == (3, 9.0)
+	for epoch, metrics in results:
+		assert metrics == epoch * 3
+	print("async evaluator OK")
+
+def test_flat_adam():
+	np.random.seed(0)
+	data = np.random.normal(size=(2, 3, 5)).astype(np.float32)
+	encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	expected = copy.deepcopy(encoder)
+	optimizer = optimizers.Adam(alpha=0.01)
+	optimizer.setup(expected)
+	optimizer.add_hook(chainer.optimizer.GradientClipping(0.1))
+	optimizer.add_hook(chainer.optimizer.WeightDecay(0.01))
+	flat_optimizer = FlatAdam(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+	flat_optimizer.setup(encoder)
+	for step in xrange(3):
+		expected.reset_state()
+		optimizer.update(lossfun=lambda: F.sum(expected(data)))
+		encoder.reset_state()
+		flat_optimizer.update(lambda: F.sum(encoder(data)))
+	for (name, param), (_, param_expected) in zip(sorted(encoder.namedparams()), sorted(expected.namedparams())):
+		assert np.allclose(param.data, param_expected.data, atol=1e-6), name
+	print("flat adam OK")
+
+# d and f are updated from the loss before t is incremented, as in Eve.update
+def test_flat_eve():
+	np.random.seed(0)
+	encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	expected = copy.deepcopy(encoder)
+	optimizer = Eve(alpha=0.01)
+	optimizer.setup(expected)
+	optimizer.add_hook(chainer.optimizer.GradientClipping(0.1))
+	optimizer.add_hook(chainer.optimizer.WeightDecay(0.01))
+	flat_optimizer = FlatEve(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+	flat_optimizer.setup(encoder)
+	for step in xrange(5):
+		data = np.random.normal(scale=step + 1, size=(2, 3, 5)).astype(np.float32)
+		expected.reset_state()
+		optimizer.update(lambda: F.sum(expected(data) ** 2))
+		encoder.reset_state()
+		flat_optimizer.update(lambda: F.sum(encoder(data) ** 2))
+		assert np.allclose(flat_optimizer.d, optimizer.d) and np.allclose(flat_optimizer.f, optimizer.f)
+	assert flat_optimizer.d != 1
+	for (name, param), (_, param_expected) in zip(sorted(encoder.namedparams()), sorted(expected.namedparams())):
+		assert np.allclose(param.data, param_expected.data, atol=1e-6), name
+	print("flat eve OK")
+
+# two half batches accumulated with update_accumulated give the same update as the full batch
+def test_update_accumulated():
+	np.random.seed(0)
+	data = np.random.normal(size=(4, 3, 5)).astype(np.float32)
+	for make_optimizer in [lambda: Eve(alpha=0.01), lambda: FlatEve(alpha=0.01, grad_clip=0.1, weight_decay=0.01)]:
+		encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+		expected = copy.deepcopy(encoder)
+		optimizer = make_optimizer()
+		optimizer.setup(encoder)
+		expected_optimizer = make_optimizer()
+		expected_optimizer.setup(expected)
+		for step in xrange(3):
+			expected.reset_state()
+			expected_optimizer.update(lambda: F.sum(expected(data) ** 2) / data.size)
+			encoder.zerograds()
+			loss_sum = 0
+			for half in [data[:2], data[2:]]:
+				encoder.reset_state()
+				loss = F.sum(encoder(half) ** 2)	# mean over the elements of the half times their number
+				loss.backward()
+				loss_sum += float(loss.data)
+			update_accumulated(encoder, optimizer, loss_sum, data.size)
+			assert np.allclose(optimizer.d, expected_optimizer.d)
+		for (name, param), (_, param_expected) in zip(sorted(encoder.namedparams()), sorted(expected.namedparams())):
+			assert np.allclose(param.data, param_expected.data, atol=1e-6), name
+	print("update accumulated OK")
+
+def test_batch_prefetcher():
+	def fill_batch(buffers, request):
+		if request == 5:
+			raise ValueError("bad request")
+		batch = get_buffer(buffers, "batch", (2,))
+		batch[...] = request
+		return (batch,)
+
+	# batches come out in the order of the requests
+	loader = BatchPrefetcher(xrange(5), fill_batch, num_prefetch=2)
+	assert [int(batch[0]) for batch, in loader] == list(xrange(5))
+
+	# an exception in fill_batch reaches the consumer
+	loader = BatchPrefetcher(xrange(10), fill_batch, num_prefetch=2)
+	received = []
+	try:
+		for batch, in loader:
+			received.append(int(batch[0]))
+		assert False
+	except ValueError:
+		pass
+	assert received == list(xrange(5))
+
+	# close() stops a producer that is blocked on the full queue
+	loader = BatchPrefetcher(itertools.count(), lambda buffers, request: (np.full((2,), request),), num_prefetch=2)
+	assert int(next(loader)[0][0]) == 0
+	while not loader._ready.full():
+		time.sleep(0.01)
+	loader.close()
+	loader._thread.join(5)
+	assert not loader._thread.is_alive()
+	print("batch prefetcher OK")
+
+def test_vocabulary():
+	words = [u"<pad>", u"<unk>", u"caf\u00e9", u"\u65e5\u672c\u8a9e", u"na\u00efve", u"a"]
+	# two more words on the same slot as the first one, 8 words use a table of 16 slots
+	slot = lambda word: _hash(_encode(word)) & 15
+	words += [word for word in (u"c{}".format(i) for i in xrange(1000)) if slot(word) == slot(words[0])][:2]
+	assert len(words) == 8
+	directory = tempfile.mkdtemp()
+	try:
+		Vocabulary.from_dict(dict((word, word_id) for word_id, word in enumerate(words))).save(os.path.join(directory, "vocab"))
+		assert Vocabulary.exists(os.path.join(directory, "vocab"))
+		vocab = Vocabulary.load(os.path.join(directory, "vocab"), mmap=True)
+		assert len(vocab.table) == 16 and len(vocab) == len(words) and len(vocab.inv) == len(words)
+		for word_id, word in enumerate(words):
+			assert vocab.get(word) == word_id and vocab[word] == word_id and vocab.get(word.encode("utf-8")) == word_id
+			assert word in vocab and word_id in vocab.inv
+			assert vocab.inv[word_id] == word
+		assert vocab.to_dict() == dict((word, word_id) for word_id, word in enumerate(words))
+
+		# missing words, including a prefix of a stored one
+		for word in (u"missing", u"caf", u"\u65e5"):
+			assert vocab.get(word) is None and vocab.get(word, -1) == -1 and word not in vocab
+		try:
+			vocab[u"missing"]
+			assert False
+		except KeyError:
+			pass
+		assert len(words) not in vocab.inv and -1 not in vocab.inv
+		try:
+			vocab.inv[len(words)]
+			assert False
+		except KeyError:
+			pass
+
+		Vocabulary.from_dict({}).save(os.path.join(directory, "empty"))
+		empty = Vocabulary.load(os.path.join(directory, "empty"), mmap=True)
+		assert len(empty) == 0 and len(empty.inv) == 0
+		assert empty.get(u"a") is None and u"a" not in empty and 0 not in empty.inv
+		assert empty.to_dict() == {}
+	finally:
+		shutil.rmtree(directory)
+	print("vocabulary OK")
+
+def test_shared_all_reduce():
+	num_workers, size = 3, 101
+	all_reduce = SharedAllReduce(size, num_workers, num_scalars=2)
+
+	def run(worker_index):
+		for step in xrange(10):
+			array = np.full((size,), worker_index + step, dtype=np.float32)
+			all_reduce(worker_index, array)
+			assert np.all(array == sum(xrange(num_workers)) + num_workers * step)
+			# scalars are summed in float64, 1e8 + 1 is not representable in float32
+			array = np.full((size,), step, dtype=np.float32)
+			scalars = np.asarray([1e8 + worker_index, step], dtype=np.float64)
+			all_reduce(worker_index, array, scalars=scalars)
+			assert np.all(array == num_workers * step)
+			assert scalars.tolist() == [3e8 + sum(xrange(num_workers)), num_workers * step]
+			array = np.full((size - 1,), worker_index, dtype=np.float32)
+			all_reduce.broadcast(worker_index, array)
+			assert np.all(array == 0)
+
+	processes = [multiprocessing.Process(target=run, args=(worker_index,)) for worker_index in xrange(1, num_workers)]
+	for process in processes:
+		process.start()
+	run(0)
+	for process in processes:
+		process.join()
+		assert process.exitcode == 0
+	print("shared all-reduce OK")
+
+# one step of 2 workers on half batches equals one step on the concatenated batch
+def test_data_parallel():
+	np.random.seed(0)
+	data = np.random.normal(size=(4, 3, 5)).astype(np.float32)
+	encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	expected = copy.deepcopy(encoder)
+	optimizer = FlatAdam(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+	optimizer.setup(encoder)
+	trainer = DataParallel(encoder, optimizer, 2)
+
+	def step(worker_index):
+		half = data[worker_index * 2:(worker_index + 1) * 2]
+		encoder.reset_state()
+		trainer.step(lambda: (F.sum(encoder(half) ** 2) / half.size, half.size))
+
+	trainer.start(step)
+	step(0)
+	trainer.join()
+
+	expected_optimizer = FlatAdam(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+	expected_optimizer.setup(expected)
+	expected.reset_state()
+	expected_optimizer.update(lambda: F.sum(expected(data) ** 2) / data.size)
+	assert np.allclose(optimizer.params.data, expected_optimizer.params.data, atol=1e-6)
+	print("data parallel OK")
+
+def test_ring_all_reduce():
+	world_size, size = 3, 101
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+
+	def run(rank):
+		for dtype in (np.float32, np.float16):
+			all_reduce = RingAllReduce(rank, world_size, "127.0.0.1", port, dtype=dtype, bucket_size=16)
+			array = np.full((size,), rank + 0.1, dtype=np.float32)
+			all_reduce(rank, array)
+			assert np.allclose(array, sum(xrange(world_size)) + 0.1 * world_size, atol=1e-2)
+			# float16 sums must still be identical on every rank
+			reference = array.copy()
+			all_reduce.broadcast(rank, reference)
+			assert np.all(reference == array)
+			all_reduce.close()
+
+	processes = [multiprocessing.Process(target=run, args=(rank,)) for rank in xrange(1, world_size)]
+	for process in processes:
+		process.start()
+	run(0)
+	for process in processes:
+		process.join()
+		assert process.exitcode == 0
+	print("ring all-reduce OK")
+
+def test_distributed_data_parallel():
+	np.random.seed(0)
+	data = np.random.normal(size=(4, 3, 5)).astype(np.float32)
+	encoder = QRNNEncoder(3, 4, kernel_size=2, pooling="fo")
+	expected = copy.deepcopy(encoder)
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+
+	# a large token count would overflow float16 if gradients were not normalized before they are sent
+	def run(rank):
+		optimizer = FlatAdam(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+		optimizer.setup(encoder)
+		all_reduce = RingAllReduce(rank, 2, "127.0.0.1", port, dtype=np.float16, bucket_size=16)
+		trainer = DistributedDataParallel(encoder, optimizer, all_reduce)
+		half = data[rank * 2:(rank + 1) * 2]
+		encoder.reset_state()
+		trainer.step(lambda: (F.sum(encoder(half) ** 2) / half.size, 10000000))
+		assert trainer.num_skipped == 0
+		# every rank must hold the same weights
+		reference = optimizer.params.data.copy()
+		all_reduce.broadcast(rank, reference)
+		assert np.all(reference == optimizer.params.data)
+		all_reduce.close()
+		return optimizer
+
+	process = multiprocessing.Process(target=run, args=(1,))
+	process.start()
+	optimizer = run(0)
+	process.join()
+	assert process.exitcode == 0
+
+	expected_optimizer = FlatAdam(alpha=0.01, grad_clip=0.1, weight_decay=0.01)
+	expected_optimizer.setup(expected)
+	expected.reset_state()
+	expected_optimizer.update(lambda: F.sum(expected(data) ** 2) / data.size)
+	assert np.allclose(optimizer.params.data, expected_optimizer.params.data, atol=1e-3)
+	print("distributed data parallel OK")
+
+def test_softmax_cross_entropy_cpu():
+	np.random.seed(0)
+	x = np.random.normal(size=(13, 7)).astype(np.float32)
+	t = np.random.randint(0, 7, size=(13,)).astype(np.int32)
+	t[:3] = 0
+	x_expected = Variable(x.copy())
+	loss_expected = F.softmax_cross_entropy(x_expected, t, ignore_label=0)
+	loss_expected.backward()
+	x = Variable(x)
+	loss = softmax_cross_entropy(x, t, ignore_label=0)
+	loss.backward()
+	assert np.allclose(loss.data, loss_expected.data)
+	assert np.allclose(x.grad, x_expected.grad, atol=1e-6)
+	assert np.all(x.grad[:3] == 0)
+	print("softmax cross entropy OK")
+
+def test_linear_softmax_cross_entropy():
+	np.random.seed(0)
+	dense = L.Linear(8, 10)
+	h = np.random.normal(size=(13, 8)).astype(np.float32)
+	t = np.random.randint(0, 10, size=(13,)).astype(np.int32)
+	t[:3] = 0
+	h_expected = Variable(h.copy())
+	loss_expected = F.softmax_cross_entropy(dense(h_expected), t, ignore_label=0)
+	dense.zerograds()
+	loss_expected.backward()
+	gW_expected = dense.W.grad.copy()
+	h = Variable(h)
+	loss = linear_softmax_cross_entropy(h, dense.W, dense.b, t, chunk_size=4, ignore_label=0)
+	dense.zerograds()
+	loss.backward()
+	assert np.allclose(loss.data, loss_expected.data)
+	assert np.allclose(h.grad, h_expected.grad, atol=1e-6)
+	assert np.allclose(dense.W.grad, gW_expected, atol=1e-6)
+	print("linear softmax cross entropy OK")
+
 if __name__ == "__main__":
 	test_decoder()
-	test_attentive_decoder()
\ No newline at end of file
+	test_attentive_decoder()
+	test_map_params()
+	test_async_evaluator()
+	test_flat_adam()
+	test_flat_eve()
+	test_update_accumulated()
+	test_batch_prefetcher()
+	test_vocabulary()
+	test_shared_all_reduce()
+	test_data_parallel()
+	test_ring_all_reduce()
+	test_distributed_data_parallel()
+	test_softmax_cross_entropy_cpu()
+	test_linear_softmax_cross_entropy()
@@ -0,0 +1,112 @@
+import os, zlib
+import numpy as np
+
+def _encode(word):
+	if isinstance(word, bytes):
+		return word
+	return word.encode("utf-8")
+
+def _hash(word_bytes):
+	return zlib.crc32(word_bytes) & 0xffffffff
+
+# array-backed replacement for the word -> id dict
+# blob:		utf-8 encoded words, concatenated
+# offsets:	word i is blob[offsets[i]:offsets[i + 1]]
+# table:	open addressing (linear probing) hash table of word ids, -1 for empty slots
+# all three arrays can be memory-mapped and shared between processes
+class Vocabulary(object):
+	suffixes = ("blob", "offsets", "table")
+
+	def __init__(self, blob, offsets, table):
+		self.blob = blob
+		self.offsets = offsets
+		self.table = table
+		self._mask = len(table) - 1
+		self.inv = InverseVocabulary(self)
+
+	@classmethod
+	def from_dict(cls, vocab):
+		vocab_size = max(vocab.values()) + 1 if len(vocab) > 0 else 0
+		encoded = [b""] * vocab_size
+		for word, word_id in vocab.items():
+			encoded[word_id] = _encode(word)
+
+		offsets = np.zeros((vocab_size + 1,), dtype=np.int64)
+		np.cumsum([len(word_bytes) for word_bytes in encoded], out=offsets[1:])
+		blob = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+
+		# load factor <= 0.5
+		table_size = 1
+		while table_size < 2 * len(vocab):
+			table_size *= 2
+		table = np.full((table_size,), -1, dtype=np.int32)
+		mask = table_size - 1
+		for word, word_id in vocab.items():
+			slot = _hash(_encode(word)) & mask
+			while table[slot] != -1:
+				slot = (slot + 1) & mask
+			table[slot] = word_id
+		return cls(blob, offsets, table)
+
+	@classmethod
+	def exists(cls, prefix):
+		return all(os.path.isfile("{}.{}.npy".format(prefix, suffix)) for suffix in cls.suffixes)
+
+	@classmethod
+	def load(cls, prefix, mmap=True):
+		mmap_mode = "r" if mmap else None
+		blob, offsets, table = [np.load("{}.{}.npy".format(prefix, suffix), mmap_mode=mmap_mode) for suffix in cls.suffixes]
+		return cls(blob, offsets, table)
+
+	def save(self, prefix):
+		for suffix, array in zip(self.suffixes, (self.blob, self.offsets, self.table)):
+			np.save("{}.{}.npy".format(prefix, suffix), array)
+
+	def _word_bytes(self, word_id):
+		return self.blob[self.offsets[word_id]:self.offsets[word_id + 1]].tobytes()
+
+	def get(self, word, default=None):
+		word_bytes = _encode(word)
+		slot = _hash(word_bytes) & self._mask
+		while True:
+			word_id = int(self.table[slot])
+			if word_id == -1:
+				return default
+			if self._word_bytes(word_id) == word_bytes:
+				return word_id
+			slot = (slot + 1) & self._mask
+
+	def __getitem__(self, word):
+		word_id = self.get(word)
+		if word_id is None:
+			raise KeyError(word)
+		return word_id
+
+	def __contains__(self, word):
+		return self.get(word) is not None
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def word(self, word_id):
+		return self._word_bytes(word_id).decode("utf-8")
+
+	def to_dict(self):
+		return dict((self.word(word_id), word_id) for word_id in self.table if word_id != -1)
+
+# id -> word view of a Vocabulary, replaces the vocab_inv dict
+class InverseVocabulary(object):
+	def __init__(self, vocab):
+		self.vocab = vocab
+
+	def __getitem__(self, word_id):
+		word_id = int(word_id)
+		if word_id < 0 or word_id >= len(self.vocab):
+			raise KeyError(word_id)
+		return self.vocab.word(word_id)
+
+	def __contains__(self, word_id):
+		return 0 <= int(word_id) < len(self.vocab)
+
+	def __len__(self):
+		return len(self.vocab)